@@ -38,8 +38,16 @@ async def _run() -> None:
     from gestorftpbase import select_gestor
 
     gestor = select_gestor()
-    deleted = await gestor.eliminar_expiradas()
-    logger.info("Cleanup FTP: %d solicitudes expiradas procesadas", deleted)
+    # Un solo pool MySQL para toda la corrida.
+    await gestor.iniciar()
+    tiempos: dict = {}
+    try:
+        deleted = await gestor.eliminar_expiradas(tiempos=tiempos)
+    finally:
+        await gestor.cerrar()
+    resumen = " ".join(f"{fase}={seg:.2f}s" for fase, seg in tiempos.items())
+    logger.info("Cleanup FTP: %d solicitudes expiradas procesadas%s",
+                deleted, f" ({resumen})" if resumen else "")
 
 
 def main() -> int:
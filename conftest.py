@@ -0,0 +1,36 @@
+"""
+Fixtures compartidas por los tests.
+"""
+import asyncio
+import time
+
+import pytest
+
+
+async def _medir_lag(corrutina, tick_s: float = 0.01):
+    """Espera `corrutina` mientras un ticker duerme tick_s una y otra vez, y
+    devuelve (resultado, mayor atraso del event loop en segundos). Un atraso
+    grande es trabajo bloqueante que corrió en el loop y no en un hilo."""
+    lag_max = 0.0
+    terminado = False
+
+    async def ticker():
+        nonlocal lag_max
+        while not terminado:
+            t0 = time.perf_counter()
+            await asyncio.sleep(tick_s)
+            lag_max = max(lag_max, time.perf_counter() - t0 - tick_s)
+
+    tick = asyncio.create_task(ticker())
+    try:
+        resultado = await corrutina
+    finally:
+        terminado = True
+        await tick
+    return resultado, lag_max
+
+
+@pytest.fixture
+def medir_lag():
+    """`resultado, lag_max = asyncio.run(medir_lag(corrutina, tick_s))`."""
+    return _medir_lag
@@ -1,17 +1,29 @@
 import os
-import subprocess
+import signal
 import hashlib
 import asyncio
 import shutil
-import socket
 import logging
+import re
+import shlex
+import math
+import tempfile
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timezone
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
 import aiomysql
+from pymysql.constants import CLIENT, ER
 from cifrado import cifrar
 from gestorftpbase import GestorFTPBase
-from tmpftpdb import TMPFTPdb
-from argon2 import PasswordHasher
+from tmpftpdb import TMPFTPdb, AsyncTMPFTPdb
+from indicedescargas import IndiceDescargas
+from papelera import Papelera
+from usodisco import EscanerUso
+from sshmux import MultiplexorSSH
+from localidad import LocalidadHosts
+from hashargon2 import HashArgon2
 #try:
 #    from passlib.hash import sha512_crypt, sha256_crypt, md5_crypt, des_crypt, argon2
 #    PASSLIB_AVAILABLE = True
@@ -21,14 +33,232 @@ from argon2 import PasswordHasher
 
 logger = logging.getLogger(__name__)
 
+# Usuarios por sentencia en las variantes masivas de FTPDB_MySQL (IN (...)).
+_MYSQL_LOTE = 500
+
+# Línea de --info=progress2, p. ej.
+#   "  1,234,567,890  45%   12.34MB/s    0:01:23 (xfr#12, to-chk=34/100)"
+_RE_PROGRESO_RSYNC = re.compile(r"^\s*([\d,.]+)\s+(\d{1,3})%\s+([\d.]+)([kKMGT]?B)/s\s+(\d+:\d{2}:\d{2})")
+_UNIDADES_RSYNC = {"B": 1, "kB": 1024, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3, "TB": 1024 ** 4}
+
+
+def _parse_progreso_rsync(linea: str) -> Optional[Dict[str, Any]]:
+    """Instantánea {porcentaje, bytes, bytes_por_seg, eta} de una línea de
+    progress2, o None si la línea no es de progreso."""
+    m = _RE_PROGRESO_RSYNC.match(linea)
+    if not m:
+        return None
+    bytes_, pct, velocidad, unidad, eta = m.groups()
+    try:
+        return {
+            "porcentaje": int(pct),
+            "bytes": int(bytes_.replace(",", "").replace(".", "")),
+            "bytes_por_seg": int(float(velocidad) * _UNIDADES_RSYNC.get(unidad, 1)),
+            "eta": eta,
+        }
+    except ValueError:
+        return None
+
+
+def _timeout_env(nombre: str, defecto: str) -> Optional[float]:
+    """Segundos de TEMPOFTP_*_TIMEOUT_S; 0 o negativo = sin límite."""
+    valor = float(os.getenv(nombre, defecto))
+    return valor if valor > 0 else None
+
+
+async def _terminar_grupo(proc: asyncio.subprocess.Process, gracia_s: float = 5.0) -> None:
+    """SIGTERM a todo el grupo del proceso (ssh, el rsync remoto que arrastra,
+    etc.) y SIGKILL si no terminó en gracia_s."""
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=gracia_s)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+
+
+async def _esperar_proceso(proc: asyncio.subprocess.Process, corrutina, timeout_s: Optional[float], cmd) -> Any:
+    """Espera `corrutina` (que lee/espera a proc) con tope de timeout_s. Si se
+    vence o la tarea se cancela, termina el grupo del proceso antes de salir."""
+    try:
+        return await asyncio.wait_for(corrutina, timeout=timeout_s)
+    except asyncio.TimeoutError:
+        await _terminar_grupo(proc)
+        raise TimeoutError(f"'{cmd[0]}' superó {timeout_s:g}s y se terminó")
+    except asyncio.CancelledError:
+        await asyncio.shield(_terminar_grupo(proc))
+        raise
+
+
+async def _ejecutar_comando(cmd, timeout_s: Optional[float]) -> Tuple[int, str, str]:
+    """(returncode, stdout, stderr) de un comando corto, en su propio grupo de
+    procesos, sin ocupar un hilo mientras corre."""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    out, err = await _esperar_proceso(proc, proc.communicate(), timeout_s, cmd)
+    return proc.returncode, out.decode("utf-8", errors="replace"), err.decode("utf-8", errors="replace")
+
+
+def _subdir_contenido(ruta: str, id: str) -> Optional[str]:
+    """Dónde deja rsync el contenido de `ruta` dentro de /data/<usuario>/<id>:
+    None si lo vuelca ahí mismo ('ruta/' o último segmento igual a id), si no
+    el subdirectorio con el último segmento de la ruta."""
+    ultimo = os.path.basename(ruta.rstrip("/"))
+    if ultimo == id or ruta.endswith("/"):
+        return None
+    return ultimo
+
+
+@contextmanager
+def _alinear_link_dest(candidatos: List[str], subdir: Optional[str]):
+    """
+    rsync busca cada archivo en DIR/<ruta relativa al destino>. Los candidatos
+    son directorios de contenido; si esta copia deja el suyo en
+    <destino>/<subdir>, cada candidato se presenta como un directorio temporal
+    con un enlace simbólico <subdir> -> candidato. Se borra al salir.
+    """
+    if not candidatos or subdir is None:
+        yield list(candidatos)
+        return
+    tmp = tempfile.mkdtemp(prefix="tempoftp-linkdest-")
+    try:
+        alineados = []
+        for i, candidato in enumerate(candidatos):
+            d = os.path.join(tmp, str(i))
+            os.mkdir(d)
+            os.symlink(candidato, os.path.join(d, subdir))
+            alineados.append(d)
+        yield alineados
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _filtrar_link_dest(rutas: List[str], referencia: str) -> List[str]:
+    """Las rutas que existen, son directorios reales (no los enlaces de las
+    solicitudes de host local) y están en el mismo sistema de archivos que
+    `referencia`: --link-dest no puede enlazar entre sistemas de archivos."""
+    try:
+        dispositivo = os.stat(referencia).st_dev
+    except OSError:
+        return []
+    validas = []
+    for ruta in dict.fromkeys(rutas):
+        try:
+            if not os.path.islink(ruta) and os.path.isdir(ruta) and os.stat(ruta).st_dev == dispositivo:
+                validas.append(ruta)
+        except OSError:
+            continue
+    return validas
+
+
+def _repartir(entradas: List[Tuple[str, int]], n: int) -> List[List[str]]:
+    """Reparte (nombre, bytes) en hasta n grupos de peso parecido: de la más
+    grande a la más chica, cada entrada va al grupo más liviano."""
+    grupos: List[Tuple[int, int, List[str]]] = [(0, i, []) for i in range(n)]
+    for nombre, tamano in sorted(entradas, key=lambda e: (-e[1], e[0])):
+        peso, i, nombres = min(grupos)
+        nombres.append(nombre)
+        grupos[i] = (peso + tamano, i, nombres)
+    return [nombres for _, _, nombres in grupos if nombres]
+
+
+def _particionar(entradas: List[Tuple[str, int]], n: int) -> Optional[List[List[str]]]:
+    """Las entradas de primer nivel del sondeo repartidas en hasta n
+    particiones (_repartir). None si no conviene o no se puede particionar
+    (no es un directorio, una sola entrada, nombres que no son UTF-8): la
+    copia sigue con un solo rsync."""
+    if any("\ufffd" in nombre for nombre, _ in entradas):
+        return None
+    particiones = _repartir(entradas, n)
+    return particiones if len(particiones) > 1 else None
+
+
+def _combinar_progreso(snaps: Dict[int, Dict[str, Any]], total_bytes: Optional[int]) -> Optional[Dict[str, Any]]:
+    """Una instantánea de progreso a partir de la de cada partición."""
+    if not snaps:
+        return None
+    bytes_ = sum(s["bytes"] for s in snaps.values())
+    velocidad = sum(s["bytes_por_seg"] for s in snaps.values())
+    if total_bytes:
+        porcentaje = min(100, bytes_ * 100 // total_bytes)
+        restante = max(0, total_bytes - bytes_)
+        segundos = int(restante / velocidad) if velocidad else 0
+        eta = f"{segundos // 3600}:{segundos % 3600 // 60:02d}:{segundos % 60:02d}"
+    else:
+        porcentaje = min(s["porcentaje"] for s in snaps.values())
+        eta = max((s["eta"] for s in snaps.values()), key=lambda e: tuple(int(x) for x in e.split(":")))
+    return {"porcentaje": porcentaje, "bytes": bytes_, "bytes_por_seg": velocidad, "eta": eta,
+            "particiones": len(snaps)}
+
+
+def _cuota_ftp(uso: Dict[str, int]) -> Tuple[int, int]:
+    """(QuotaSize en MB, QuotaFiles) de Pure-FTPd para el uso de un usuario:
+    lo publicado más TEMPOFTP_CUOTA_MARGEN_PCT por ciento (2), redondeado
+    hacia arriba. El usuario sólo descarga, y la cuota le impide subir datos
+    propios a /data; el margen cubre lo que el origen crece entre el sondeo
+    (cacheado hasta TEMPOFTP_DU_CACHE_TTL_S) y el rsync, que copia lo que
+    haya en ese momento: sin él, el home quedaría ya por encima de la cuota.
+    Mínimo 1, para que un home vacío (origen local) no deje la cuota en 0."""
+    factor = 1 + float(os.getenv("TEMPOFTP_CUOTA_MARGEN_PCT", "2")) / 100
+    return (max(1, math.ceil(uso["bytes"] * factor / (1024 * 1024))),
+            max(1, math.ceil(uso["archivos"] * factor)))
+
+
+def _bytes_en_arbol(ruta: str, solo_compartidos: bool = False) -> int:
+    """Bytes de los archivos bajo `ruta` (sin seguir enlaces). Con
+    `solo_compartidos`, sólo los que tienen otros enlaces duros (reuso,
+    --link-dest): están en el árbol pero no ocupan disco de nuevo."""
+    total = 0
+    pendientes = [ruta]
+    while pendientes:
+        try:
+            with os.scandir(pendientes.pop()) as it:
+                for entrada in it:
+                    try:
+                        if entrada.is_dir(follow_symlinks=False):
+                            pendientes.append(entrada.path)
+                        elif entrada.is_file(follow_symlinks=False):
+                            st = entrada.stat(follow_symlinks=False)
+                            if not solo_compartidos or st.st_nlink > 1:
+                                total += st.st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total
+
 
 class FTPDB_MySQL:
     """
     Gestor simple de conexión MySQL para Pure-FTPd con pool aiomysql.
+
+    Se crea un pool por proceso (GestorFTP.iniciar, desde el lifespan de
+    FastAPI o al inicio de cleanup_expired.py / transfer_worker.py) y todas
+    las operaciones toman conexiones prestadas de él; antes cada operación
+    creaba y cerraba su propio pool, pagando el handshake de MySQL cada vez.
+    Tamaño, reciclado y chequeo de salud se configuran con TEMPOFTP_MYSQL_*.
     """
     def __init__(self) -> None:
         self.pool: Optional[aiomysql.Pool] = None
         self.conf: Optional[Dict[str, object]] = None
+        self._lock_connect = asyncio.Lock()
+        # Una conexión ociosa más de este tiempo se verifica con ping() antes de
+        # prestarse (MySQL corta las inactivas tras wait_timeout).
+        self._ping_tras_s = float(os.getenv("TEMPOFTP_MYSQL_PING_S", "30"))
+        self._prestamos = 0
+        self._espera_total_s = 0.0
+        self._espera_max_s = 0.0
+        self._reconexiones = 0
+        # Hashes de contraseña fuera del event loop, con memoria acotada.
+        self.hasher = HashArgon2()
 
     async def connect(self) -> None:
         host = os.getenv("FTP_DB_HOST", "localhost")
@@ -37,16 +267,24 @@ class FTPDB_MySQL:
         password = os.getenv("FTP_DB_PASS", "secret")
         dbname = os.getenv("FTP_DB_NAME", "ftpdb")
         self.conf = {"host": host, "port": port, "user": user, "db": dbname}
-        if self.pool is None:
-            logger.debug("Iniciando pool de conexión MySQL")
-            self.pool = await aiomysql.create_pool(
-                host=host,
-                port=port,
-                user=user,
-                password=password,
-                db=dbname,
-                autocommit=True
-            )
+        async with self._lock_connect:
+            if self.pool is None:
+                minsize = int(os.getenv("TEMPOFTP_MYSQL_POOL_MIN", "1"))
+                maxsize = int(os.getenv("TEMPOFTP_MYSQL_POOL_MAX", "10"))
+                recycle = int(os.getenv("TEMPOFTP_MYSQL_POOL_RECYCLE_S", "3600"))
+                logger.debug("Iniciando pool de conexión MySQL (min=%s max=%s recycle=%ss)", minsize, maxsize, recycle)
+                self.pool = await aiomysql.create_pool(
+                    host=host,
+                    port=port,
+                    user=user,
+                    password=password,
+                    db=dbname,
+                    autocommit=True,
+                    minsize=minsize,
+                    maxsize=maxsize,
+                    pool_recycle=recycle,
+                    client_flag=CLIENT.FOUND_ROWS,
+                )
 
     async def close(self) -> None:
         if self.pool:
@@ -55,92 +293,215 @@ class FTPDB_MySQL:
             await self.pool.wait_closed()
             self.pool = None
 
-    async def obtener_password_hash(self, user: str) -> Optional[str]:
+    @asynccontextmanager
+    async def _acquire(self):
+        """Presta una conexión del pool midiendo la espera y verificando con
+        ping() las que llevan más de TEMPOFTP_MYSQL_PING_S ociosas."""
+        if self.pool is None:
+            await self.connect()
+        t0 = time.perf_counter()
         async with self.pool.acquire() as conn:
+            espera = time.perf_counter() - t0
+            self._prestamos += 1
+            self._espera_total_s += espera
+            self._espera_max_s = max(self._espera_max_s, espera)
+            ultimo_uso = getattr(conn, "_tempoftp_ultimo_uso", None)
+            if ultimo_uso is not None and time.monotonic() - ultimo_uso > self._ping_tras_s:
+                try:
+                    await conn.ping(reconnect=True)
+                except Exception:
+                    self._reconexiones += 1
+                    raise
+            try:
+                yield conn
+            finally:
+                conn._tempoftp_ultimo_uso = time.monotonic()
+
+    def metricas(self) -> Dict[str, Any]:
+        """Estado del pool: conexiones en uso/ociosas y tiempo de espera por préstamo."""
+        if self.pool is None:
+            return {"conectado": False}
+        tamano, libres = self.pool.size, self.pool.freesize
+        return {
+            "conectado": True,
+            "en_uso": tamano - libres,
+            "ociosas": libres,
+            "min": self.pool.minsize,
+            "max": self.pool.maxsize,
+            "prestamos": self._prestamos,
+            "espera_media_ms": round(self._espera_total_s / self._prestamos * 1000, 3) if self._prestamos else 0.0,
+            "espera_max_ms": round(self._espera_max_s * 1000, 3),
+            "pings_fallidos": self._reconexiones,
+        }
+
+    async def obtener_password_hash(self, user: str) -> Optional[str]:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute("SELECT Password FROM users WHERE User=%s", (user,))
                 row = await cur.fetchone()
                 return row[0] if row else None
 
-    async def actualizar_password_ftp(self, user: str, password: str) -> None:
-        """Actualiza la contraseña de un usuario FTP existente."""
-        stored_password = self._hash_password(password)
-        async with self.pool.acquire() as conn:
+    def _ctx_error(self) -> str:
+        conf = self.conf or {}
+        return f"user={conf.get('user')} host={conf.get('host')} db={conf.get('db')} table=users"
+
+    async def actualizar_password_ftp(self, user: str, password: str) -> bool:
+        """Actualiza la contraseña de un usuario FTP existente. Retorna True si existía."""
+        stored_password = await self._hash_password(password)
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 query = "UPDATE users SET Password=%s WHERE User=%s"
                 try:
                     await cur.execute(query, (stored_password, user))
                 except Exception as e:
-                    conf = self.conf or {}
-                    ctx = f"user={conf.get('user')} host={conf.get('host')} db={conf.get('db')} table=users"
-                    msg = f"Error al actualizar password en MySQL ({ctx}). Detalle: {e}."
+                    msg = f"Error al actualizar password en MySQL ({self._ctx_error()}). Detalle: {e}."
                     raise Exception(msg)
+                return cur.rowcount > 0
+
+    # Con CLIENT.FOUND_ROWS (ver connect) rowcount de un UPDATE cuenta las filas
+    # que coinciden, no sólo las que cambiaron: bloquear un usuario ya bloqueado
+    # devuelve 1, y cada operación es una sola sentencia sin SELECT previo.
 
     async def eliminar_usuario_ftp(self, user: str) -> bool:
-        """Elimina un usuario FTP de la base de datos."""
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                # Verificar si existe primero para retornar bool
-                await cur.execute("SELECT COUNT(*) FROM users WHERE User=%s", (user,))
-                if (await cur.fetchone())[0] == 0:
-                    return False
-                await cur.execute("DELETE FROM users WHERE User=%s", (user,))
-                return True
+        """Elimina un usuario FTP de la base de datos. Retorna True si existía."""
+        return await self.eliminar_usuarios_ftp([user]) > 0
 
     async def bloquear_usuario(self, user: str) -> bool:
         """Deshabilita un usuario FTP poniendo Status=0. Retorna True si existía."""
-        async with self.pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT COUNT(*) FROM users WHERE User=%s", (user,))
-                if (await cur.fetchone())[0] == 0:
-                    return False
-                await cur.execute("UPDATE users SET Status=0 WHERE User=%s", (user,))
-                return True
+        return await self.bloquear_usuarios([user]) > 0
 
     async def desbloquear_usuario(self, user: str) -> bool:
         """Rehabilita un usuario FTP poniendo Status=1. Retorna True si existía."""
-        async with self.pool.acquire() as conn:
+        return await self.desbloquear_usuarios([user]) > 0
+
+    async def _por_lotes(self, sql: str, users, params_previos: tuple = ()) -> int:
+        """Ejecuta `sql` (con un `{}` donde va la lista IN) sobre `users` en
+        sentencias de hasta _MYSQL_LOTE usuarios. Devuelve la suma de rowcount."""
+        users = list(dict.fromkeys(users))
+        total = 0
+        if not users:
+            return total
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("SELECT COUNT(*) FROM users WHERE User=%s", (user,))
-                if (await cur.fetchone())[0] == 0:
-                    return False
-                await cur.execute("UPDATE users SET Status=1 WHERE User=%s", (user,))
-                return True
-
-    async def crear_usuario_ftp(self, user: str, password: str, homedir: str) -> None:
-        async with self.pool.acquire() as conn:
+                for i in range(0, len(users), _MYSQL_LOTE):
+                    lote = users[i:i + _MYSQL_LOTE]
+                    await cur.execute(sql.format(", ".join(["%s"] * len(lote))), (*params_previos, *lote))
+                    total += cur.rowcount
+        return total
+
+    async def eliminar_usuarios_ftp(self, users) -> int:
+        """Elimina N usuarios FTP en una sentencia (por lote). Retorna cuántos existían."""
+        return await self._por_lotes("DELETE FROM users WHERE User IN ({})", users)
+
+    async def bloquear_usuarios(self, users) -> int:
+        """Status=0 para N usuarios en una sentencia (por lote). Retorna cuántos existían."""
+        return await self._por_lotes("UPDATE users SET Status=%s WHERE User IN ({})", users, (0,))
+
+    async def desbloquear_usuarios(self, users) -> int:
+        """Status=1 para N usuarios en una sentencia (por lote). Retorna cuántos existían."""
+        return await self._por_lotes("UPDATE users SET Status=%s WHERE User IN ({})", users, (1,))
+
+    async def estado_usuarios(self, users) -> Dict[str, int]:
+        """{usuario: Status} de los que existen, en una consulta por lote."""
+        users = list(dict.fromkeys(users))
+        estados: Dict[str, int] = {}
+        if not users:
+            return estados
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                for i in range(0, len(users), _MYSQL_LOTE):
+                    lote = users[i:i + _MYSQL_LOTE]
+                    await cur.execute(
+                        f"SELECT User, Status FROM users WHERE User IN ({', '.join(['%s'] * len(lote))})", lote)
+                    for user, status in await cur.fetchall():
+                        estados[user] = int(status)
+        return estados
+
+    async def crear_usuario_ftp(self, user: str, password: str, homedir: str) -> bool:
+        """Crea el usuario FTP si no existe, con un solo INSERT: la clave
+        duplicada (User es PRIMARY KEY) indica que ya existía y no se toca.
+        Retorna True si lo creó."""
+        stored_password = await self._hash_password(password)
+        uid = int(os.getenv("FTP_UID", 2001))
+        gid = int(os.getenv("FTP_GID", 2001))
+        query = (
+            "INSERT INTO users (User, Password, Uid, Gid, Dir, Status) VALUES (%s, %s, %s, %s, %s, %s)"
+        )
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("SELECT COUNT(*) FROM users WHERE User=%s", (user,))
-                existe = (await cur.fetchone())[0] > 0
-                if existe:
-                    return
-
-                stored_password = self._hash_password(password)
-
-                uid = int(os.getenv("FTP_UID", 2001))
-                gid = int(os.getenv("FTP_GID", 2001))
-                query = (
-                    "INSERT INTO users (User, Password, Uid, Gid, Dir, Status) VALUES (%s, %s, %s, %s, %s, %s)"
-                )
                 try:
                     await cur.execute(query, (user, stored_password, uid, gid, homedir, '1'))
+                except aiomysql.IntegrityError as e:
+                    if e.args and e.args[0] == ER.DUP_ENTRY:
+                        return False
+                    raise Exception(self._msg_error_insert(e))
                 except Exception as e:
-                    conf = self.conf or {}
-                    ctx = f"user={conf.get('user')} host={conf.get('host')} db={conf.get('db')} table=users"
-                    msg = (
-                        f"Error al insertar usuario FTP en MySQL ({ctx}). Detalle original: {e}. "
-                        "Sugerencia: privilegios INSERT en ftpdb.users y que MYSQLCrypt coincide con FTP_PASSWORD_FORMAT."
-                    )
-                    raise Exception(msg)
+                    raise Exception(self._msg_error_insert(e))
+                return True
 
-    def _hash_password(self, password: str) -> str:
+    async def guardar_usuario_ftp(self, user: str, password: str, homedir: str,
+                                  cuota: Optional[Tuple[int, int]] = None) -> str:
+        """Crea el usuario FTP o, si ya existe, le cambia la contraseña, en un
+        solo INSERT ... ON DUPLICATE KEY UPDATE. Retorna 'creado' o 'actualizado'
+        (rowcount 1 o 2; el salt nuevo hace que la contraseña siempre cambie).
+        Con `cuota` (QuotaSize en MB, QuotaFiles; ver _cuota_ftp) la escribe
+        en la misma sentencia."""
+        stored_password = await self._hash_password(password)
+        uid = int(os.getenv("FTP_UID", 2001))
+        gid = int(os.getenv("FTP_GID", 2001))
+        columnas, valores, actualizar = "", (), ""
+        if cuota is not None:
+            columnas, valores = ", QuotaSize, QuotaFiles", cuota
+            actualizar = ", QuotaSize=VALUES(QuotaSize), QuotaFiles=VALUES(QuotaFiles)"
+        query = (
+            f"INSERT INTO users (User, Password, Uid, Gid, Dir, Status{columnas}) "
+            f"VALUES ({', '.join(['%s'] * (6 + len(valores)))}) "
+            f"ON DUPLICATE KEY UPDATE Password=VALUES(Password){actualizar}"
+        )
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(query, (user, stored_password, uid, gid, homedir, '1', *valores))
+                except Exception as e:
+                    raise Exception(self._msg_error_insert(e))
+                return "creado" if cur.rowcount == 1 else "actualizado"
+
+    async def actualizar_cuotas(self, cuotas: Dict[str, Tuple[int, int]]) -> int:
+        """QuotaSize (MB) y QuotaFiles de N usuarios con un UPDATE ... CASE por
+        cada _MYSQL_LOTE usuarios (aiomysql sólo agrupa el executemany de
+        INSERT: con UPDATE era un round trip por usuario). Retorna cuántos
+        existían."""
+        items = list(cuotas.items())
+        total = 0
+        if not items:
+            return total
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                for i in range(0, len(items), _MYSQL_LOTE):
+                    lote = items[i:i + _MYSQL_LOTE]
+                    casos = " ".join(["WHEN %s THEN %s"] * len(lote))
+                    await cur.execute(
+                        f"UPDATE users SET QuotaSize = CASE User {casos} END, "
+                        f"QuotaFiles = CASE User {casos} END "
+                        f"WHERE User IN ({', '.join(['%s'] * len(lote))})",
+                        (*(v for user, (mb, _) in lote for v in (user, mb)),
+                         *(v for user, (_, archivos) in lote for v in (user, archivos)),
+                         *(user for user, _ in lote)))
+                    total += cur.rowcount
+        return total
+
+    def _msg_error_insert(self, e: Exception) -> str:
+        return (
+            f"Error al insertar usuario FTP en MySQL ({self._ctx_error()}). Detalle original: {e}. "
+            "Sugerencia: privilegios INSERT en ftpdb.users y que MYSQLCrypt coincide con FTP_PASSWORD_FORMAT."
+        )
+
+    async def _hash_password(self, password: str) -> str:
         """
-        Genera un hash Argon2 compatible con Pure-FTPd.
-        Se simplifica para usar exclusivamente Argon2id (moderno y seguro).
+        Genera un hash Argon2 compatible con Pure-FTPd (ver hashargon2.py:
+        parámetros TEMPOFTP_ARGON2_*, pool acotado por memoria).
         """
-        ph = PasswordHasher()
-        # Genera el hash con salt incluido automáticamente
-        return ph.hash(password)
+        return await self.hasher.hash(password)
 
 class GestorFTP(GestorFTPBase):
     def __init__(self) -> None:
@@ -149,6 +510,152 @@ class GestorFTP(GestorFTPBase):
             self.db = TMPFTPdb(db_path=':memory:')
         else:
             self.db = TMPFTPdb()
+        # Fachada async: los métodos async usan self.adb para no bloquear el loop.
+        self.adb = AsyncTMPFTPdb(self.db)
+        self.indice_descargas = IndiceDescargas(self.db)
+        # Pool MySQL del proceso: se conecta en iniciar() (o en el primer uso).
+        self.mysql = FTPDB_MySQL()
+        # Los árboles borrados se renombran a /data/.trash y se purgan en segundo plano.
+        self.papelera = Papelera("/data")
+        # Uso de cada home FTP, medido en segundo plano para GET /usage.
+        self.escaner_uso = EscanerUso("/data", guardar=self.adb.guardar_escaneo_uso)
+        # du remoto y rsync comparten un master SSH por host de origen.
+        self.ssh = MultiplexorSSH()
+        # Direcciones locales y resoluciones DNS cacheadas (¿enlace o rsync?).
+        self.localidad = LocalidadHosts()
+        # Admisión de rsync (ver _cupo_rsync): límites compartidos entre procesos.
+        self._rsync_max_global = int(os.getenv("TEMPOFTP_RSYNC_MAX_GLOBAL", "4"))
+        self._rsync_max_host = int(os.getenv("TEMPOFTP_RSYNC_MAX_POR_HOST", "2"))
+        self._rsync_max_host_map = self._parse_limites_host(os.getenv("TEMPOFTP_RSYNC_LIMITES_HOST", ""))
+        self._rsync_lease_s = float(os.getenv("TEMPOFTP_RSYNC_LEASE_S", "60"))
+        self._rsync_poll_s = float(os.getenv("TEMPOFTP_RSYNC_POLL_S", "5"))
+        # Sondeos de tamaño (du remoto): caché por (usuario, host, ruta) con TTL y
+        # un solo sondeo en vuelo por clave (ver _tamano_remoto).
+        self._du_ttl_s = float(os.getenv("TEMPOFTP_DU_CACHE_TTL_S", "300"))
+        self._du_cache: Dict[Tuple[str, str, str], Tuple[Dict[str, Optional[int]], float]] = {}
+        self._du_en_vuelo: Dict[Tuple[str, str, str], asyncio.Task] = {}
+        # Reuso de árboles ya copiados del mismo origen sin cambios (enlaces duros).
+        self._reuso_activo = os.getenv("TEMPOFTP_REUSO_CONTENIDO", "1").strip().lower() not in ("0", "false", "no")
+        # Directorios previos contra los que rsync enlaza lo que no cambió (0 = no usar --link-dest).
+        self._link_dest_max = min(int(os.getenv("TEMPOFTP_LINK_DEST_MAX", "5")), 20)
+        # Copia en paralelo de árboles grandes: N rsync sobre particiones del
+        # primer nivel de la ruta (1 = un solo rsync, como siempre).
+        self._rsync_particiones = int(os.getenv("TEMPOFTP_RSYNC_PARTICIONES", "1"))
+        self._rsync_particion_min_bytes = int(os.getenv("TEMPOFTP_RSYNC_PARTICION_MIN_BYTES", str(50 * 1024 ** 3)))
+
+    async def iniciar(self) -> None:
+        """Abre el pool MySQL del proceso. Si MySQL no responde, no impide
+        arrancar: el pool se vuelve a intentar en la primera operación."""
+        try:
+            await self.mysql.connect()
+        except Exception as e:
+            logger.error("No se pudo abrir el pool MySQL al iniciar: %s. Se reintentará al usarlo.", e)
+
+    async def iniciar_tareas_fondo(self) -> None:
+        """El purgador de la papelera, el escáner de uso y el indexador del log
+        de descargas. Sólo los arranca transfer_worker.py: en la API correrían
+        una vez por worker de uvicorn (ver P0-1 en main.py); los DELETE y
+        cleanup_expired.py sólo mueven a la papelera, y GET /usage y GET
+        /tmpftp/{id} leen lo ya guardado."""
+        await self.papelera.iniciar()
+        await self.escaner_uso.iniciar()
+        await self.indice_descargas.iniciar()
+
+    async def cerrar(self) -> None:
+        await self.indice_descargas.cerrar()
+        await self.escaner_uso.cerrar()
+        await self.papelera.cerrar()
+        await asyncio.to_thread(self.ssh.cerrar)
+        await self.mysql.close()
+        await asyncio.to_thread(self.mysql.hasher.close)
+        # Al final: lo anterior todavía puede escribir en SQLite al cerrarse.
+        await asyncio.to_thread(self.adb.close)
+
+    async def _mysql(self) -> FTPDB_MySQL:
+        """El FTPDB_MySQL compartido, conectado."""
+        if self.mysql.pool is None:
+            await self.mysql.connect()
+        return self.mysql
+
+    def metricas_mysql(self) -> Dict[str, Any]:
+        return self.mysql.metricas()
+
+    def metricas_argon2(self) -> Dict[str, Any]:
+        return self.mysql.hasher.metricas()
+
+    def metricas_papelera(self) -> Dict[str, Any]:
+        return self.papelera.metricas()
+
+    def metricas_dns(self) -> Dict[str, Any]:
+        return self.localidad.metricas()
+
+    @staticmethod
+    def _parse_limites_host(valor: str) -> Dict[str, int]:
+        """'hostA=1,hostB=3' -> {'hostA': 1, 'hostB': 3}. Entradas mal formadas se ignoran."""
+        limites = {}
+        for par in valor.split(","):
+            host, _, n = par.strip().partition("=")
+            try:
+                limites[host.strip().lower()] = int(n)
+            except ValueError:
+                continue
+        return limites
+
+    def _max_rsync_por_host(self, host: str) -> int:
+        return self._rsync_max_host_map.get(host.lower(), self._rsync_max_host)
+
+    @asynccontextmanager
+    async def _cupo_rsync(self, id: str, host: str, info: Dict[str, Any], intento: Optional[str] = None):
+        """
+        Espera cupo de rsync contra `host` (límite global y por host, comunes a
+        todos los procesos vía SQLite) y lo mantiene vivo mientras dura el
+        bloque. Mientras espera, la solicitud queda en 'en_cola' con su
+        posición, que GET /tmpftp/{id} devuelve. El cupo queda a nombre de
+        `intento` (ver procesar_trabajo): al salir sólo se libera si sigue
+        siendo suyo.
+        """
+        posicion_anterior = None
+        try:
+            while True:
+                # Como en el latido: un error pasajero (database is locked) no
+                # hace fallar la copia, se reintenta en la siguiente vuelta.
+                try:
+                    concedido, posicion = await self.adb.solicitar_cupo_rsync(
+                        id, host, self._rsync_lease_s, self._rsync_max_global, self._max_rsync_por_host, intento)
+                    if concedido:
+                        break
+                    if posicion != posicion_anterior:
+                        await self.adb.actualizar_estado(id, "en_cola", {**info,
+                            "posicion_cola": posicion,
+                            "mensaje": f"En cola para copiar desde {host} (posición {posicion})."})
+                        logger.info("Solicitud %s en cola para rsync desde %s (posición %d)", id, host, posicion)
+                        posicion_anterior = posicion
+                except Exception as e:
+                    logger.warning("Solicitud %s: no se pudo pedir cupo de rsync: %s", id, e)
+                await asyncio.sleep(self._rsync_poll_s)
+        except asyncio.CancelledError:
+            # Cancelada en la cola: el lugar se libera ya, no cuando venza el lease.
+            await asyncio.shield(self.adb.liberar_cupo_rsync(id, intento))
+            raise
+
+        async def _latido() -> None:
+            # Un error pasajero (database is locked) no debe terminar el latido:
+            # sin él el cupo vence a los lease_s y se admitiría otra copia.
+            while True:
+                await asyncio.sleep(self._rsync_lease_s / 3)
+                try:
+                    if not await self.adb.renovar_cupo_rsync(id, host, self._rsync_lease_s, intento):
+                        logger.error("Solicitud %s: su cupo de rsync desde %s había vencido (se repone como "
+                                     "activo) o lo tomó otro intento, con la copia en curso.", id, host)
+                except Exception as e:
+                    logger.warning("Solicitud %s: no se pudo renovar el cupo de rsync: %s", id, e)
+
+        latido = asyncio.create_task(_latido())
+        try:
+            yield
+        finally:
+            latido.cancel()
+            await asyncio.shield(self.adb.liberar_cupo_rsync(id, intento))
 
     def _validar_ruta_remota(self, ruta_remota: str) -> None:
         if not ruta_remota or ':' not in ruta_remota:
@@ -175,54 +682,23 @@ class GestorFTP(GestorFTPBase):
 
         return ssh_user, host_ssh, ruta
 
-    def _es_host_local(self, hostname: str) -> bool:
-        """Determina si 'hostname' debe considerarse local (criterio any-match)."""
-        if not hostname:
-                return True
-
-        if ":" in hostname and "/" in hostname:
-            # Solo split si parece patrón 'host:/path' (no afectará '127.0.0.1')
-            host_part = hostname.split(":", 1)[0]
-            hostname = host_part
-
-        h = str(hostname).strip().lower()
-
-        # Atajos obvios
-        if h in ("localhost", "127.0.0.1", "::1"):
-            return True
-
-        try:
-            # Resolver TODAS las IPv4 para el hostname
-            resolved_ipv4 = set()
-            for ai in socket.getaddrinfo(h, None, socket.AF_INET, socket.SOCK_STREAM):
-                try:
-                    ip = ai[4][0]
-                    if ip:
-                            resolved_ipv4.add(ip)
-                except Exception:
-                    continue
-
-                # CUALQUIER IP loopback -> local
-                if any(ip.startswith("127.") for ip in resolved_ipv4):
-                    return True
-
-                # Obtener IPv4 locales
-            try:
-                    local_ipv4 = set(socket.gethostbyname_ex(socket.gethostname())[2])
-            except Exception:
-                local_ipv4 = set()
-            # Siempre considerar loopback como local
-            local_ipv4.add("127.0.0.1")
-
-            # CUALQUIER coincidencia entre resueltas y locales -> local
-            if any(ip in local_ipv4 for ip in resolved_ipv4):
-                return True
-
-        except socket.gaierror:
-            logger.warning("No se pudo resolver el hostname '%s'. Asumiendo remoto.", hostname)
-        return False
+    async def _es_host_local(self, hostname: str) -> bool:
+        """Determina si 'hostname' debe considerarse local (criterio any-match),
+        sin bloquear el event loop (ver localidad.py)."""
+        return await self.localidad.es_local(hostname)
 
-    def obtener_tamano_remoto(self, ruta_remota: str, usuario_ssh: Optional[str] = None, host_ssh: Optional[str] = None) -> int:
+    async def _contar_remoto(self, ruta_remota: str, usuario_ssh: Optional[str] = None,
+                             host_ssh: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Bytes y entradas (archivos y directorios) bajo la ruta, y los bytes de
+        cada entrada de primer nivel ("primer_nivel", lo que usa _particionar),
+        en un solo recorrido en el host de origen (o aquí, si es local):
+        `find -printf '%s\t%P\0' | awk` suma en el origen y devuelve una línea
+        con los totales y un registro NUL por entrada de primer nivel. Antes
+        eran tres (`du -sb`, `du -s --inodes` y `du --max-depth=1` para
+        particionar). Los bytes son aparentes, como `du -sb`, salvo que un
+        archivo con varios enlaces duros cuenta una vez por enlace.
+        """
         ssh_user_env, host_detectado, ruta = self._parse_ruta_remota(ruta_remota)
         host_ssh = host_ssh or host_detectado
         ssh_user = usuario_ssh or ssh_user_env
@@ -230,69 +706,386 @@ class GestorFTP(GestorFTPBase):
             raise Exception("No se pudo determinar el host remoto para SSH")
         ssh_target = f"{ssh_user}@{host_ssh}"
 
-        es_local = self._es_host_local(host_ssh)
-
+        es_local = await self._es_host_local(host_ssh)
+
+        script = (f"find {shlex.quote(ruta)} -printf '%s\\t%P\\0' | awk '"
+                  'BEGIN {RS = "\\0"} '
+                  '{t = index($0, "\\t"); s = substr($0, 1, t - 1); p = substr($0, t + 1); b += s; n++; '
+                  'if (p != "") {i = index(p, "/"); if (i) p = substr(p, 1, i - 1); e[p] += s}} '
+                  'END {printf "%.0f %d\\n", b, n; for (p in e) printf "%.0f\\t%s%c", e[p], p, 0}'
+                  "'")
+        cmd = ["bash", "-o", "pipefail", "-c", script]
+        if not es_local:
+            cmd = self.ssh.ssh(ssh_target) + [shlex.join(cmd)]
+        returncode, stdout, stderr = await _ejecutar_comando(cmd, _timeout_env("TEMPOFTP_DU_TIMEOUT_S", "900"))
+        if returncode != 0:
+            msg = stderr.strip() or f"código de salida {returncode}"
+            logger.error("El sondeo de %s en %s falló: %s", ruta, ssh_target, msg)
+            raise Exception(f"El comando 'find' falló: {msg}")
+        totales, _, resto = stdout.partition("\n")
+        campos = totales.split()
+        if len(campos) < 2:
+            raise Exception("Salida vacía del sondeo find | awk")
+        primer_nivel = []
+        for registro in resto.split("\0"):
+            tamano, tab, nombre = registro.partition("\t")
+            if tab:
+                primer_nivel.append((nombre, int(tamano)))
+        conteo = {"bytes": int(campos[0]), "archivos": int(campos[1]), "primer_nivel": primer_nivel}
+        logger.info("Sondeo de %s en %s: %d bytes, %d entradas", ruta, ssh_target, conteo["bytes"], conteo["archivos"])
+        return conteo
+
+    async def obtener_tamano_remoto(self, ruta_remota: str, usuario_ssh: Optional[str] = None, host_ssh: Optional[str] = None) -> int:
+        return (await self._contar_origen(ruta_remota, usuario_ssh, host_ssh))["bytes"]
+
+    async def _contar_origen(self, ruta_remota: str, usuario_ssh: Optional[str] = None,
+                             host_ssh: Optional[str] = None) -> Dict[str, Any]:
         try:
-            # du -sb <ruta> | awk '{print $1}'
-            cmd = ["du", "-sb", ruta]
-            if not es_local:
-                cmd = ["ssh", ssh_target] + cmd
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            out = result.stdout.strip().splitlines()
-            if not out:
-                raise Exception("Salida vacía de du -sb")
-            first = out[0].split()[0]
-            size = int(first)
-            logger.info("Tamaño remoto para %s en %s: %s bytes", ruta, ssh_target, size)
-            return size
-        except subprocess.CalledProcessError as e:
-            msg = e.stderr.strip() if e.stderr else str(e)
-            logger.error("El comando '%s' falló para %s: %s", " ".join(cmd), ruta, msg)
-            raise Exception(f"El comando 'du' falló: {msg}")
+            return await self._contar_remoto(ruta_remota, usuario_ssh, host_ssh)
         except Exception as e:
-            logger.error("Error al obtener tamaño remoto para %s: %s", ruta, e)
+            logger.error("Error al obtener tamaño remoto para %s: %s", ruta_remota, e)
             raise Exception(f"Error al obtener tamaño remoto: {e}")
 
-    async def verificar_espacio_data(self, minimo_bytes: int = 1_000_000_000) -> bool:
-        usage = shutil.disk_usage('/data')
-        # Soportar tanto namedtuple con atributo 'free' como tupla simple (total, used, free)
-        free = getattr(usage, 'free', None)
-        if free is None:
+    async def _tamano_remoto(self, ruta_remota: str) -> int:
+        return (await self._sondeo_remoto(ruta_remota))["bytes"]
+
+    async def _sondeo_remoto(self, ruta_remota: str) -> Dict[str, Any]:
+        """
+        Tamaño ({"bytes"}), cantidad de entradas ({"archivos"}) y bytes por
+        entrada de primer nivel ({"primer_nivel"}) de la ruta de origen
+        (_contar_remoto, un solo recorrido), con caché y single-flight: varias solicitudes
+        sobre la misma ruta de origen en pocos minutos recorren el árbol
+        remoto una sola vez. El resultado vale TEMPOFTP_DU_CACHE_TTL_S
+        segundos (300; 0 desactiva la caché); mientras un sondeo está en
+        curso, los demás pedidos de la misma clave esperan ese mismo sondeo.
+        Los errores no se cachean. Cada sondeo registra su duración por host
+        (TMPFTPdb.registrar_sondeo).
+        """
+        ssh_user, host, ruta = self._parse_ruta_remota(ruta_remota)
+        clave = (ssh_user, host or "", ruta.rstrip("/") or "/")
+        cacheado = self._du_cache.get(clave)
+        if cacheado and cacheado[1] > time.monotonic():
+            logger.info("Tamaño de %s:%s desde caché: %s bytes", host, ruta, cacheado[0]["bytes"])
+            return cacheado[0]
+
+        tarea = self._du_en_vuelo.get(clave)
+        if tarea is None:
+            tarea = asyncio.create_task(self._sondear_tamano(clave, ruta_remota))
+            self._du_en_vuelo[clave] = tarea
+            tarea.add_done_callback(lambda _t: self._du_en_vuelo.pop(clave, None))
+        # shield: si se cancela un pedido, el sondeo sigue para los demás.
+        return await asyncio.shield(tarea)
+
+    async def _sondear_tamano(self, clave: Tuple[str, str, str], ruta_remota: str) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        tamano = None
+        try:
+            sondeo = await self._contar_origen(ruta_remota)
+            tamano = sondeo["bytes"]
+            if self._du_ttl_s > 0:
+                self._du_cache[clave] = (sondeo, time.monotonic() + self._du_ttl_s)
+            return sondeo
+        finally:
+            duracion = time.perf_counter() - t0
+            logger.info("Sondeo de %s:%s: %.2fs", clave[1], clave[2], duracion)
             try:
-                free = usage[2]
-            except Exception:
-                free = 0
-        ok = free >= minimo_bytes
-        await asyncio.to_thread(logger.info, "Espacio libre en /data: %s bytes (mínimo requerido %s): %s", free, minimo_bytes, ok)
+                await self.adb.registrar_sondeo(clave[1], clave[2], tamano, duracion, tamano is not None)
+            except Exception as e:
+                logger.warning("No se pudo registrar la duración del sondeo: %s", e)
+
+    async def resumen_sondeos(self) -> list:
+        return await self.adb.resumen_sondeos()
+
+    async def reservar_espacio_data(self, id: str, bytes_: int, intento: Optional[str] = None) -> bool:
+        """
+        Reserva en el libro de reservas (tabla reservas_espacio, compartida
+        entre workers) los bytes que va a escribir la copia de `id`. Se concede
+        si caben en el espacio libre de /data menos lo que aún deben escribir
+        las demás copias en curso y un margen de TEMPOFTP_ESPACIO_MARGEN_PCT
+        por ciento del volumen. Comparar sólo con el espacio libre dejaba pasar
+        varias copias grandes a la vez que después llenaban el disco.
+        """
+        usage = shutil.disk_usage('/data')
+        margen = int(usage.total * float(os.getenv("TEMPOFTP_ESPACIO_MARGEN_PCT", "2")) / 100)
+        ok, otras = await self.adb.reservar_espacio(id, bytes_, usage.free, margen, intento)
+        await asyncio.to_thread(
+            logger.info, "Espacio en /data: libre=%s reservado por otras copias=%s margen=%s requerido=%s: %s",
+            usage.free, otras, margen, bytes_, ok)
         return ok
 
-    def _ejecutar_rsync(self, ruta_origen: str, ruta_destino: str) -> None:
+    async def _ejecutar_rsync(self, ruta_origen: str, ruta_destino: str, on_progreso=None,
+                              reanudar: bool = False, link_dest: Tuple[str, ...] = (),
+                              files_from: Optional[str] = None) -> None:
+        """
+        Ejecuta rsync leyendo su salida a medida que llega. Sin -v sólo emite las
+        líneas de --info=progress2 (separadas por '\r'), que se parsean y se
+        pasan a `on_progreso`; de lo demás se guardan las últimas líneas, para
+        el mensaje de error. La memoria queda acotada sin importar cuántos
+        archivos tenga el árbol (antes -av + capture_output acumulaba el
+        listado completo hasta que rsync terminaba).
+
+        Corre como subproceso asyncio en su propio grupo de procesos: no ocupa
+        un hilo del executor durante las horas que puede durar la copia, y si
+        la tarea se cancela o se supera TEMPOFTP_RSYNC_TIMEOUT_S (sin límite
+        por defecto) se termina rsync junto con su ssh. --timeout corta una
+        copia sin E/S durante TEMPOFTP_RSYNC_IO_TIMEOUT_S (600).
+
+        --partial conserva el archivo a medio copiar si la copia se corta; con
+        `reanudar` (el destino ya tiene datos de un intento anterior) se agrega
+        --append-verify, que completa esos archivos en lugar de traerlos de
+        nuevo y verifica el checksum del archivo completo.
+
+        Cada directorio de `link_dest` va como --link-dest: un archivo que está
+        igual ahí se enlaza (enlace duro) en vez de traerse por la red, y uno
+        distinto se usa como base para la transferencia delta.
+        """
+        comando_rsync = ["rsync", "-a", "--partial", "--info=progress2,name0"]
+        if reanudar:
+            comando_rsync.append("--append-verify")
+        comando_rsync += [f"--link-dest={d}" for d in link_dest]
+        if files_from:
+            # Sólo las entradas listadas (separadas por NUL) de ruta_origen;
+            # --files-from anula el -r implícito de -a.
+            comando_rsync += ["-r", f"--files-from={files_from}", "--from0"]
+        io_timeout = _timeout_env("TEMPOFTP_RSYNC_IO_TIMEOUT_S", "600")
+        if io_timeout:
+            comando_rsync.append(f"--timeout={int(io_timeout)}")
+        hostinfo, sep, _ = ruta_origen.partition(":")
+        if sep and "/" not in hostinfo:
+            # Origen remoto (usuario@host:ruta): transporte por el master SSH del host.
+            comando_rsync += self.ssh.rsync_rsh(hostinfo)
+        comando_rsync += [ruta_origen, ruta_destino]
+        ultimas = deque(maxlen=20)
         try:
-            comando_rsync = ["rsync", "-av", "--info=progress2", ruta_origen, ruta_destino]
-            subprocess.run(
-                comando_rsync,
-                check=True,
-                capture_output=True,
-                text=True,
-                encoding='utf-8'
-            )
-        except subprocess.CalledProcessError as e:
-            logger.error("rsync falló: %s", e.stderr)
-            raise Exception(f"Error durante la copia de datos (rsync): {e.stderr}")
+            proc = await asyncio.create_subprocess_exec(
+                *comando_rsync, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True)
         except FileNotFoundError:
             logger.error("El comando rsync no se encuentra en el sistema.")
             raise Exception("Error: El comando 'rsync' no se encuentra en el sistema.")
 
-    def _preparar_directorio(self, usuario: str, id: str, ruta_remota: Optional[str] = None, crear_dir_solicitud: bool = True) -> str:
+        async def _leer() -> int:
+            pendiente = b""
+            while True:
+                bloque = await proc.stdout.read(65536)
+                if not bloque:
+                    break
+                pendiente += bloque
+                *lineas, pendiente = re.split(rb"[\r\n]", pendiente)
+                # Una "línea" sin separador que crece sin límite no es salida de rsync.
+                pendiente = pendiente[-4096:]
+                for cruda in lineas:
+                    linea = cruda.decode("utf-8", errors="replace")
+                    if not linea.strip():
+                        continue
+                    snap = _parse_progreso_rsync(linea)
+                    if snap is None:
+                        ultimas.append(linea)
+                    elif on_progreso is not None:
+                        on_progreso(snap)
+            if pendiente.strip():
+                ultimas.append(pendiente.decode("utf-8", errors="replace"))
+            return await proc.wait()
+
+        try:
+            returncode = await _esperar_proceso(proc, _leer(), _timeout_env("TEMPOFTP_RSYNC_TIMEOUT_S", "0"), comando_rsync)
+        except TimeoutError as e:
+            logger.error("rsync %s -> %s: %s", ruta_origen, ruta_destino, e)
+            raise Exception(f"Error durante la copia de datos (rsync): {e}")
+        if returncode != 0:
+            detalle = "\n".join(ultimas)
+            logger.error("rsync falló (código %s): %s", returncode, detalle)
+            raise Exception(f"Error durante la copia de datos (rsync): {detalle}")
+
+    async def _rsync_con_progreso(self, id: str, info: Dict[str, Any], ruta_origen: str, ruta_destino: str,
+                                  reanudar: bool = False, link_dest: Tuple[str, ...] = (),
+                                  particiones: Optional[List[List[str]]] = None,
+                                  total_bytes: Optional[int] = None) -> None:
+        """
+        Corre _ejecutar_rsync y persiste en la solicitud ('traslado')
+        la última instantánea de progreso como info['progreso'], como mucho una
+        vez cada TEMPOFTP_PROGRESO_INTERVALO_S segundos, para que GET
+        /tmpftp/{id} la devuelva sin escribir en SQLite por cada línea de rsync.
+
+        Con `particiones` (listas de entradas de primer nivel de ruta_origen,
+        ver _particionar) corre un rsync por partición a la vez hacia el
+        mismo destino, y el progreso es la suma de todos contra total_bytes. Si
+        una partición falla, las demás se cancelan (se termina su grupo de
+        procesos) y el error se propaga.
+        """
+        intervalo = float(os.getenv("TEMPOFTP_PROGRESO_INTERVALO_S", "5"))
+        ultimo: Dict[int, Dict[str, Any]] = {}
+
+        def _on_progreso_de(i: int):
+            def _on_progreso(snap: Dict[str, Any]) -> None:
+                # Se llama por cada línea de progreso; sólo reemplaza la referencia.
+                ultimo[i] = snap
+            return _on_progreso
+
+        def _instantanea() -> Optional[Dict[str, Any]]:
+            if particiones:
+                return _combinar_progreso(dict(ultimo), total_bytes)
+            return ultimo.get(0)
+
+        async def _persistir() -> None:
+            escrito = None
+            while True:
+                await asyncio.sleep(intervalo)
+                snap = _instantanea()
+                if snap is not None and snap != escrito:
+                    # Condicional: si la escritura llega tarde (la copia ya
+                    # terminó y la solicitud pasó a 'listo'), no la pisa.
+                    await self.adb.actualizar_info_si_estado(id, "traslado", {**info, "progreso": {
+                        **snap, "actualizado": datetime.now(timezone.utc).isoformat()}})
+                    # Lo ya escrito deja de contar como reservado (ver reservar_espacio_data).
+                    await self.adb.ajustar_reserva(id, snap["bytes"])
+                    escrito = snap
+
+        async def _particion(i: int, nombres: List[str]) -> None:
+            fd, lista = tempfile.mkstemp(prefix="tempoftp-particion-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(b"".join(n.encode("utf-8", "surrogateescape") + b"\0" for n in nombres))
+                await self._ejecutar_rsync(ruta_origen, ruta_destino, _on_progreso_de(i), reanudar,
+                                           link_dest, files_from=lista)
+            except Exception as e:
+                raise Exception(f"Partición {i + 1}/{len(particiones)}: {e}") from e
+            finally:
+                os.unlink(lista)
+
+        persistidor = asyncio.create_task(_persistir())
+        try:
+            if not particiones:
+                await self._ejecutar_rsync(ruta_origen, ruta_destino, _on_progreso_de(0), reanudar, link_dest)
+                return
+            tareas = [asyncio.create_task(_particion(i, nombres)) for i, nombres in enumerate(particiones)]
+            try:
+                await asyncio.gather(*tareas)
+            except BaseException:
+                for tarea in tareas:
+                    tarea.cancel()
+                await asyncio.gather(*tareas, return_exceptions=True)
+                raise
+        finally:
+            persistidor.cancel()
+
+    async def _candidatos_link_dest(self, id: str, usuario: str, host: str, ruta: str, base_dir: str) -> List[str]:
+        """
+        Directorios de contenido contra los que conviene comparar en rsync
+        (--link-dest), en orden de preferencia y hasta TEMPOFTP_LINK_DEST_MAX
+        (rsync admite 20): los árboles vigentes del mismo origen aunque haya
+        cambiado (contenido_preparado), y las últimas solicitudes vigentes del
+        mismo usuario (p. ej. días sucesivos del mismo producto). Sólo los del
+        mismo sistema de archivos que el destino.
+        """
+        if self._link_dest_max <= 0:
+            return []
+        home = os.path.dirname(base_dir.rstrip("/"))
+        rutas = list(await self.adb.contenido_por_origen(host, ruta, self._link_dest_max))
+        for otro_id, otra_ruta in await self.adb.solicitudes_recientes(usuario, self._link_dest_max + 1):
+            if otro_id == id or ":" not in (otra_ruta or ""):
+                continue
+            _, _, otra_ruta_norm = self._parse_ruta_remota(otra_ruta)
+            subdir = _subdir_contenido(otra_ruta_norm, otro_id)
+            rutas.append(os.path.join(home, otro_id, subdir) if subdir else os.path.join(home, otro_id))
+        rutas = [r for r in rutas if not r.startswith(base_dir.rstrip("/") + "/") and r != base_dir]
+        return (await asyncio.to_thread(_filtrar_link_dest, rutas, base_dir))[:self._link_dest_max]
+
+    async def _huella_remota(self, ruta_remota: str) -> Optional[str]:
+        """
+        Huella barata del árbol de origen: sha256 del listado ordenado de
+        rutas, tipos, tamaños y mtimes (`find -printf | sort | sha256sum` en el
+        host de origen, por el master SSH; no lee el contenido de los
+        archivos). None si no se pudo calcular: la copia sigue sin reuso.
+        """
+        ssh_user, host, ruta = self._parse_ruta_remota(ruta_remota)
+        script = (f"cd {shlex.quote(ruta)} && "
+                  "find . -printf '%P\\t%y\\t%s\\t%T@\\n' | LC_ALL=C sort | sha256sum")
+        cmd = self.ssh.ssh(f"{ssh_user}@{host}") + [shlex.join(["bash", "-o", "pipefail", "-c", script])]
+        try:
+            returncode, stdout, stderr = await _ejecutar_comando(cmd, _timeout_env("TEMPOFTP_HUELLA_TIMEOUT_S", "600"))
+        except Exception as e:
+            logger.warning("No se pudo calcular la huella de %s: %s", ruta_remota, e)
+            return None
+        huella = stdout.split()[0] if stdout.split() else ""
+        if returncode != 0 or len(huella) != 64:
+            logger.warning("No se pudo calcular la huella de %s: %s", ruta_remota,
+                           stderr.strip() or f"código de salida {returncode}")
+            return None
+        return huella
+
+    async def _reusar_preparado(self, id: str, info: Dict[str, Any], host: str, ruta: str, huella: str,
+                                contenido_dir: str) -> bool:
+        """
+        Si otra solicitud vigente ya tiene en /data el mismo origen con la
+        misma huella, arma `contenido_dir` con enlaces duros a ese árbol
+        (`cp -al`, sin red ni espacio adicional) y deja info['reuso'].
+        Devuelve False si no hay candidato o el enlace falló (se copia con
+        rsync como siempre). Los borrados van a la papelera por rename y la
+        purga sólo quita enlaces, así que expirar una de las dos solicitudes
+        no afecta a la otra.
+        """
+        candidatos = await self.adb.buscar_contenido(host, ruta, huella)
+        try:
+            dispositivo = os.stat(os.path.dirname(contenido_dir.rstrip("/"))).st_dev
+        except OSError:
+            dispositivo = None
+        for candidato in candidatos:
+            origen = candidato["destino"]
+            try:
+                valido = os.path.isdir(origen) and not os.path.islink(origen) and os.stat(origen).st_dev == dispositivo
+            except OSError:
+                valido = False
+            if not valido:
+                await self.adb.olvidar_contenido(origen)
+                continue
+            await self.adb.actualizar_estado(id, "traslado", {
+                **info, "mensaje": f"Enlazando datos ya preparados de la solicitud {candidato['solicitud_id']}."})
+            try:
+                os.makedirs(contenido_dir, exist_ok=True)
+                returncode, _, stderr = await _ejecutar_comando(
+                    ["cp", "-al", f"{origen.rstrip('/')}/.", contenido_dir],
+                    _timeout_env("TEMPOFTP_ENLACE_TIMEOUT_S", "3600"))
+                if returncode != 0:
+                    raise Exception(stderr.strip() or f"código de salida {returncode}")
+            except Exception as e:
+                logger.warning("Solicitud %s: no se pudo enlazar %s (%s); se copia con rsync.", id, origen, e)
+                await self.adb.sumar_contadores({"reuso_consultas": 1, "reuso_fallidos": 1})
+                return False
+            bytes_ = candidato["bytes"] or 0
+            info["reuso"] = {"solicitud": candidato["solicitud_id"], "bytes_ahorrados": bytes_}
+            await self.adb.sumar_contadores({"reuso_consultas": 1, "reuso_aciertos": 1,
+                                             "reuso_bytes_ahorrados": bytes_})
+            logger.info("Solicitud %s armada con enlaces a %s (%d bytes sin copiar)", id, origen, bytes_)
+            return True
+        await self.adb.sumar_contadores({"reuso_consultas": 1})
+        return False
+
+    async def metricas_reuso(self) -> Dict[str, Any]:
+        """Reuso de contenido ya preparado (todas las copias, todos los procesos)."""
+        c = await self.adb.contadores("reuso_")
+        consultas, aciertos = c.get("reuso_consultas", 0), c.get("reuso_aciertos", 0)
+        return {
+            "consultas": consultas,
+            "aciertos": aciertos,
+            "fallidos": c.get("reuso_fallidos", 0),
+            "tasa_aciertos": round(aciertos / consultas, 3) if consultas else 0.0,
+            "bytes_ahorrados": c.get("reuso_bytes_ahorrados", 0),
+        }
+
+    async def _preparar_directorio(self, usuario: str, id: str, ruta_remota: Optional[str] = None, crear_dir_solicitud: bool = True) -> str:
         homedir = f"/data/{usuario}"
         owner_user = os.getenv("DATA_OWNER_USER") or os.getenv("RSYNC_SSH_USER") or "lanotadm"
         owner_group = os.getenv("DATA_OWNER_GROUP") or owner_user
         skip_chown = os.getenv("SKIP_CHOWN", "0") in ("1", "true", "True")
 
-        def _safe_chown(path: str) -> None:
+        async def _safe_chown(path: str) -> None:
             try:
                 if not skip_chown:
-                    subprocess.run(["chown", f"{owner_user}:{owner_group}", path], check=True)
+                    cmd = ["chown", f"{owner_user}:{owner_group}", path]
+                    returncode, _, stderr = await _ejecutar_comando(cmd, _timeout_env("TEMPOFTP_CHOWN_TIMEOUT_S", "60"))
+                    if returncode != 0:
+                        raise Exception(stderr.strip() or f"código de salida {returncode}")
             except Exception as e:
                 logger.warning("chown falló para %s: %s. Continuando.", path, e)
             try:
@@ -302,12 +1095,12 @@ class GestorFTP(GestorFTPBase):
 
         if not os.path.exists(homedir):
             os.makedirs(homedir, exist_ok=True)
-            _safe_chown(homedir)
+            await _safe_chown(homedir)
 
         if crear_dir_solicitud:
             solicitud_dir = os.path.join(homedir, id)
             os.makedirs(solicitud_dir, exist_ok=True)
-            _safe_chown(solicitud_dir)
+            await _safe_chown(solicitud_dir)
             return solicitud_dir
         return homedir
 
@@ -324,9 +1117,11 @@ class GestorFTP(GestorFTPBase):
         logger.info("Enlace simbólico creado: %s -> %s", ruta_enlace_destino, ruta_origen_local)
 
     def _borrar_directorio_seguro(self, path: str) -> bool:
-        """Elimina un directorio asegurando que esté dentro de /data."""
+        """Elimina un directorio asegurando que esté dentro de /data. El
+        directorio se mueve a la papelera (rename atómico) y se purga en
+        segundo plano, así que vuelve sin esperar a que se borren los archivos."""
         real_path = os.path.abspath(path)
-        if not real_path.startswith("/data/"):
+        if not real_path.startswith("/data/") or self.papelera.contiene(real_path):
             logger.error("Intento de borrar ruta insegura: %s", real_path)
             raise Exception("Operación de borrado rechazada por seguridad (ruta fuera de /data)")
         
@@ -335,8 +1130,8 @@ class GestorFTP(GestorFTPBase):
                 if os.path.islink(real_path):
                     os.unlink(real_path)
                 else:
-                    shutil.rmtree(real_path)
-                logger.info("Directorio eliminado: %s", real_path)
+                    self.papelera.mover(real_path)
+                logger.info("Directorio eliminado (a la papelera): %s", real_path)
                 return True
             except Exception as e:
                 logger.error("Error borrando %s: %s", real_path, e)
@@ -344,85 +1139,88 @@ class GestorFTP(GestorFTPBase):
         return False
 
     async def delete_request(self, id: str) -> Dict[str, str]:
-        """Elimina una solicitud específica y su carpeta de datos."""
-        solicitud = self.db.obtener_solicitud(id)
+        """Elimina una solicitud específica y su carpeta de datos. Si su copia
+        no ha terminado, la cancela (ver cancelar_solicitud)."""
+        solicitud = await self.adb.obtener_solicitud(id)
         if not solicitud:
             return {"status": "not_found", "mensaje": "Solicitud no encontrada"}
         
         info = solicitud.get("info", {})
         usuario = info.get("usuario")
+
+        cancelada = await self.cancelar_solicitud(id, solicitud)
+        if cancelada is not None:
+            return cancelada
         
         if usuario:
             ruta_destino = f"/data/{usuario}/{id}"
             await asyncio.to_thread(self._borrar_directorio_seguro, ruta_destino)
         
-        self.db.eliminar_solicitud(id)
+        await self.adb.eliminar_solicitud(id)
+        if usuario:
+            await self._actualizar_cuotas([usuario])
         return {"status": "deleted", "id": id}
 
+    async def _actualizar_cuotas(self, usuarios) -> None:
+        """Reescribe en MySQL la cuota de `usuarios` según su uso registrado
+        (uso_usuarios), después de borrar solicitudes suyas. Los que no tienen
+        solicitudes registradas (p. ej. sólo anteriores al registro de uso)
+        conservan su cuota. Un fallo de MySQL sólo se loguea: el borrado ya
+        ocurrió y la cuota se corrige en la próxima solicitud del usuario."""
+        usos = {u: uso for u, uso in (await self.adb.usos_usuarios(usuarios)).items() if uso["solicitudes"]}
+        if not usos:
+            return
+        try:
+            db_mysql = await self._mysql()
+            await db_mysql.actualizar_cuotas({u: _cuota_ftp(uso) for u, uso in usos.items()})
+        except Exception as e:
+            logger.warning("No se pudo actualizar la cuota FTP de %s: %s", ", ".join(usos), e)
+
+    async def cancelar_solicitud(self, id: str, solicitud: Dict[str, Any]) -> Optional[Dict[str, str]]:
+        """
+        Deja en 'cancelado' una solicitud cuya copia no terminó. La API y el
+        worker de transferencias son procesos distintos, así que la orden pasa
+        por SQLite: si el trabajo está en curso, transfer_worker.py lo detecta
+        en su siguiente sondeo (TEMPOFTP_JOB_CANCEL_POLL_S), cancela la tarea
+        (lo que termina el grupo de procesos de rsync) y llama a
+        limpiar_cancelada. Si aún no se reclamó, nadie escribe en el destino y
+        se limpia aquí mismo. Devuelve None si ya no estaba en curso.
+        """
+        info = solicitud.get("info", {})
+        cancelada = await self.adb.cancelar_solicitud(id, {
+            **{k: v for k, v in info.items() if k not in ("progreso", "posicion_cola")},
+            "mensaje": "Solicitud cancelada; la copia se detuvo y los datos parciales se eliminan.",
+        })
+        if cancelada is None:
+            return None
+        logger.info("Solicitud %s cancelada en '%s' (trabajo: %s)", id, cancelada["estado"], cancelada["trabajo"])
+        if cancelada["trabajo"] != "en_curso":
+            await self.limpiar_cancelada(id)
+        return {"status": "cancelado", "id": id}
+
+    async def limpiar_cancelada(self, id: str) -> None:
+        """Borra el destino parcial de una solicitud cancelada."""
+        solicitud = await self.adb.obtener_solicitud(id)
+        if not solicitud or solicitud["estado"] != "cancelado":
+            return
+        usuario = solicitud["info"].get("usuario")
+        if usuario:
+            await asyncio.to_thread(self._borrar_directorio_seguro, f"/data/{usuario}/{id}")
+
     async def obtener_estadisticas_descargas(self, usuario_ftp: str, consulta_id: str = None) -> Dict[str, Any]:
         """
-        Lee el log de transferencias para obtener un resumen de descargas del usuario.
+        Resumen de descargas del usuario a partir del log de transferencias.
         Filtra por el subdirectorio específico de la consulta (consulta_id) para evitar
         contar descargas de consultas anteriores del mismo usuario FTP.
-        Retorna cantidad de archivos y fecha de la última descarga.
+        Retorna cantidad de sesiones (IP, día) y fecha de la última descarga.
+        El log no se lee aquí: IndiceDescargas lo procesa incrementalmente en
+        transfer_worker.py y la consulta es una lectura por clave en SQLite.
         """
-        log_path = "/var/log/pure-ftpd/transfer.log"
-        stats = {"total_descargas": 0, "ultima_descarga": None}
-        
-        if not usuario_ftp or not os.path.exists(log_path):
-            return stats
-
-        # El path en el log es /data/<usuario_ftp>/<consulta_id>/archivo
-        # Filtrar por subdirectorio específico de esta consulta evita contar
-        # descargas de consultas anteriores del mismo usuario FTP.
-        path_filter = f"/{consulta_id}/" if consulta_id else None
-
-        def _leer_log():
-            # Sesión = combinación única de (IP, día).
-            # Múltiples archivos descargados desde la misma IP el mismo día = 1 sesión.
-            # Formato CLF: IP - USER [dd/Mon/yyyy:HH:mm:ss tz] "GET /path" 200 SIZE
-            sesiones = set()
-            last_date = None
-            try:
-                # errors='replace' para evitar fallos con caracteres extraños en nombres de archivo
-                with open(log_path, "r", encoding="utf-8", errors="replace") as f:
-                    for line in f:
-                        # Filtro rápido: si la línea no tiene el usuario, saltar
-                        if usuario_ftp not in line:
-                            continue
-
-                        # Si se especificó subdirectorio de consulta, filtrar por él
-                        if path_filter and path_filter not in line:
-                            continue
-
-                        # Verificar que sea una descarga (GET) y exitosa (200)
-                        # Formato CLF típico: IP - USER [DATE] "GET /path" 200 SIZE
-                        if '"GET ' not in line or ' 200 ' not in line:
-                            continue
-
-                        # Extraer IP (primer campo) y fecha completa entre corchetes
-                        parts = line.split()
-                        ip = parts[0] if parts else None
-
-                        start = line.find('[')
-                        end = line.find(']')
-                        if start == -1 or end == -1:
-                            continue
-                        timestamp = line[start+1:end]  # dd/Mon/yyyy:HH:mm:ss tz
-                        # Extraer solo la parte del día: dd/Mon/yyyy
-                        dia = timestamp.split(':')[0] if timestamp else None
-
-                        if ip and dia:
-                            sesiones.add((ip, dia))
-                            last_date = timestamp  # última línea que pasa los filtros
-            except PermissionError:
-                logger.warning("No se puede leer %s. Verifique permisos (chmod 644).", log_path)
-            return len(sesiones), last_date
-
-        count, last_date = await asyncio.to_thread(_leer_log)
-        return {"total_descargas": count, "ultima_descarga": last_date}
-
-    async def eliminar_expiradas(self) -> int:
+        if not usuario_ftp:
+            return {"total_descargas": 0, "ultima_descarga": None}
+        return await asyncio.to_thread(self.indice_descargas.estadisticas, usuario_ftp, consulta_id)
+
+    async def eliminar_expiradas(self, tiempos: Optional[Dict[str, float]] = None) -> int:
         """
         Procesa todas las solicitudes en estado 'listo' cuya vigencia venció:
         - Borra el subdirectorio de la solicitud en /data/{usuario}/{id}
@@ -430,79 +1228,112 @@ class GestorFTP(GestorFTPBase):
         - Si el usuario FTP ya no tiene solicitudes activas: lo elimina de MySQL
           y borra el home vacío de /data/{usuario}
         Retorna el número de solicitudes procesadas.
+
+        Los borrados corren de a TEMPOFTP_CLEANUP_PARALELO a la vez y, a medida
+        que terminan, las solicitudes se marcan en SQLite en lotes de
+        TEMPOFTP_CLEANUP_LOTE (una transacción por lote). Los usuarios MySQL se
+        eliminan con una sola sentencia. Si se pasa `tiempos`, se llena con la
+        duración en segundos de cada fase (listar, directorios, sqlite, mysql,
+        homes, total).
         """
+        t_inicio = time.perf_counter()
+        tiempos = tiempos if tiempos is not None else {}
+        for fase in ("listar", "directorios", "sqlite", "mysql", "homes", "total"):
+            tiempos[fase] = 0.0
+
         now_utc = datetime.now(timezone.utc)
-        expiradas = self.db.obtener_expiradas(now_utc)
+        expiradas = await self.adb.obtener_expiradas(now_utc)
+        tiempos["listar"] = time.perf_counter() - t_inicio
         if not expiradas:
+            tiempos["total"] = tiempos["listar"]
             return 0
 
-        usernames_procesados: set = set()
-        count = 0
+        paralelo = asyncio.Semaphore(max(1, int(os.getenv("TEMPOFTP_CLEANUP_PARALELO", "4"))))
+        lote = max(1, int(os.getenv("TEMPOFTP_CLEANUP_LOTE", "100")))
+        pendientes: list = []
 
-        for solicitud in expiradas:
+        async def marcar(ids: list) -> None:
+            t0 = time.perf_counter()
+            await self.adb.marcar_expiradas(ids)
+            tiempos["sqlite"] += time.perf_counter() - t0
+            logger.info("Lote de %d solicitudes marcadas como expiradas", len(ids))
+
+        async def procesar(solicitud: Dict[str, Any]) -> None:
             id_ = solicitud['id']
             usuario = solicitud['info'].get('usuario')
-
             # 1. Borrar subdirectorio de la solicitud
             if usuario:
                 ruta_solicitud = f"/data/{usuario}/{id_}"
-                try:
-                    await asyncio.to_thread(self._borrar_directorio_seguro, ruta_solicitud)
-                except Exception as e:
-                    logger.warning("No se pudo borrar %s: %s", ruta_solicitud, e)
-
-            # 2. Marcar como expirada en SQLite
-            self.db.marcar_expirada(id_)
-            count += 1
-            logger.info("Solicitud %s marcada como expirada (usuario=%s)", id_, usuario)
-
-            if usuario:
-                usernames_procesados.add(usuario)
-
-        # 3. Para cada username sin solicitudes activas: eliminar de MySQL + home vacío
-        db_mysql = FTPDB_MySQL()
-        await db_mysql.connect()
+                async with paralelo:
+                    try:
+                        await asyncio.to_thread(self._borrar_directorio_seguro, ruta_solicitud)
+                    except Exception as e:
+                        logger.warning("No se pudo borrar %s: %s", ruta_solicitud, e)
+            # 2. Marcar como expirada en SQLite, por lotes
+            pendientes.append(id_)
+            if len(pendientes) >= lote:
+                ids = pendientes[:]
+                pendientes.clear()
+                await marcar(ids)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(procesar(s) for s in expiradas))
+        if pendientes:
+            await marcar(pendientes[:])
+        tiempos["directorios"] = time.perf_counter() - t0 - tiempos["sqlite"]
+
+        # 3. Usernames sin solicitudes activas: eliminar de MySQL (una sentencia) + home vacío.
+        usernames_procesados = {s['info'].get('usuario') for s in expiradas} - {None, ""}
+        con_activas = await self.adb.usuarios_con_activas(usernames_procesados)
+        for usuario in usernames_procesados & con_activas:
+            logger.info("Usuario '%s' conserva solicitudes activas, no se elimina de MySQL", usuario)
+        if con_activas:
+            await self._actualizar_cuotas(sorted(con_activas))
+        sin_activas = sorted(usernames_procesados - con_activas)
+        if sin_activas:
+            t0 = time.perf_counter()
+            db_mysql = await self._mysql()
+            eliminados = await db_mysql.eliminar_usuarios_ftp(sin_activas)
+            tiempos["mysql"] = time.perf_counter() - t0
+            logger.info("%d de %d usuarios FTP eliminados de MySQL: %s",
+                        eliminados, len(sin_activas), ", ".join(sin_activas))
+
+            t0 = time.perf_counter()
+
+            async def borrar_home(usuario: str) -> None:
+                async with paralelo:
+                    await asyncio.to_thread(self._borrar_home_si_vacio, f"/data/{usuario}")
+            await asyncio.gather(*(borrar_home(u) for u in sin_activas))
+            tiempos["homes"] = time.perf_counter() - t0
+
+        tiempos["total"] = time.perf_counter() - t_inicio
+        return len(expiradas)
+
+    def _borrar_home_si_vacio(self, ruta_home: str) -> None:
         try:
-            for usuario in usernames_procesados:
-                activas = self.db.obtener_activas_por_usuario(usuario)
-                if activas:
-                    logger.info("Usuario '%s' conserva %d solicitudes activas, no se elimina de MySQL", usuario, len(activas))
-                    continue
-                eliminado = await db_mysql.eliminar_usuario_ftp(usuario)
-                if eliminado:
-                    logger.info("Usuario FTP '%s' eliminado de MySQL", usuario)
-                ruta_home = f"/data/{usuario}"
-                try:
-                    if os.path.exists(ruta_home) and not os.listdir(ruta_home):
-                        await asyncio.to_thread(self._borrar_directorio_seguro, ruta_home)
-                        logger.info("Home vacío eliminado: %s", ruta_home)
-                except Exception as e:
-                    logger.warning("No se pudo eliminar home vacío %s: %s", ruta_home, e)
-        finally:
-            await db_mysql.close()
-
-        return count
+            if os.path.exists(ruta_home) and not os.listdir(ruta_home):
+                self._borrar_directorio_seguro(ruta_home)
+                logger.info("Home vacío eliminado: %s", ruta_home)
+        except Exception as e:
+            logger.warning("No se pudo eliminar home vacío %s: %s", ruta_home, e)
 
     async def delete_ftp_user(self, usuario: str) -> Dict[str, str]:
         """Elimina un usuario FTP (MySQL) y todo su directorio home."""
-        db_mysql = FTPDB_MySQL()
-        await db_mysql.connect()
-        try:
-            user_deleted = await db_mysql.eliminar_usuario_ftp(usuario)
-            ruta_home = f"/data/{usuario}"
-            dir_deleted = await asyncio.to_thread(self._borrar_directorio_seguro, ruta_home)
-            
-            if not user_deleted and not dir_deleted:
-                return {"status": "not_found", "mensaje": "Usuario o directorio no encontrados"}
-            
-            return {"status": "deleted", "usuario": usuario}
-        finally:
-            await db_mysql.close()
+        db_mysql = await self._mysql()
+        user_deleted = await db_mysql.eliminar_usuario_ftp(usuario)
+        ruta_home = f"/data/{usuario}"
+        dir_deleted = await asyncio.to_thread(self._borrar_directorio_seguro, ruta_home)
+        await self.adb.olvidar_uso_usuario(usuario)
+
+        if not user_deleted and not dir_deleted:
+            return {"status": "not_found", "mensaje": "Usuario o directorio no encontrados"}
+
+        return {"status": "deleted", "usuario": usuario}
 
     async def bloquear_solicitud(self, id: str, razon: str = None, descargas: int = None) -> Dict[str, Any]:
         """Bloquea el usuario FTP asociado a la solicitud sin eliminarlo.
         Pone Status=0 en MySQL y registra el bloqueo en SQLite."""
-        solicitud = self.db.obtener_solicitud(id)
+        solicitud = await self.adb.obtener_solicitud(id)
         if not solicitud:
             return {"status": "not_found", "mensaje": "Solicitud no encontrada"}
 
@@ -511,12 +1342,8 @@ class GestorFTP(GestorFTPBase):
         if not usuario:
             return {"status": "error", "mensaje": "La solicitud no tiene usuario FTP asociado"}
 
-        db_mysql = FTPDB_MySQL()
-        await db_mysql.connect()
-        try:
-            encontrado = await db_mysql.bloquear_usuario(usuario)
-        finally:
-            await db_mysql.close()
+        db_mysql = await self._mysql()
+        encontrado = await db_mysql.bloquear_usuario(usuario)
 
         info_actualizada = {**info,
             "bloqueado": True,
@@ -526,7 +1353,7 @@ class GestorFTP(GestorFTPBase):
         if descargas is not None:
             info_actualizada["descargas_al_bloquear"] = descargas
 
-        self.db.actualizar_estado(id, "bloqueado", info_actualizada)
+        await self.adb.actualizar_estado(id, "bloqueado", info_actualizada)
         logger.info("Solicitud %s bloqueada (usuario=%s, razon=%s)", id, usuario, razon)
 
         return {
@@ -540,7 +1367,7 @@ class GestorFTP(GestorFTPBase):
     async def desbloquear_solicitud(self, id: str) -> Dict[str, Any]:
         """Reactiva el usuario FTP asociado a la solicitud.
         Pone Status=1 en MySQL y restaura el estado 'listo' en SQLite."""
-        solicitud = self.db.obtener_solicitud(id)
+        solicitud = await self.adb.obtener_solicitud(id)
         if not solicitud:
             return {"status": "not_found", "mensaje": "Solicitud no encontrada"}
 
@@ -552,17 +1379,13 @@ class GestorFTP(GestorFTPBase):
         if not usuario:
             return {"status": "error", "mensaje": "La solicitud no tiene usuario FTP asociado"}
 
-        db_mysql = FTPDB_MySQL()
-        await db_mysql.connect()
-        try:
-            encontrado = await db_mysql.desbloquear_usuario(usuario)
-        finally:
-            await db_mysql.close()
+        db_mysql = await self._mysql()
+        encontrado = await db_mysql.desbloquear_usuario(usuario)
 
         info_actualizada = {k: v for k, v in info.items()
                             if k not in ("bloqueado", "razon_bloqueo", "timestamp_bloqueo", "descargas_al_bloquear")}
 
-        self.db.actualizar_estado(id, "listo", info_actualizada)
+        await self.adb.actualizar_estado(id, "listo", info_actualizada)
         logger.info("Solicitud %s desbloqueada (usuario=%s)", id, usuario)
 
         return {
@@ -573,102 +1396,193 @@ class GestorFTP(GestorFTPBase):
         }
 
     async def create_usertmp(self, id: str, email: str, ruta: str, vigencia: int) -> Dict[str, object]:
+        """
+        Valida y registra la solicitud, y encola su trabajo de copia en la misma
+        transacción SQLite. No copia nada: de eso se encarga transfer_worker.py
+        (procesar_trabajo), que sobrevive a reinicios de la API y limita cuántas
+        copias corren a la vez sin importar cuántos workers de uvicorn haya.
+        """
         # Validaciones iniciales
-        self._verificar_solicitud_duplicada(id)
+        await self._verificar_solicitud_duplicada(id)
         self._validar_ruta_remota(ruta)
         username = self.generate_username(email)
 
-        # Obtener/crear password (sin exponer el claro en la respuesta final)
-        db_mysql = FTPDB_MySQL()
-        await db_mysql.connect()
-        
-        hash_existente = await db_mysql.obtener_password_hash(username)
-        ya_existe = hash_existente is not None
-
-        reuse_password = os.getenv("TEMPOFTP_REUSE_PASSWORD", "false").strip().lower() in ("1", "true", "yes")
-        password_cifrada_existente = self.db.obtener_password_cifrada_por_email(email) if (ya_existe and reuse_password) else None
+        info_inicial = {
+            "usuario": username,
+            "vigencia": vigencia,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        await self.adb.crear_solicitud(
+            id, email, ruta, "recibido", {**info_inicial, "mensaje": "Solicitud en cola."},
+            trabajo={"email": email, "ruta": ruta, "vigencia": vigencia},
+        )
+        return {
+            "usuario": username,
+            "mensaje": "Solicitud en proceso. Recibirá notificación cuando esté lista.",
+            "vigencia": vigencia
+        }
 
-        if password_cifrada_existente and reuse_password and ya_existe:
-            password_claro = None  # no se renueva
-            password_cifrada = password_cifrada_existente
-        else:
-            password_claro = self.generate_password()
-            password_cifrada = cifrar(password_claro)
+    async def procesar_trabajo(self, trabajo: Dict[str, Any]) -> None:
+        """
+        Ejecuta un trabajo de copia reclamado de la cola (ver transfer_worker.py):
+        prepara /data, copia (rsync o enlace local), crea/actualiza el usuario
+        FTP en MySQL y deja la solicitud en 'listo'. Un fallo de la copia deja
+        la solicitud en 'error' y no se propaga: el trabajo terminó, aunque mal.
+        Sólo una cancelación (apagado del worker) sale como excepción.
+        Re-ejecutarlo tras una caída es seguro: rsync retoma lo ya copiado y
+        lo que ya había en /data queda en info['reanudacion'].
+        """
+        id = trabajo["solicitud_id"]
+        payload = trabajo["payload"]
+        email, ruta, vigencia = payload["email"], payload["ruta"], payload["vigencia"]
+        solicitud = await self.adb.obtener_solicitud(id)
+        if not solicitud or solicitud["estado"] == "cancelado":
+            logger.warning("Trabajo %s sin solicitud %s en curso (¿eliminada o cancelada?). Se descarta.", trabajo["id"], id)
+            return
+        if solicitud["estado"] in ("listo", "expirado", "error"):
+            # El worker murió entre marcarla y cerrar el trabajo: no se vuelve
+            # a copiar, y sobre todo no se genera otra contraseña FTP que deje
+            # sin acceso al usuario que ya recibió la anterior.
+            logger.warning("Trabajo %s: la solicitud %s ya está en '%s'. Se descarta.",
+                           trabajo["id"], id, solicitud["estado"])
+            return
+        username = solicitud["info"].get("usuario") or self.generate_username(email)
+        # Cupo de rsync y reserva de espacio quedan a nombre de este intento: si
+        # el trabajo se reclama de nuevo (lease vencido) mientras éste se
+        # detiene, su limpieza no borra los del intento nuevo.
+        intento = f"{trabajo['id']}:{trabajo.get('intentos', 0)}"
+        # posicion_cola sólo vale en 'en_cola' (un reinicio en plena espera la deja en info).
+        info_inicial = {k: v for k, v in solicitud["info"].items() if k not in ("mensaje", "posicion_cola")}
 
         try:
-            info_inicial = {
-                "usuario": username,
-                "password": password_cifrada,
-                "vigencia": vigencia,
-                "created_at": datetime.now(timezone.utc).isoformat(),
-            }
-            self.db.crear_solicitud(id, email, ruta, "recibido", {**info_inicial, 
-                "mensaje": "Solicitud en cola."})
-
-            async def proceso_copia() -> None:
-                try:
-                    self.db.actualizar_estado(id, "preparando", {**info_inicial, "mensaje": "Creando entorno y verificando espacio."})
-                    logger.info("Preparando entorno para %s (usuario=%s)", id, username)
-                    tamano_remoto = await asyncio.to_thread(self.obtener_tamano_remoto, ruta)
-                    if not await self.verificar_espacio_data(tamano_remoto):
-                        logger.error("Espacio insuficiente: requerido=%s bytes", tamano_remoto)
-                        raise Exception(f"Espacio insuficiente en /data: se requieren {tamano_remoto} bytes")
-                    
-                    ssh_user_env, host_detectado, ruta_norm = self._parse_ruta_remota(ruta)
-                    es_local = self._es_host_local(host_detectado)
-
-                    if es_local:
-                        logger.info("El host %s es local. Se creará un enlace simbólico en lugar de rsync.", host_detectado)
-                        homedir = f"/data/{username}"
-                        await asyncio.to_thread(self._preparar_directorio, username, id, ruta, False)
-                        await asyncio.to_thread(self._crear_enlace_local, ruta_norm, os.path.join(homedir, id))
-                    else:
-                        base_dir = await asyncio.to_thread(self._preparar_directorio, username, id, ruta)
-                        self.db.actualizar_estado(id, "traslado", {**info_inicial, "mensaje": f"Copiando datos desde {ruta} a {base_dir}."})
-                        logger.info("Iniciando rsync %s -> %s", ruta, base_dir)
-                        logger.info("El host %s es remoto. Se usará rsync.", host_detectado)
-                        origen = f"{ssh_user_env}@{host_detectado}:{ruta_norm}"
-                        last_segment = os.path.basename(ruta_norm.rstrip("/"))
-                        rsync_origen = f"{origen.rstrip('/')}" + "/" if last_segment == id else origen
-                        rsync_destino = base_dir
-                        await asyncio.to_thread(self._ejecutar_rsync, rsync_origen, rsync_destino)
-
-                    if password_claro:
-                        if ya_existe:
-                            logger.info("Actualizando password para usuario FTP '%s' en MySQL.", username)
-                            await db_mysql.actualizar_password_ftp(username, password_claro)
-                        else:
-                            logger.info("Creando usuario FTP '%s' en MySQL.", username)
-                            await db_mysql.crear_usuario_ftp(username, password_claro, f"/data/{username}")
-                    elif ya_existe:
-                        logger.info("Reutilizando password existente para usuario FTP '%s' (TEMPOFTP_REUSE_PASSWORD=true).", username)
-
-                    info_final = {
-                        # Conservar created_at (y vigencia) de info_inicial: son
-                        # obligatorios para que eliminar_expiradas() pueda limpiar
-                        # esta solicitud al vencer. Si no se propagan aquí, el
-                        # registro 'listo' pierde created_at y nunca expira.
-                        **info_inicial,
-                        "password": password_cifrada,
-                        "mensaje": f"Listo, tiene {vigencia} días para hacer la descarga.",
+            db_mysql = await self._mysql()
+            hash_existente = await db_mysql.obtener_password_hash(username)
+            ya_existe = hash_existente is not None
+
+            reuse_password = os.getenv("TEMPOFTP_REUSE_PASSWORD", "false").strip().lower() in ("1", "true", "yes")
+            password_cifrada_existente = await self.adb.obtener_password_cifrada_por_email(email) if (ya_existe and reuse_password) else None
+
+            if password_cifrada_existente and reuse_password and ya_existe:
+                password_claro = None  # no se renueva
+                password_cifrada = password_cifrada_existente
+            else:
+                password_claro = self.generate_password()
+                password_cifrada = cifrar(password_claro)
+
+            await self.adb.actualizar_estado(id, "preparando", {**info_inicial, "mensaje": "Creando entorno y verificando espacio."})
+            logger.info("Preparando entorno para %s (usuario=%s)", id, username)
+            sondeo = await self._sondeo_remoto(ruta)
+            tamano_remoto = sondeo["bytes"]
+            info_inicial["sondeo"] = {"bytes": sondeo["bytes"], "archivos": sondeo["archivos"]}
+            ssh_user_env, host_detectado, ruta_norm = self._parse_ruta_remota(ruta)
+            es_local = await self._es_host_local(host_detectado)
+            # Un origen local se enlaza: no ocupa espacio en /data.
+            if not await self.reservar_espacio_data(id, 0 if es_local else tamano_remoto, intento):
+                logger.error("Espacio insuficiente: requerido=%s bytes", tamano_remoto)
+                raise Exception(f"Espacio insuficiente en /data: se requieren {tamano_remoto} bytes "
+                                "más lo reservado por las copias en curso")
+
+            if es_local:
+                logger.info("El host %s es local. Se creará un enlace simbólico en lugar de rsync.", host_detectado)
+                homedir = f"/data/{username}"
+                await self._preparar_directorio(username, id, ruta, False)
+                await asyncio.to_thread(self._crear_enlace_local, ruta_norm, os.path.join(homedir, id))
+                # El enlace no ocupa /data y Pure-FTPd no lo sigue al contar
+                # la cuota: el home no suma nada.
+                uso_home = {"bytes": 0, "archivos": 0, "compartidos": 0}
+            else:
+                base_dir = await self._preparar_directorio(username, id, ruta)
+                # Datos de un intento anterior (reinicio del worker a media
+                # copia): se reanuda sobre ellos y se informa cuánto había.
+                # No es lo ahorrado: rsync vuelve a traer lo que haya cambiado
+                # en el origen o quedado a medias.
+                previos = await asyncio.to_thread(_bytes_en_arbol, base_dir)
+                if previos:
+                    anterior = info_inicial.get("reanudacion") or {}
+                    info_inicial["reanudacion"] = {
+                        "bytes_previos": previos,
+                        "reanudaciones": anterior.get("reanudaciones", 0) + 1,
                     }
-                    self.db.actualizar_estado(id, "listo", info_final)
-                    logger.info("Solicitud %s lista para usuario %s", id, username)
-                except Exception as e:
-                    logger.error("Fallo en proceso_copia (%s): %s", id, e)
-                    self.db.actualizar_estado(id, "error", {**info_inicial, "mensaje": str(e)})
-                finally:
-                    await db_mysql.close()
-
-            # Ejecutar en background para producción (y tests harán polling)
-            asyncio.create_task(proceso_copia())
-            return {
-                "usuario": username,
+                    logger.info("Solicitud %s: se reanuda la copia sobre %d bytes ya presentes en %s",
+                                id, previos, base_dir)
+                    await self.adb.ajustar_reserva(id, previos)
+                origen = f"{ssh_user_env}@{host_detectado}:{ruta_norm}"
+                last_segment = os.path.basename(ruta_norm.rstrip("/"))
+                rsync_origen = f"{origen.rstrip('/')}" + "/" if last_segment == id else origen
+                rsync_destino = base_dir
+                subdir = _subdir_contenido(ruta_norm, id)
+                contenido_dir = os.path.join(base_dir, subdir) if subdir else base_dir
+                # Las particiones salen del mismo sondeo: no hace falta otro
+                # recorrido del origen.
+                particiones = None
+                if self._rsync_particiones > 1 and tamano_remoto >= self._rsync_particion_min_bytes:
+                    particiones = _particionar(sondeo["primer_nivel"], self._rsync_particiones)
+                # La huella también recorre el origen por ssh: corre dentro del
+                # cupo, bajo los mismos límites por host que la copia. Si hay
+                # reuso, el cupo se suelta tras el cp -al.
+                candidatos: List[str] = []
+                async with self._cupo_rsync(id, host_detectado, info_inicial, intento):
+                    # Con el cupo concedido la solicitud ya no está en cola,
+                    # aunque la huella y el cp -al tarden antes del rsync.
+                    await self.adb.actualizar_estado(id, "preparando", {
+                        **info_inicial, "mensaje": f"Verificando el contenido de {ruta} antes de copiar."})
+                    huella = await self._huella_remota(ruta) if self._reuso_activo and not previos else None
+                    reusado = bool(huella) and await self._reusar_preparado(id, info_inicial, host_detectado,
+                                                                            ruta_norm, huella, contenido_dir)
+                    if not reusado:
+                        candidatos = await self._candidatos_link_dest(id, username, host_detectado, ruta_norm, base_dir)
+                        if particiones:
+                            # Cada partición lista entradas de primer nivel de la
+                            # ruta: se copian desde 'ruta/' al directorio de contenido.
+                            rsync_origen, rsync_destino, subdir = f"{origen.rstrip('/')}/", contenido_dir, None
+                            os.makedirs(contenido_dir, exist_ok=True)
+                        await self.adb.actualizar_estado(id, "traslado", {**info_inicial, "mensaje": f"Copiando datos desde {ruta} a {base_dir}."})
+                        logger.info("Iniciando rsync %s -> %s (%d candidatos --link-dest, %d particiones)",
+                                    ruta, base_dir, len(candidatos), len(particiones or [None]))
+                        logger.info("El host %s es remoto. Se usará rsync.", host_detectado)
+                        with _alinear_link_dest(candidatos, subdir) as link_dest:
+                            await self._rsync_con_progreso(id, {**info_inicial, "mensaje": f"Copiando datos desde {ruta} a {base_dir}."},
+                                                           rsync_origen, rsync_destino, reanudar=bool(previos),
+                                                           link_dest=tuple(link_dest), particiones=particiones,
+                                                           total_bytes=tamano_remoto)
+                if huella:
+                    await self.adb.registrar_contenido(host_detectado, ruta_norm, huella, contenido_dir,
+                                                       tamano_remoto, id)
+                # Lo publicado cuenta entero en el home (y en la cuota de
+                # Pure-FTPd), pero lo enlazado desde otros árboles no ocupa
+                # disco de nuevo: se registra aparte.
+                compartidos = (await asyncio.to_thread(_bytes_en_arbol, contenido_dir, True)
+                               if reusado or candidatos else 0)
+                uso_home = {"bytes": tamano_remoto, "archivos": sondeo["archivos"], "compartidos": compartidos}
+
+            # Uso del usuario con esta solicitud incluida: es su nueva cuota.
+            uso = await self.adb.registrar_uso(id, username, uso_home["bytes"], uso_home["archivos"],
+                                               uso_home["compartidos"])
+            cuota = _cuota_ftp(uso)
+            if password_claro:
+                resultado = await db_mysql.guardar_usuario_ftp(username, password_claro, f"/data/{username}", cuota)
+                logger.info("Usuario FTP '%s' %s en MySQL (cuota %d MB, %d archivos).", username, resultado, *cuota)
+            elif ya_existe:
+                await db_mysql.actualizar_cuotas({username: cuota})
+                logger.info("Reutilizando password existente para usuario FTP '%s' (TEMPOFTP_REUSE_PASSWORD=true).", username)
+
+            info_final = {
+                # Conservar created_at (y vigencia) de info_inicial: son
+                # obligatorios para que eliminar_expiradas() pueda limpiar
+                # esta solicitud al vencer. Si no se propagan aquí, el
+                # registro 'listo' pierde created_at y nunca expira.
+                **info_inicial,
                 "password": password_cifrada,
-                "mensaje": "Solicitud en proceso. Recibirá notificación cuando esté lista.",
-                "vigencia": vigencia
+                "mensaje": f"Listo, tiene {vigencia} días para hacer la descarga.",
             }
-        except Exception:
-            # Si falla antes de lanzar la tarea, cerrar la conexión
-            await db_mysql.close()
-            raise
+            if await self.adb.actualizar_estado(id, "listo", info_final):
+                logger.info("Solicitud %s lista para usuario %s", id, username)
+            else:
+                logger.info("Solicitud %s cancelada mientras terminaba; no se marca lista.", id)
+                await self.adb.descontar_uso([id])
+        except Exception as e:
+            logger.error("Fallo en proceso_copia (%s): %s", id, e)
+            await self.adb.actualizar_estado(id, "error", {**info_inicial, "mensaje": str(e)})
+        finally:
+            # Lo copiado ya figura como ocupado en /data: la reserva sobra.
+            await self.adb.liberar_reserva(id, intento)
@@ -2,6 +2,8 @@ import os
 import string
 import secrets
 import random
+import time
+from datetime import datetime, timezone
 
 
 def select_gestor():
@@ -63,42 +65,91 @@ class GestorFTPBase:
         alphabet = string.ascii_letters + string.digits
         return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-    def _verificar_solicitud_duplicada(self, id: str):
+    async def _verificar_solicitud_duplicada(self, id: str):
         """Verifica si ya existe una solicitud y lanza una excepción si es así."""
-        # Este método asume que `self.db` está disponible en la clase hija.
-        solicitud_existente = self.db.obtener_solicitud(id)
+        # Este método asume que `self.adb` (AsyncTMPFTPdb) está disponible en la clase hija.
+        solicitud_existente = await self.adb.obtener_solicitud(id)
         if solicitud_existente:
             mensaje = f"Ya existe una solicitud en proceso con el ID '{id}'. Estado actual: {solicitud_existente['estado']}"
             raise Exception(mensaje)
 
+    async def iniciar(self) -> None:
+        """Recursos de vida del proceso (p. ej. el pool MySQL del gestor real).
+        Se llama una vez al arrancar: lifespan de FastAPI o inicio de los scripts."""
+
+    async def iniciar_tareas_fondo(self) -> None:
+        """Tareas de mantenimiento en segundo plano. Sólo las arranca el worker
+        de transferencias, que es uno solo (ver P0-1 en main.py)."""
+
+    async def cerrar(self) -> None:
+        """Libera lo abierto en iniciar() e iniciar_tareas_fondo()."""
+
     def _reiniciar_db_para_test(self):
         """Método específico para pruebas para garantizar un estado limpio."""
         # Asume que la clase hija tiene un constructor que puede ser llamado de nuevo.
+        if getattr(self, "adb", None) is not None:
+            self.adb.close()
         self.__init__()
 
-    async def list_solicitudes(self, estado: str = None, limite: int = 500):
+    async def list_solicitudes(self, estado: str = None, limite: int = 500, sin_vencimiento: bool = False):
         """Lista solicitudes para inventario y reconciliación. Se define aquí, como
         get_status, para que el gestor real y el simulado se comporten igual."""
-        return self.db.listar_solicitudes(estado=estado, limite=limite)
+        return await self.adb.listar_solicitudes(estado=estado, limite=limite, sin_vencimiento=sin_vencimiento)
+
+    async def espacio_reservado(self) -> dict:
+        """Bytes de /data reservados y aún no escritos por las copias en curso
+        (ver TMPFTPdb.reservar_espacio), para /health."""
+        return await self.adb.espacio_reservado()
+
+    async def uso_disco(self, limite: int = 500) -> dict:
+        """Última foto del escáner de uso (usodisco.py): homes de mayor a menor
+        tamaño y su antigüedad. Antes de la primera pasada no hay foto."""
+        foto = await self.adb.escaneo_uso(limite)
+        escaneo = foto["escaneo"]
+        if escaneo is None:
+            return {"actualizado": None, "antiguedad_s": None, "homes": []}
+        return {
+            "actualizado": datetime.fromtimestamp(escaneo["ts"], timezone.utc).isoformat(),
+            "antiguedad_s": round(time.time() - escaneo["ts"], 1),
+            "duracion_s": round(escaneo["duracion_s"], 2),
+            "directorios_leidos": escaneo["leidos"],
+            "directorios_sin_cambios": escaneo["reusados"],
+            "bytes_total": foto["bytes_total"],
+            "homes": foto["homes"],
+        }
 
     async def get_status(self, id: str):
         """Obtiene el estado de una solicitud desde la base de datos."""
-        solicitud = self.db.obtener_solicitud(id)
+        solicitud = await self.adb.obtener_solicitud(id)
         if solicitud:
             estado = solicitud["estado"]
             info = solicitud["info"]
             # Si el estado es 'listo' extrae ftpuser y password
             if estado == "listo":
-                return {
+                respuesta = {
                     "status": "listo",
                     "ftpuser": info.get("usuario"),
                     "password": info.get("password"),
                     "vigencia": info.get("vigencia"),
                     "mensaje": info.get("mensaje", "")
                 }
+                # Copia reanudada tras un reinicio: bytes que ya había en /data al
+                # reanudar (no lo ahorrado: rsync vuelve a traer lo que cambió).
+                if info.get("reanudacion"):
+                    respuesta["reanudacion"] = info["reanudacion"]
+                return respuesta
             else:
-                return {
+                respuesta = {
                     "status": estado,
                     "mensaje": info.get("mensaje", "")
                 }
+                # 'en_cola': esperando cupo de rsync (límite global/por host).
+                if estado == "en_cola" and info.get("posicion_cola") is not None:
+                    respuesta["posicion"] = info["posicion_cola"]
+                # 'traslado': última instantánea de progreso de rsync, si la hay.
+                if estado == "traslado" and info.get("progreso"):
+                    respuesta["progreso"] = info["progreso"]
+                if estado == "traslado" and info.get("reanudacion"):
+                    respuesta["reanudacion"] = info["reanudacion"]
+                return respuesta
         return None
\ No newline at end of file
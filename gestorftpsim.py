@@ -6,7 +6,7 @@ from datetime import datetime, timezone
 from typing import Dict, Any, Optional
 from cifrado import cifrar
 from gestorftpbase import GestorFTPBase
-from tmpftpdb import TMPFTPdb
+from tmpftpdb import TMPFTPdb, AsyncTMPFTPdb
 
 logger = logging.getLogger(__name__)
 
@@ -18,10 +18,11 @@ class GestorFTPsim(GestorFTPBase):
             self.db = TMPFTPdb(db_path=':memory:')
         else:
             self.db = TMPFTPdb(db_path='tempoftp_simulacro.db')
+        self.adb = AsyncTMPFTPdb(self.db)
 
     async def create_usertmp(self, id, email, ruta, vigencia):
         # Verificar si la solicitud ya existe (lógica en la clase base)
-        self._verificar_solicitud_duplicada(id)
+        await self._verificar_solicitud_duplicada(id)
         # Validación estricta de ruta remota (como en el real)
         if not ruta or ':' not in ruta:
             raise Exception("Ruta remota inválida, use 'host:/ruta' o 'usuario@host:/ruta'")
@@ -50,9 +51,9 @@ class GestorFTPsim(GestorFTPBase):
             # gestor real, se fija al crear la solicitud y se propaga a 'listo'.
             "created_at": datetime.now(timezone.utc).isoformat(),
         }
-        self.db.crear_solicitud(id, email, ruta, "recibido", {**info, "mensaje": "Solicitud en cola."})
+        await self.adb.crear_solicitud(id, email, ruta, "recibido", {**info, "mensaje": "Solicitud en cola."})
         # Simulación de proceso
-        self.db.actualizar_estado(id, "preparando", info)
+        await self.adb.actualizar_estado(id, "preparando", info)
         logger.info("SIMULACRO: Verificando espacio para copiar desde %s", ruta)
         # Determinismo configurable por variables de entorno:
         # - TEMPOFTP_SIM_FORCE: 'ok'/'fail' para forzar resultado
@@ -75,9 +76,9 @@ class GestorFTPsim(GestorFTPBase):
             info["espacio_libre_sim"] = free_size
         if not espacio_suficiente:
             error_msg = "Espacio insuficiente"
-            self.db.actualizar_estado(id, "error", {**info, "mensaje": error_msg})
+            await self.adb.actualizar_estado(id, "error", {**info, "mensaje": error_msg})
             raise Exception(error_msg)
-        self.db.actualizar_estado(id, "traslado", {**info, "mensaje": f"Copiando datos desde {ruta} a {destino}."})
+        await self.adb.actualizar_estado(id, "traslado", {**info, "mensaje": f"Copiando datos desde {ruta} a {destino}."})
         logger.info("SIMULACRO: Ejecutando rsync -av %s %s", ruta, destino)
         time.sleep(2)
         logger.info("SIMULACRO: Copia finalizada.")        
@@ -86,16 +87,16 @@ class GestorFTPsim(GestorFTPBase):
         info_final["password"] = password_cifrada # Enviamos la contraseña cifrada, como en el gestor real
         info_final["mensaje"] = f"Listo, tiene {vigencia} días para hacer la descarga."
         del info_final["password_cifrada"] # No es necesario enviarla al cliente
-        self.db.actualizar_estado(id, "listo", info_final)
+        await self.adb.actualizar_estado(id, "listo", info_final)
         logger.info("SIMULACRO: Programando cron para eliminar al usuario %s y la carpeta en %s días.", username, vigencia)
         # Simulación de cron
         return
 
     async def delete_request(self, id: str):
-        solicitud = self.db.obtener_solicitud(id)
+        solicitud = await self.adb.obtener_solicitud(id)
         if not solicitud:
             return {"status": "not_found"}
-        self.db.eliminar_solicitud(id)
+        await self.adb.eliminar_solicitud(id)
         logger.info("SIMULACRO: Eliminada solicitud %s y datos simulados.", id)
         return {"status": "deleted", "id": id}
 
@@ -109,7 +110,7 @@ class GestorFTPsim(GestorFTPBase):
 
     async def bloquear_solicitud(self, id: str, razon: str = None, descargas: int = None) -> Dict[str, Any]:
         """Simulacro: bloquea la solicitud en SQLite sin tocar MySQL."""
-        solicitud = self.db.obtener_solicitud(id)
+        solicitud = await self.adb.obtener_solicitud(id)
         if not solicitud:
             return {"status": "not_found", "mensaje": "Solicitud no encontrada"}
         info = solicitud.get("info", {})
@@ -123,13 +124,13 @@ class GestorFTPsim(GestorFTPBase):
         }
         if descargas is not None:
             info_actualizada["descargas_al_bloquear"] = descargas
-        self.db.actualizar_estado(id, "bloqueado", info_actualizada)
+        await self.adb.actualizar_estado(id, "bloqueado", info_actualizada)
         logger.info("SIMULACRO: Solicitud %s bloqueada (usuario=%s, razon=%s)", id, usuario, razon)
         return {"status": "bloqueado", "id": id, "usuario": usuario, "razon": razon or "no especificada", "en_mysql": False}
 
     async def desbloquear_solicitud(self, id: str) -> Dict[str, Any]:
         """Simulacro: reactiva la solicitud en SQLite sin tocar MySQL."""
-        solicitud = self.db.obtener_solicitud(id)
+        solicitud = await self.adb.obtener_solicitud(id)
         if not solicitud:
             return {"status": "not_found", "mensaje": "Solicitud no encontrada"}
         if solicitud.get("estado") != "bloqueado":
@@ -140,6 +141,6 @@ class GestorFTPsim(GestorFTPBase):
             return {"status": "error", "mensaje": "La solicitud no tiene usuario FTP asociado"}
         info_actualizada = {k: v for k, v in info.items()
                             if k not in ("bloqueado", "razon_bloqueo", "timestamp_bloqueo", "descargas_al_bloquear")}
-        self.db.actualizar_estado(id, "listo", info_actualizada)
+        await self.adb.actualizar_estado(id, "listo", info_actualizada)
         logger.info("SIMULACRO: Solicitud %s desbloqueada (usuario=%s)", id, usuario)
         return {"status": "listo", "id": id, "usuario": usuario, "en_mysql": False}
\ No newline at end of file
@@ -0,0 +1,145 @@
+"""
+Servicio de hash Argon2 para las contraseñas de los usuarios FTP.
+
+Antes FTPDB_MySQL._hash_password creaba un PasswordHasher() por defecto
+(64 MiB por hash) y lo ejecutaba en el event loop: una ráfaga de altas
+congelaba el proceso mientras duraban los hashes y sumaba 64 MiB por cada uno
+en curso. Ahora los hashes corren en un pool de hilos acotado (argon2-cffi
+libera el GIL durante el cálculo) cuyo tamaño sale de un presupuesto de
+memoria: con memory_cost=64 MiB y presupuesto de 256 MiB hay como mucho 4
+hashes simultáneos, y el resto espera en cola sin reservar memoria.
+
+El presupuesto es por proceso. Las altas y cambios de contraseña los hace el
+worker de transferencias (un solo proceso), así que en la práctica es el
+presupuesto de toda la instalación.
+
+Parámetros (se validan contra lo que acepta Pure-FTPd, que verifica con
+crypto_pwhash_str_verify de libsodium):
+    TEMPOFTP_ARGON2_TYPE            id | i  (argon2d no lo acepta libsodium) (id)
+    TEMPOFTP_ARGON2_TIME_COST       iteraciones; >= 1 (argon2id) o >= 3 (argon2i) (3)
+    TEMPOFTP_ARGON2_MEMORY_COST     KiB por hash; >= 8 * parallelism (65536)
+    TEMPOFTP_ARGON2_PARALLELISM     carriles, 1..16 (4)
+    TEMPOFTP_ARGON2_HASH_LEN        bytes del hash, 16..64 (32)
+    TEMPOFTP_ARGON2_SALT_LEN        bytes de salt, 16..64 (16)
+    TEMPOFTP_ARGON2_MEMORIA_MAX_MIB presupuesto de memoria de hashes en curso (256)
+    TEMPOFTP_ARGON2_HILOS           tope de hilos, además del presupuesto (núcleos)
+
+Los valores por defecto son los de PasswordHasher(), así que los hashes
+nuevos son idénticos en formato a los ya guardados en MySQL.
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from argon2 import PasswordHasher, Type
+
+_TIPOS = {"id": Type.ID, "i": Type.I}
+
+
+def _env_int(nombre: str, defecto: int) -> int:
+    valor = os.getenv(nombre, str(defecto))
+    try:
+        return int(valor)
+    except ValueError:
+        raise ValueError(f"{nombre}={valor!r} no es un entero")
+
+
+class HashArgon2:
+    """Pool acotado de hashes Argon2 con presupuesto de memoria."""
+
+    def __init__(self, tipo: Optional[str] = None, time_cost: Optional[int] = None,
+                 memory_cost: Optional[int] = None, parallelism: Optional[int] = None,
+                 hash_len: Optional[int] = None, salt_len: Optional[int] = None,
+                 memoria_max_mib: Optional[int] = None, max_hilos: Optional[int] = None) -> None:
+        self.tipo = (tipo or os.getenv("TEMPOFTP_ARGON2_TYPE", "id")).lower()
+        self.time_cost = time_cost if time_cost is not None else _env_int("TEMPOFTP_ARGON2_TIME_COST", 3)
+        self.memory_cost = memory_cost if memory_cost is not None else _env_int("TEMPOFTP_ARGON2_MEMORY_COST", 65536)
+        self.parallelism = parallelism if parallelism is not None else _env_int("TEMPOFTP_ARGON2_PARALLELISM", 4)
+        self.hash_len = hash_len if hash_len is not None else _env_int("TEMPOFTP_ARGON2_HASH_LEN", 32)
+        self.salt_len = salt_len if salt_len is not None else _env_int("TEMPOFTP_ARGON2_SALT_LEN", 16)
+        self.memoria_max_mib = (memoria_max_mib if memoria_max_mib is not None
+                                else _env_int("TEMPOFTP_ARGON2_MEMORIA_MAX_MIB", 256))
+        if max_hilos is None:
+            max_hilos = _env_int("TEMPOFTP_ARGON2_HILOS", os.cpu_count() or 4)
+        self._validar()
+
+        # Hashes simultáneos: los que caben en el presupuesto, sin pasar del tope de hilos.
+        self.max_concurrentes = max(1, min(max_hilos, (self.memoria_max_mib * 1024) // self.memory_cost))
+        self._hasher = PasswordHasher(
+            time_cost=self.time_cost,
+            memory_cost=self.memory_cost,
+            parallelism=self.parallelism,
+            hash_len=self.hash_len,
+            salt_len=self.salt_len,
+            type=_TIPOS[self.tipo],
+        )
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._en_curso = 0
+        self._en_curso_max = 0
+        self._hashes = 0
+        self._duracion_total_s = 0.0
+
+    def _validar(self) -> None:
+        """ValueError si Pure-FTPd (libsodium) no podría verificar los hashes
+        o si un solo hash no cabe en el presupuesto."""
+        if self.tipo not in _TIPOS:
+            raise ValueError(f"TEMPOFTP_ARGON2_TYPE={self.tipo!r}: Pure-FTPd sólo acepta argon2id ('id') o argon2i ('i')")
+        minimo_t = 3 if self.tipo == "i" else 1
+        if self.time_cost < minimo_t:
+            raise ValueError(f"TEMPOFTP_ARGON2_TIME_COST={self.time_cost}: argon2{self.tipo} requiere >= {minimo_t}")
+        if not 1 <= self.parallelism <= 16:
+            raise ValueError(f"TEMPOFTP_ARGON2_PARALLELISM={self.parallelism}: debe estar entre 1 y 16")
+        if self.memory_cost < 8 * self.parallelism:
+            raise ValueError(f"TEMPOFTP_ARGON2_MEMORY_COST={self.memory_cost} KiB: debe ser >= 8 * parallelism")
+        if not 16 <= self.hash_len <= 64:
+            raise ValueError(f"TEMPOFTP_ARGON2_HASH_LEN={self.hash_len}: debe estar entre 16 y 64")
+        if not 16 <= self.salt_len <= 64:
+            raise ValueError(f"TEMPOFTP_ARGON2_SALT_LEN={self.salt_len}: debe estar entre 16 y 64")
+        if self.memory_cost > self.memoria_max_mib * 1024:
+            raise ValueError(
+                f"TEMPOFTP_ARGON2_MEMORY_COST={self.memory_cost} KiB no cabe en "
+                f"TEMPOFTP_ARGON2_MEMORIA_MAX_MIB={self.memoria_max_mib}"
+            )
+
+    def _hash_sync(self, password: str) -> str:
+        with self._lock:
+            self._en_curso += 1
+            self._en_curso_max = max(self._en_curso_max, self._en_curso)
+        t0 = time.perf_counter()
+        try:
+            return self._hasher.hash(password)
+        finally:
+            duracion = time.perf_counter() - t0
+            with self._lock:
+                self._en_curso -= 1
+                self._hashes += 1
+                self._duracion_total_s += duracion
+
+    async def hash(self, password: str) -> str:
+        """Hash en formato PHC ($argon2id$v=19$m=...,t=...,p=...$salt$hash),
+        calculado fuera del event loop."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrentes,
+                                                thread_name_prefix="argon2")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._hash_sync, password)
+
+    def metricas(self) -> Dict[str, Any]:
+        return {
+            "tipo": f"argon2{self.tipo}",
+            "memory_cost_kib": self.memory_cost,
+            "max_concurrentes": self.max_concurrentes,
+            "en_curso": self._en_curso,
+            "en_curso_max": self._en_curso_max,
+            "hashes": self._hashes,
+            "duracion_media_ms": round(self._duracion_total_s / self._hashes * 1000, 3) if self._hashes else 0.0,
+        }
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
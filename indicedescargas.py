@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Índice incremental del log de transferencias de Pure-FTPd para las
+estadísticas de descarga de GET /tmpftp/{id}.
+
+Antes cada GET sobre una solicitud 'listo' leía transfer.log (cientos de MB)
+desde el principio para contar sesiones (IP, día). Ahora el log se lee una sola
+vez: se guarda el inode y el offset hasta donde se procesó y cada
+actualización lee sólo lo nuevo. Las sesiones y su resumen por (usuario FTP,
+consulta) viven en SQLite (mismo archivo que las solicitudes), así que la
+consulta de estadísticas es una lectura por clave primaria.
+
+La actualización no corre dentro de los GET: con el índice vacío el primer
+request leería el log entero. La hace un bucle en segundo plano (iniciar())
+que sólo arranca transfer_worker.py, cada TEMPOFTP_INDICE_DESCARGAS_INTERVALO_S
+segundos. La API sólo lee el resumen, que puede ir ese intervalo atrasado.
+
+Rotación: si el inode del log cambió, se termina de leer el archivo rotado
+(`<log>.1`, si su inode es el guardado) desde el offset y se empieza el nuevo
+desde 0. Si el archivo se truncó (tamaño < offset), se relee desde 0.
+
+Uso (pre-indexar, p. ej. tras desplegar, sin esperar al worker):
+    python indicedescargas.py
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from tmpftpdb import TMPFTPdb
+
+logger = logging.getLogger(__name__)
+
+LOG_PATH_DEFAULT = "/var/log/pure-ftpd/transfer.log"
+
+# Bytes procesados por transacción: acota cuánto tiempo se retiene el lock de
+# escritura de SQLite mientras se pone al día con un log grande.
+_LOTE_BYTES = 4 * 1024 * 1024
+
+# Clave de consulta para el agregado de todo el usuario (consulta_id=None).
+_TODAS = ""
+
+
+def _parse_linea(linea: str) -> Optional[Tuple[str, str, str, str, str]]:
+    """
+    (usuario, consulta_id, ip, dia, timestamp) de una descarga exitosa en
+    formato CLF, o None si la línea no es un GET con 200.
+    Formato: IP - USER [dd/Mon/yyyy:HH:mm:ss tz] "GET /path" 200 SIZE
+    El path es /data/<usuario>/<consulta_id>/archivo (o /<consulta_id>/archivo
+    si el log es relativo al home).
+    """
+    if '"GET ' not in linea or ' 200 ' not in linea:
+        return None
+    partes = linea.split()
+    if len(partes) < 3:
+        return None
+    ip, usuario = partes[0], partes[2]
+    inicio, fin = linea.find('['), linea.find(']')
+    if inicio == -1 or fin == -1:
+        return None
+    timestamp = linea[inicio + 1:fin]
+    dia = timestamp.split(':')[0]
+    p_ini = linea.find('"GET ') + 5
+    p_fin = linea.find('"', p_ini)
+    if p_fin == -1:
+        return None
+    path = linea[p_ini:p_fin].split(' ', 1)[0]
+    segmentos = [s for s in path.split('/') if s]
+    if usuario in segmentos:
+        i = segmentos.index(usuario)
+        consulta = segmentos[i + 1] if len(segmentos) > i + 2 else None
+    else:
+        consulta = segmentos[0] if len(segmentos) > 1 else None
+    if not ip or not dia or not consulta:
+        return None
+    return usuario, consulta, ip, dia, timestamp
+
+
+class IndiceDescargas:
+    """Índice de sesiones de descarga sobre las tablas descargas_* de TMPFTPdb."""
+
+    def __init__(self, db: TMPFTPdb, log_path: Optional[str] = None) -> None:
+        self.db = db
+        self.log_path = log_path or os.getenv("TEMPOFTP_TRANSFER_LOG", LOG_PATH_DEFAULT)
+        # Segundos entre actualizaciones del bucle de fondo (0 = no arranca).
+        self.intervalo_s = float(os.getenv("TEMPOFTP_INDICE_DESCARGAS_INTERVALO_S", "10"))
+        self._hilo: Optional[ThreadPoolExecutor] = None
+        self._tarea: Optional[asyncio.Task] = None
+        self._init_tablas()
+
+    def _init_tablas(self) -> None:
+        with self.db._get_conn() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS descargas_cursor (
+                    log_path TEXT PRIMARY KEY,
+                    inode INTEGER,
+                    offset INTEGER NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS descargas_sesiones (
+                    usuario TEXT NOT NULL,
+                    consulta_id TEXT NOT NULL,
+                    ip TEXT NOT NULL,
+                    dia TEXT NOT NULL,
+                    PRIMARY KEY (usuario, consulta_id, ip, dia)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS descargas_resumen (
+                    usuario TEXT NOT NULL,
+                    consulta_id TEXT NOT NULL,
+                    sesiones INTEGER NOT NULL,
+                    ultima_descarga TEXT,
+                    PRIMARY KEY (usuario, consulta_id)
+                ) WITHOUT ROWID
+            ''')
+            conn.commit()
+
+    async def iniciar(self) -> None:
+        if self._tarea is not None or self.intervalo_s <= 0:
+            return
+        # Un solo hilo: una sola conexión SQLite para todas las pasadas.
+        self._hilo = ThreadPoolExecutor(max_workers=1, thread_name_prefix="indice-descargas")
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def _bucle(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self._hilo, self.actualizar)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("No se pudo actualizar el índice de descargas de %s", self.log_path)
+            await asyncio.sleep(self.intervalo_s)
+
+    async def cerrar(self) -> None:
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+        if self._hilo is not None:
+            # El lote en curso termina su transacción antes de soltar el hilo.
+            await asyncio.to_thread(self._hilo.shutdown, wait=True)
+            self._hilo = None
+
+    def estadisticas(self, usuario_ftp: str, consulta_id: Optional[str] = None) -> Dict[str, object]:
+        """{total_descargas, ultima_descarga} según lo indexado hasta ahora."""
+        with self.db._get_conn() as conn:
+            row = conn.execute(
+                "SELECT sesiones, ultima_descarga FROM descargas_resumen WHERE usuario = ? AND consulta_id = ?",
+                (usuario_ftp, consulta_id or _TODAS)
+            ).fetchone()
+        if not row:
+            return {"total_descargas": 0, "ultima_descarga": None}
+        return {"total_descargas": row[0], "ultima_descarga": row[1]}
+
+    def actualizar(self) -> int:
+        """Procesa lo que se agregó al log desde la última vez. Devuelve bytes leídos."""
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            return 0
+        except PermissionError:
+            logger.warning("No se puede leer %s. Verifique permisos (chmod 644).", self.log_path)
+            return 0
+
+        total = 0
+        while True:
+            leidos, seguir = self._procesar_lote(st)
+            total += leidos
+            if not seguir:
+                return total
+
+    def _procesar_lote(self, st: os.stat_result) -> Tuple[int, bool]:
+        """Una transacción: lee hasta _LOTE_BYTES de líneas completas desde el
+        cursor, registra sesiones y avanza el cursor. BEGIN IMMEDIATE hace que
+        dos workers no procesen el mismo tramo a la vez. Devuelve (bytes
+        consumidos, si queda algo por leer)."""
+        with self.db._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT inode, offset FROM descargas_cursor WHERE log_path = ?", (self.log_path,)
+            ).fetchone()
+            inode, offset = (row[0], row[1]) if row else (st.st_ino, 0)
+
+            path = self.log_path
+            if inode != st.st_ino:
+                rotado = self.log_path + ".1"
+                try:
+                    st_rot = os.stat(rotado)
+                except OSError:
+                    st_rot = None
+                if st_rot is not None and st_rot.st_ino == inode and st_rot.st_size > offset:
+                    path = rotado
+                else:
+                    logger.info("Rotación de %s detectada; se indexa el archivo nuevo desde el inicio.", self.log_path)
+                    inode, offset = st.st_ino, 0
+            elif st.st_size < offset:
+                logger.info("%s se truncó; se reindexa desde el inicio.", self.log_path)
+                offset = 0
+
+            datos = b""
+            try:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    datos = f.read(_LOTE_BYTES)
+            except PermissionError:
+                logger.warning("No se puede leer %s. Verifique permisos (chmod 644).", path)
+            fin_linea = datos.rfind(b"\n")
+            if fin_linea == -1:
+                if path != self.log_path:
+                    # Rotado leído por completo: continuar con el actual.
+                    self._guardar_cursor(conn, st.st_ino, 0)
+                    conn.commit()
+                    return 0, True
+                conn.commit()
+                return 0, False
+            consumido = datos[:fin_linea + 1]
+
+            sesiones = set()
+            ultimas: Dict[Tuple[str, str], str] = {}
+            for cruda in consumido.splitlines():
+                parsed = _parse_linea(cruda.decode("utf-8", errors="replace"))
+                if parsed is None:
+                    continue
+                usuario, consulta, ip, dia, timestamp = parsed
+                for clave in ((usuario, consulta), (usuario, _TODAS)):
+                    sesiones.add((*clave, ip, dia))
+                    ultimas[clave] = timestamp
+            # El resumen se mantiene por deltas: sólo las sesiones realmente
+            # nuevas (rowcount 1 en el INSERT OR IGNORE) suman.
+            nuevas: Dict[Tuple[str, str], int] = {}
+            for usuario, consulta, ip, dia in sesiones:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO descargas_sesiones (usuario, consulta_id, ip, dia) VALUES (?, ?, ?, ?)",
+                    (usuario, consulta, ip, dia)
+                )
+                if cur.rowcount:
+                    nuevas[(usuario, consulta)] = nuevas.get((usuario, consulta), 0) + 1
+            conn.executemany(
+                "INSERT INTO descargas_resumen (usuario, consulta_id, sesiones, ultima_descarga) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(usuario, consulta_id) DO UPDATE SET "
+                "sesiones = sesiones + excluded.sesiones, ultima_descarga = excluded.ultima_descarga",
+                [(u, c, nuevas.get((u, c), 0), ts) for (u, c), ts in ultimas.items()]
+            )
+            self._guardar_cursor(conn, inode, offset + len(consumido))
+            conn.commit()
+            return len(consumido), True
+
+    def _guardar_cursor(self, conn, inode: int, offset: int) -> None:
+        conn.execute(
+            "INSERT INTO descargas_cursor (log_path, inode, offset) VALUES (?, ?, ?) "
+            "ON CONFLICT(log_path) DO UPDATE SET inode = excluded.inode, offset = excluded.offset",
+            (self.log_path, inode, offset)
+        )
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    from dotenv import load_dotenv
+    load_dotenv()
+    indice = IndiceDescargas(TMPFTPdb())
+    t0 = time.perf_counter()
+    leidos = indice.actualizar()
+    logger.info("Índice de descargas al día: %d bytes procesados en %.1fs", leidos, time.perf_counter() - t0)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+¿El host de origen de una solicitud es esta máquina? (para usar un enlace
+simbólico en lugar de ssh/rsync).
+
+Antes GestorFTP._es_host_local llamaba a socket.getaddrinfo y a
+gethostbyname_ex(gethostname()) en cada solicitud, y procesar_trabajo lo
+hacía directo en el event loop: un resolver lento congelaba todo el worker.
+Ahora:
+
+- Las direcciones locales se leen una vez de las interfaces
+  (/proc/net/fib_trie para IPv4, /proc/net/if_inet6 para IPv6; si no hay
+  /proc, gethostbyname_ex(gethostname())) y se refrescan cada
+  TEMPOFTP_LOCALIDAD_REFRESCO_S segundos (300).
+- Los nombres se resuelven con loop.getaddrinfo (fuera del loop) con tope de
+  TEMPOFTP_DNS_TIMEOUT_S (5) y se cachean: las respuestas
+  TEMPOFTP_DNS_TTL_S (300) y los fallos TEMPOFTP_DNS_TTL_NEGATIVO_S (30).
+- metricas() expone la latencia de resolución y los aciertos de caché.
+
+El criterio no cambia: local si alguna dirección resuelta es loopback o es
+de una interfaz propia; un nombre que no resuelve se asume remoto.
+"""
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _direcciones_interfaces() -> FrozenSet[str]:
+    """Direcciones IPv4/IPv6 asignadas a las interfaces de esta máquina."""
+    direcciones = set()
+    try:
+        with open("/proc/net/fib_trie") as f:
+            anterior = None
+            for linea in f:
+                partes = linea.split()
+                if linea.strip().startswith("|--") and len(partes) >= 2:
+                    anterior = partes[1]
+                elif "/32 host LOCAL" in linea and anterior:
+                    direcciones.add(anterior)
+    except OSError:
+        pass
+    try:
+        with open("/proc/net/if_inet6") as f:
+            for linea in f:
+                hexa = linea.split()[0]
+                direcciones.add(str(ipaddress.IPv6Address(int(hexa, 16))))
+    except (OSError, ValueError, IndexError):
+        pass
+    if not direcciones:
+        try:
+            direcciones.update(socket.gethostbyname_ex(socket.gethostname())[2])
+        except OSError:
+            pass
+    direcciones.update(("127.0.0.1", "::1"))
+    return frozenset(direcciones)
+
+
+def _es_loopback(ip: str) -> bool:
+    try:
+        return ipaddress.ip_address(ip.split("%", 1)[0]).is_loopback
+    except ValueError:
+        return False
+
+
+class LocalidadHosts:
+    """Caché de direcciones locales y de resoluciones de nombres."""
+
+    def __init__(self) -> None:
+        self._refresco_s = float(os.getenv("TEMPOFTP_LOCALIDAD_REFRESCO_S", "300"))
+        self._ttl_s = float(os.getenv("TEMPOFTP_DNS_TTL_S", "300"))
+        self._ttl_negativo_s = float(os.getenv("TEMPOFTP_DNS_TTL_NEGATIVO_S", "30"))
+        self._timeout_s = float(os.getenv("TEMPOFTP_DNS_TIMEOUT_S", "5"))
+        self._locales: FrozenSet[str] = _direcciones_interfaces()
+        self._locales_ts = time.monotonic()
+        # host -> (direcciones o None si no resolvió, vence)
+        self._cache: Dict[str, Tuple[Optional[FrozenSet[str]], float]] = {}
+        self._lock = threading.Lock()
+        self._resoluciones = 0
+        self._fallos = 0
+        self._aciertos_cache = 0
+        self._latencia_total_s = 0.0
+        self._latencia_max_s = 0.0
+
+    @staticmethod
+    def _normalizar(hostname: str) -> str:
+        if ":" in hostname and "/" in hostname:
+            # Solo split si parece patrón 'host:/path' (no afectará '127.0.0.1')
+            hostname = hostname.split(":", 1)[0]
+        return str(hostname).strip().lower().strip("[]")
+
+    def _locales_vigentes(self) -> FrozenSet[str]:
+        if time.monotonic() - self._locales_ts > self._refresco_s:
+            self._locales = _direcciones_interfaces()
+            self._locales_ts = time.monotonic()
+        return self._locales
+
+    def _desde_cache(self, h: str):
+        with self._lock:
+            entrada = self._cache.get(h)
+            if entrada and entrada[1] > time.monotonic():
+                self._aciertos_cache += 1
+                return True, entrada[0]
+        return False, None
+
+    def _guardar(self, h: str, direcciones: Optional[FrozenSet[str]], duracion: float) -> None:
+        ttl = self._ttl_s if direcciones is not None else self._ttl_negativo_s
+        with self._lock:
+            self._cache[h] = (direcciones, time.monotonic() + ttl)
+            self._resoluciones += 1
+            self._fallos += direcciones is None
+            self._latencia_total_s += duracion
+            self._latencia_max_s = max(self._latencia_max_s, duracion)
+
+    def _decidir(self, hostname: str, direcciones: Optional[FrozenSet[str]]) -> bool:
+        if direcciones is None:
+            logger.warning("No se pudo resolver el hostname '%s'. Asumiendo remoto.", hostname)
+            return False
+        locales = self._locales_vigentes()
+        return any(_es_loopback(ip) or ip in locales for ip in direcciones)
+
+    def _atajo(self, h: str) -> Optional[bool]:
+        if not h or h == "localhost":
+            return True
+        try:
+            ip = ipaddress.ip_address(h)
+        except ValueError:
+            return None
+        # Una IP literal no necesita resolverse.
+        return ip.is_loopback or str(ip) in self._locales_vigentes()
+
+    async def es_local(self, hostname: Optional[str]) -> bool:
+        """Versión para el event loop: la resolución corre fuera del loop."""
+        h = self._normalizar(hostname or "")
+        atajo = self._atajo(h)
+        if atajo is not None:
+            return atajo
+        en_cache, direcciones = self._desde_cache(h)
+        if not en_cache:
+            loop = asyncio.get_running_loop()
+            t0 = time.perf_counter()
+            try:
+                infos = await asyncio.wait_for(
+                    loop.getaddrinfo(h, None, type=socket.SOCK_STREAM), timeout=self._timeout_s)
+                direcciones = frozenset(ai[4][0] for ai in infos)
+            except (OSError, asyncio.TimeoutError):
+                direcciones = None
+            self._guardar(h, direcciones, time.perf_counter() - t0)
+        return self._decidir(hostname, direcciones)
+
+    def metricas(self) -> Dict[str, Any]:
+        return {
+            "direcciones_locales": len(self._locales),
+            "resoluciones": self._resoluciones,
+            "fallidas": self._fallos,
+            "aciertos_cache": self._aciertos_cache,
+            "latencia_media_ms": round(self._latencia_total_s / self._resoluciones * 1000, 3)
+            if self._resoluciones else 0.0,
+            "latencia_max_ms": round(self._latencia_max_s * 1000, 3),
+        }
@@ -90,7 +90,14 @@ def validate_encryption_key():
 async def lifespan(app: FastAPI):
     validate_pureftpd_config()
     validate_encryption_key()
-    yield
+    # Un pool MySQL por worker de uvicorn, vivo mientras viva la app (antes
+    # cada operación abría y cerraba el suyo).
+    gestor = get_gestor()
+    await gestor.iniciar()
+    try:
+        yield
+    finally:
+        await gestor.cerrar()
 
 
 limiter = Limiter(key_func=get_remote_address)
@@ -136,7 +143,7 @@ async def get_status():
     return {"status": "active"}
 
 @app.get("/health")
-async def get_health():
+async def get_health(gestor=Depends(get_gestor)):
     data_path = os.getenv('TEMPOFTP_DATA_PATH', '/data')
     try:
         usage = shutil.disk_usage(data_path)
@@ -148,7 +155,33 @@ async def get_health():
     except (FileNotFoundError, PermissionError) as e:
         logger.warning(f"No se pudo leer espacio en disco ({data_path}): {e}")
         disk_info = {"space_error": "unavailable"}
-    return {"status": "ok", **disk_info, "ftpd": "up", "database": "ok"}
+    if "space_free_gb" in disk_info:
+        # Lo que las copias en curso todavía van a escribir (reservas_espacio).
+        reservado = await gestor.espacio_reservado()
+        disk_info["space_reserved_gb"] = round(reservado["bytes"] / (1024**3), 2)
+        disk_info["space_reservations"] = reservado["reservas"]
+        disk_info["space_available_gb"] = round(max(usage.free - reservado["bytes"], 0) / (1024**3), 2)
+    health = {"status": "ok", **disk_info, "ftpd": "up", "database": "ok"}
+    # Sólo el gestor real tiene pool MySQL.
+    if hasattr(gestor, "metricas_mysql"):
+        health["mysql_pool"] = gestor.metricas_mysql()
+        health["argon2"] = gestor.metricas_argon2()
+        health["papelera"] = gestor.metricas_papelera()
+        health["dns"] = gestor.metricas_dns()
+        health["sondeos_du"] = await gestor.resumen_sondeos()
+        health["reuso_contenido"] = await gestor.metricas_reuso()
+    return health
+
+@app.get("/usage")
+async def get_usage(limite: int = 500, gestor=Depends(get_gestor)):
+    """
+    Uso de /data por home FTP, de mayor a menor, según la última pasada del
+    escáner en segundo plano (usodisco.py). No recorre /data: responde desde
+    SQLite, con la antigüedad de la foto (`antiguedad_s`). Cada home trae
+    además `bytes_registrados`, lo que suman sus solicitudes según el sondeo
+    (uso_usuarios), para detectar datos que no corresponden a ninguna.
+    """
+    return await gestor.uso_disco(limite=limite)
 
 _RATE_LIMIT_POST = os.getenv("TEMPOFTP_RATE_LIMIT_POST", "10/hour")
 
@@ -203,6 +236,7 @@ async def create_tmpftp(request: Request, req: TmpFTPRequest, gestor=Depends(get
 async def list_tmpftp(
     estado: Optional[str] = None,
     limite: int = 500,
+    sin_vencimiento: bool = False,
     gestor=Depends(get_gestor),
 ):
     """
@@ -218,13 +252,14 @@ async def list_tmpftp(
 
     `created_at: null` es el dato importante de cada fila: sin él
     `eliminar_expiradas()` no puede calcular el vencimiento y la cuenta no
-    caduca nunca.
+    caduca nunca. Con `?sin_vencimiento=true` se listan sólo ésas (las que no
+    tienen `expires_at`), sin tener que recorrer el inventario completo.
     """
-    solicitudes = await gestor.list_solicitudes(estado=estado, limite=limite)
-    sin_vencimiento = [s["id"] for s in solicitudes if not s.get("created_at")]
+    solicitudes = await gestor.list_solicitudes(estado=estado, limite=limite, sin_vencimiento=sin_vencimiento)
+    ids_sin_created_at = [s["id"] for s in solicitudes if not s.get("created_at")]
     return {
         "total": len(solicitudes),
-        "sin_created_at": len(sin_vencimiento),
+        "sin_created_at": len(ids_sin_created_at),
         "solicitudes": solicitudes,
     }
 
@@ -245,6 +280,8 @@ async def get_tmpftp_status(id: str, gestor=Depends(get_gestor)):
         return JSONResponse(content=result, status_code=status.HTTP_200_OK)
     elif st == "error":
         return JSONResponse(content=result, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    elif st == "cancelado":
+        return JSONResponse(content=result, status_code=status.HTTP_200_OK)
     return JSONResponse(content=result, status_code=status.HTTP_202_ACCEPTED, headers={"Retry-After": "10"})
 
 @app.delete("/tmpftp/expired")
@@ -259,7 +296,8 @@ async def cleanup_expired(gestor=Depends(get_gestor)):
 
 @app.delete("/tmpftp/{id}")
 async def delete_tmpftp_request(id: str, gestor=Depends(get_gestor)):
-    """Elimina una solicitud específica y sus datos asociados."""
+    """Elimina una solicitud específica y sus datos asociados. Si su copia
+    sigue en curso, la cancela y la solicitud queda en 'cancelado'."""
     try:
         result = await gestor.delete_request(id)
         if result.get("status") == "not_found":
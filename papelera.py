@@ -0,0 +1,349 @@
+"""
+Papelera de /data: borrado en dos tiempos de los árboles de datos.
+
+Antes _borrar_directorio_seguro hacía shutil.rmtree antes de responder, así
+que DELETE /tmpftp/{id} y DELETE /tmpftp/user/{user} tardaban lo que tardara
+borrar cada archivo de un dataset (minutos para cientos de GB). Ahora el
+árbol se renombra a /data/.trash/<ns>-<rand>-<nombre>: en el mismo sistema de
+archivos es un rename atómico, desaparece del FTP en el acto y la respuesta
+sale enseguida. Un purgador en segundo plano lo borra después:
+
+- recorre los árboles con os.scandir desde TEMPOFTP_PAPELERA_HILOS hilos
+  (4), cada uno con prioridad de E/S idle (ioprio_set), para no competir con
+  las descargas FTP ni con rsync;
+- borra directorio por directorio: cada archivo se borra al listarlo y cada
+  directorio en cuanto se vació con sus subdirectorios. En memoria sólo
+  quedan los directorios por visitar, nunca la lista de archivos del árbol;
+- un error en una entrada (permisos, un directorio que no quedó vacío) se
+  registra y se salta. Un árbol que sigue fallando tras
+  TEMPOFTP_PAPELERA_REINTENTOS pasadas (3) se aparta a .trash/.cuarentena
+  para revisarlo a mano, en lugar de reintentarse para siempre;
+- el purgador corre sólo en el worker de transferencias
+  (GestorFTP.iniciar_tareas_fondo); la API y cleanup_expired.py sólo mueven
+  a la papelera. Un flock sobre .trash/.lock evita además que purguen dos
+  procesos a la vez (p. ej. el worker saliente y el nuevo en un reinicio);
+- recuperación ante caídas: lo que quedó en .trash (entero o a medio borrar)
+  se retoma en el próximo arranque, y el lock se libera solo si el proceso
+  muere;
+- .trash/.estado.json guarda los bytes que faltan liberar, para /health: cada
+  pasada primero suma los tamaños (el mismo recorrido, sin borrar) y después
+  borra.
+
+Si .trash estuviera en otro sistema de archivos (rename con EXDEV), se borra
+en el momento como antes.
+"""
+import asyncio
+import ctypes
+import errno
+import fcntl
+import json
+import logging
+import os
+import platform
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ioprio_set(2): no está en os; número de syscall por arquitectura.
+_IOPRIO_SYSCALL = {"x86_64": 251, "aarch64": 30}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+
+# Directorios en el pool a la vez, por hilo.
+_EN_VUELO_POR_HILO = 2
+
+
+def _bajar_prioridad_io() -> None:
+    """Clase de E/S idle para el hilo que llama (con who=0 ioprio_set afecta
+    sólo a ese hilo, no al resto del proceso). Si no se puede, sigue igual."""
+    nr = _IOPRIO_SYSCALL.get(platform.machine())
+    if nr is None:
+        return
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.syscall(nr, _IOPRIO_WHO_PROCESS, 0, _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT)
+    except Exception:
+        pass
+
+
+def _scandir(directorio: str, borrar: bool) -> Tuple[List[str], int, int]:
+    """(subdirectorios, bytes, errores) de un directorio, sin seguir symlinks.
+    Con `borrar`, cada archivo se borra al listarlo y los bytes son los
+    liberados. Un error en una entrada se cuenta y se salta."""
+    subdirs, bytes_, errores, primero = [], 0, 0, None
+    try:
+        with os.scandir(directorio) as it:
+            for entrada in it:
+                try:
+                    if entrada.is_dir(follow_symlinks=False):
+                        subdirs.append(entrada.path)
+                        continue
+                    tamano = entrada.stat(follow_symlinks=False).st_size
+                    if borrar:
+                        os.unlink(entrada.path)
+                    bytes_ += tamano
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    errores += 1
+                    primero = primero or (entrada.path, e)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        errores += 1
+        primero = (directorio, e)
+    if errores and borrar:
+        logger.warning("Papelera: %d entradas de %s no se pudieron borrar (p. ej. %s: %s)",
+                       errores, directorio, *primero)
+    return subdirs, bytes_, errores
+
+
+class Papelera:
+    """Área .trash de /data y su purgador en segundo plano."""
+
+    def __init__(self, raiz: str = "/data", hilos: Optional[int] = None,
+                 intervalo_s: Optional[float] = None) -> None:
+        self.raiz = os.path.abspath(raiz)
+        self.ruta = os.path.join(self.raiz, ".trash")
+        self.hilos = hilos or int(os.getenv("TEMPOFTP_PAPELERA_HILOS", "4"))
+        # Además de despertar con cada mover(), revisa cada tanto por si otro
+        # proceso dejó algo (su purgador puede haberse cerrado).
+        self.intervalo_s = intervalo_s if intervalo_s is not None else float(
+            os.getenv("TEMPOFTP_PAPELERA_INTERVALO_S", "60"))
+        self.cuarentena = os.path.join(self.ruta, ".cuarentena")
+        self.reintentos = int(os.getenv("TEMPOFTP_PAPELERA_REINTENTOS", "3"))
+        # Pasadas seguidas con errores de cada entrada.
+        self._fallos: Dict[str, int] = {}
+        self._parar = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._despertar: Optional[asyncio.Event] = None
+        self._tarea: Optional[asyncio.Task] = None
+        self._pendientes = 0
+        self._ultimo_estado = 0.0
+
+    def contiene(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        return path == self.ruta or path.startswith(self.ruta + os.sep)
+
+    def mover(self, path: str) -> None:
+        """Renombra `path` dentro de la papelera (o lo borra ya si está en otro
+        sistema de archivos) y despierta al purgador."""
+        os.makedirs(self.ruta, exist_ok=True)
+        nombre = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}-{os.path.basename(path.rstrip(os.sep))}"
+        try:
+            os.rename(path, os.path.join(self.ruta, nombre))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            logger.warning("%s está en otro sistema de archivos que %s; se borra en el momento.", path, self.ruta)
+            shutil.rmtree(path)
+            return
+        if self._loop is not None and self._despertar is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    def entradas(self) -> List[str]:
+        """Árboles esperando purga (los archivos de control empiezan con '.')."""
+        try:
+            return sorted(n for n in os.listdir(self.ruta) if not n.startswith("."))
+        except FileNotFoundError:
+            return []
+
+    # --- Purga ---------------------------------------------------------------
+
+    def purgar(self) -> int:
+        """Purga todo lo que haya en la papelera, salvo que otro proceso ya lo
+        esté haciendo. Devuelve los bytes liberados."""
+        if not self.entradas():
+            return 0
+        fd = os.open(os.path.join(self.ruta, ".lock"), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            with ThreadPoolExecutor(max_workers=self.hilos, initializer=_bajar_prioridad_io,
+                                    thread_name_prefix="papelera") as pool:
+                # Primero se miden todas las entradas: así bytes_pendientes
+                # cubre toda la papelera antes de empezar a borrar.
+                nombres = self.entradas()
+                self._pendientes = 0
+                for nombre in nombres:
+                    if self._parar.is_set():
+                        break
+                    self._pendientes += self._recorrer(pool, os.path.join(self.ruta, nombre), borrar=False)[0]
+                self._guardar_estado(forzar=True)
+                liberados = 0
+                for nombre in nombres:
+                    if self._parar.is_set():
+                        break
+                    liberado, errores = self._recorrer(pool, os.path.join(self.ruta, nombre), borrar=True)
+                    liberados += liberado
+                    if self._parar.is_set():
+                        break
+                    if errores:
+                        self._fallo(nombre, errores)
+                    else:
+                        self._fallos.pop(nombre, None)
+                        logger.info("Papelera: purgado %s (%d bytes)", nombre, liberado)
+            self._guardar_estado(forzar=True)
+            return liberados
+        finally:
+            os.close(fd)
+
+    def _recorrer(self, pool: ThreadPoolExecutor, raiz: str, borrar: bool) -> Tuple[int, int]:
+        """
+        Recorre `raiz` en profundidad con hasta _EN_VUELO_POR_HILO directorios
+        por hilo en el pool, sin acumular la lista de archivos: en memoria sólo
+        quedan los directorios por visitar. Devuelve (bytes, errores). Con
+        `borrar`, cada archivo se borra al listarlo y cada directorio en cuanto
+        se vaciaron todos sus subdirectorios.
+        """
+        if os.path.islink(raiz) or not os.path.isdir(raiz):
+            try:
+                tamano = os.lstat(raiz).st_size
+                if borrar:
+                    os.unlink(raiz)
+                return tamano, 0
+            except FileNotFoundError:
+                return 0, 0
+            except OSError as e:
+                logger.warning("Papelera: no se pudo borrar %s: %s", raiz, e)
+                return 0, 1
+        total = errores = 0
+        por_visitar = [raiz]
+        # Directorio -> subdirectorios que todavía no se borraron.
+        hijos: Dict[str, int] = {}
+        en_curso: Dict[Future, str] = {}
+        while por_visitar or en_curso:
+            while por_visitar and len(en_curso) < _EN_VUELO_POR_HILO * self.hilos and not self._parar.is_set():
+                directorio = por_visitar.pop()
+                en_curso[pool.submit(_scandir, directorio, borrar)] = directorio
+            if not en_curso:
+                break
+            hechos, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for f in hechos:
+                directorio = en_curso.pop(f)
+                subdirs, bytes_, errs = f.result()
+                total += bytes_
+                errores += errs
+                por_visitar.extend(subdirs)
+                if borrar:
+                    self._pendientes -= bytes_
+                    self._guardar_estado()
+                    hijos[directorio] = len(subdirs)
+                    if not subdirs:
+                        errores += self._rmdir_hacia_arriba(directorio, raiz, hijos)
+        return total, errores
+
+    @staticmethod
+    def _rmdir_hacia_arriba(directorio: str, raiz: str, hijos: Dict[str, int]) -> int:
+        """Borra `directorio`, ya vacío de archivos y sin subdirectorios, y
+        los padres que con eso quedan sin subdirectorios pendientes. Devuelve
+        los errores."""
+        errores = 0
+        while True:
+            del hijos[directorio]
+            try:
+                os.rmdir(directorio)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                errores += 1
+                logger.warning("Papelera: no se pudo borrar el directorio %s: %s", directorio, e)
+            if directorio == raiz:
+                return errores
+            directorio = os.path.dirname(directorio)
+            hijos[directorio] -= 1
+            if hijos[directorio]:
+                return errores
+
+    def _fallo(self, nombre: str, errores: int) -> None:
+        """Cuenta una pasada con errores de `nombre` y, si ya van
+        self.reintentos seguidas, la aparta a la cuarentena."""
+        self._fallos[nombre] = self._fallos.get(nombre, 0) + 1
+        if self._fallos[nombre] < self.reintentos:
+            logger.warning("Papelera: %s quedó con %d errores (pasada %d de %d)",
+                           nombre, errores, self._fallos[nombre], self.reintentos)
+            return
+        del self._fallos[nombre]
+        try:
+            os.makedirs(self.cuarentena, exist_ok=True)
+            os.rename(os.path.join(self.ruta, nombre), os.path.join(self.cuarentena, nombre))
+        except OSError as e:
+            logger.error("Papelera: no se pudo apartar %s a la cuarentena: %s", nombre, e)
+            return
+        logger.error("Papelera: %s sigue sin poder borrarse tras %d pasadas; apartado a %s para revisarlo a mano",
+                     nombre, self.reintentos, self.cuarentena)
+
+    def _guardar_estado(self, forzar: bool = False) -> None:
+        ahora = time.monotonic()
+        if not forzar and ahora - self._ultimo_estado < 1:
+            return
+        self._ultimo_estado = ahora
+        estado = {"bytes_pendientes": max(0, self._pendientes),
+                  "actualizado": datetime.now(timezone.utc).isoformat()}
+        tmp = os.path.join(self.ruta, ".estado.json.tmp")
+        try:
+            with open(tmp, "w") as f:
+                json.dump(estado, f)
+            os.replace(tmp, os.path.join(self.ruta, ".estado.json"))
+        except OSError as e:
+            logger.debug("No se pudo guardar el estado de la papelera: %s", e)
+
+    def metricas(self) -> Dict[str, Any]:
+        """Entradas sin purgar, bytes pendientes según el último recorrido del
+        purgador (de cualquier proceso) y entradas apartadas a la cuarentena."""
+        entradas = self.entradas()
+        bytes_pendientes = 0
+        if entradas:
+            try:
+                with open(os.path.join(self.ruta, ".estado.json")) as f:
+                    bytes_pendientes = json.load(f).get("bytes_pendientes", 0)
+            except (OSError, ValueError):
+                pass
+        try:
+            en_cuarentena = len(os.listdir(self.cuarentena))
+        except FileNotFoundError:
+            en_cuarentena = 0
+        return {"entradas_pendientes": len(entradas), "bytes_pendientes": bytes_pendientes,
+                "en_cuarentena": en_cuarentena}
+
+    # --- Purgador en segundo plano ----------------------------------------------
+
+    async def iniciar(self) -> None:
+        """Arranca el purgador. La primera pasada retoma lo que haya quedado en
+        .trash de una ejecución anterior."""
+        if self._tarea is not None:
+            return
+        self._parar.clear()
+        self._loop = asyncio.get_running_loop()
+        self._despertar = asyncio.Event()
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def _bucle(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.purgar)
+            except Exception:
+                logger.exception("Error purgando la papelera %s", self.ruta)
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=self.intervalo_s)
+            except asyncio.TimeoutError:
+                pass
+            self._despertar.clear()
+
+    async def cerrar(self) -> None:
+        """Detiene el purgador; lo que falte se retoma en el próximo arranque."""
+        self._parar.set()
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+        self._loop = self._despertar = None
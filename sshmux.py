@@ -0,0 +1,100 @@
+"""
+Multiplexado de SSH (ControlMaster) hacia los hosts de origen.
+
+Cada solicitud remota abre al menos dos sesiones SSH al mismo host con pocos
+segundos de diferencia: el `find -printf | awk` del sondeo de tamaño y el
+transporte de rsync. Antes cada una pagaba el intercambio de claves y la autenticación, y
+un host de origen con muchas solicitudes recibía ráfagas de handshakes. Ahora
+ambas pasan por un master por host (ControlMaster=auto): la primera sesión
+lo crea y las siguientes abren un canal sobre la conexión ya autenticada.
+
+- Un socket de control por usuario/host/puerto: ControlPath=<dir>/%C (hash
+  corto, no se pasa del límite de 108 bytes de los sockets unix).
+- ControlPersist: el master sigue vivo TEMPOFTP_SSH_CONTROL_PERSIST segundos
+  (60) después de la última sesión; si el proceso muere, se cierra solo.
+- cerrar() manda `ssh -O exit` a cada master abierto y borra el directorio.
+
+Variables de entorno:
+    TEMPOFTP_SSH_MULTIPLEX        1 activa (default), 0 vuelve a una sesión por comando
+    TEMPOFTP_SSH_CONTROL_DIR      directorio de sockets (default: uno temporal por proceso)
+    TEMPOFTP_SSH_CONTROL_PERSIST  segundos que el master espera ocioso (60)
+"""
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class MultiplexorSSH:
+    """Opciones de ControlMaster para ssh/rsync y limpieza de los masters."""
+
+    def __init__(self, directorio: Optional[str] = None, persist_s: Optional[int] = None,
+                 activo: Optional[bool] = None) -> None:
+        if activo is None:
+            activo = os.getenv("TEMPOFTP_SSH_MULTIPLEX", "1").strip().lower() not in ("0", "false", "no")
+        self.activo = activo
+        self.persist_s = persist_s if persist_s is not None else int(os.getenv("TEMPOFTP_SSH_CONTROL_PERSIST", "60"))
+        self._directorio = directorio or os.getenv("TEMPOFTP_SSH_CONTROL_DIR") or None
+        self._directorio_propio = False
+        self._destinos: set = set()
+        self._lock = threading.Lock()
+
+    @property
+    def directorio(self) -> str:
+        with self._lock:
+            if self._directorio is None:
+                self._directorio = tempfile.mkdtemp(prefix="tempoftp-ssh-")
+                self._directorio_propio = True
+            elif not os.path.isdir(self._directorio):
+                os.makedirs(self._directorio, mode=0o700, exist_ok=True)
+            return self._directorio
+
+    def _opciones_control(self) -> List[str]:
+        return ["-o", f"ControlPath={os.path.join(self.directorio, '%C')}"]
+
+    def opciones(self) -> List[str]:
+        """Opciones de ssh para compartir el master del host."""
+        if not self.activo:
+            return []
+        return ["-o", "ControlMaster=auto", *self._opciones_control(),
+                "-o", f"ControlPersist={self.persist_s}"]
+
+    def ssh(self, destino: str) -> List[str]:
+        """`ssh [opciones] usuario@host`, listo para agregarle el comando remoto."""
+        if self.activo:
+            with self._lock:
+                self._destinos.add(destino)
+        return ["ssh", *self.opciones(), destino]
+
+    def rsync_rsh(self, destino: str) -> List[str]:
+        """Argumentos `-e "ssh ..."` para que rsync use el mismo master."""
+        if not self.activo:
+            return []
+        with self._lock:
+            self._destinos.add(destino)
+        return ["-e", shlex.join(["ssh", *self.opciones()])]
+
+    def cerrar(self) -> None:
+        """Cierra los masters abiertos por este proceso y, si el directorio de
+        sockets es temporal, lo borra."""
+        with self._lock:
+            destinos, self._destinos = sorted(self._destinos), set()
+            directorio, propio = self._directorio, self._directorio_propio
+        if directorio is None:
+            return
+        for destino in destinos:
+            try:
+                subprocess.run(["ssh", *self._opciones_control(), "-O", "exit", destino],
+                               capture_output=True, timeout=5)
+            except (OSError, subprocess.TimeoutExpired) as e:
+                logger.debug("ssh -O exit %s: %s", destino, e)
+        if propio:
+            shutil.rmtree(directorio, ignore_errors=True)
+            with self._lock:
+                self._directorio, self._directorio_propio = None, False
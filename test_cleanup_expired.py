@@ -13,14 +13,21 @@ import cleanup_expired
 
 def test_run_invoca_eliminar_expiradas_y_loguea_conteo(caplog):
     fake_gestor = AsyncMock()
-    fake_gestor.eliminar_expiradas.return_value = 3
+
+    async def eliminar_expiradas(tiempos):
+        tiempos.update({"directorios": 1.5, "total": 2.0})
+        return 3
+    fake_gestor.eliminar_expiradas.side_effect = eliminar_expiradas
 
     with patch("gestorftpbase.select_gestor", return_value=fake_gestor):
         with caplog.at_level("INFO"):
             asyncio.run(cleanup_expired._run())
 
     fake_gestor.eliminar_expiradas.assert_awaited_once()
-    assert "Cleanup FTP: 3 solicitudes expiradas procesadas" in caplog.text
+    # Un pool MySQL por corrida: se abre antes y se cierra después.
+    fake_gestor.iniciar.assert_awaited_once()
+    fake_gestor.cerrar.assert_awaited_once()
+    assert "Cleanup FTP: 3 solicitudes expiradas procesadas (directorios=1.50s total=2.00s)" in caplog.text
 
 
 def test_main_retorna_0_en_exito():
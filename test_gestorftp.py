@@ -0,0 +1,842 @@
+"""
+GestorFTP (gestor real) en aislamiento: los comandos externos (rsync, ssh, du)
+se sustituyen por scripts falsos en un PATH temporal, sin MySQL ni /data.
+"""
+import os
+os.environ["TEMPOFTP_SIMULACRO"] = "1"
+from cryptography.fernet import Fernet
+os.environ.setdefault("TEMPOFTP_ENCRYPTION_KEY", Fernet.generate_key().decode())
+
+import asyncio
+import shutil
+import stat
+import time
+
+import pytest
+
+import gestorftp
+from gestorftp import GestorFTP, _parse_progreso_rsync
+
+
+def _comando_falso(tmp_path, monkeypatch, nombre: str, script: str) -> None:
+    """Instala `nombre` como script sh en un directorio que va primero en PATH."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    ruta = bin_dir / nombre
+    ruta.write_text("#!/bin/sh\n" + script)
+    ruta.chmod(ruta.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+
+@pytest.fixture
+def gestor():
+    return GestorFTP()
+
+
+def test_parse_progreso_rsync():
+    snap = _parse_progreso_rsync("  1,234,567  45%   12.00MB/s    0:01:23 (xfr#12, to-chk=34/100)")
+    assert snap == {"porcentaje": 45, "bytes": 1234567, "bytes_por_seg": 12 * 1024 ** 2, "eta": "0:01:23"}
+    assert _parse_progreso_rsync("sending incremental file list") is None
+
+
+def test_rsync_emite_progreso_en_streaming(gestor, tmp_path, monkeypatch):
+    _comando_falso(tmp_path, monkeypatch, "rsync",
+                   r"printf '  100  10%%  1.00kB/s  0:00:09\r  500  50%%  2.00kB/s  0:00:05\r"
+                   r"  1,000 100%%  3.00kB/s  0:00:00 (xfr#1, to-chk=0/1)\n'" "\n")
+    snaps = []
+    asyncio.run(gestor._ejecutar_rsync("h:/src", str(tmp_path), snaps.append))
+    assert [s["porcentaje"] for s in snaps] == [10, 50, 100]
+    assert snaps[-1]["bytes"] == 1000
+
+
+def test_rsync_fallido_reporta_ultimas_lineas(gestor, tmp_path, monkeypatch):
+    _comando_falso(tmp_path, monkeypatch, "rsync",
+                   "echo 'rsync: connection unexpectedly closed'\nexit 12\n")
+    with pytest.raises(Exception, match="connection unexpectedly closed"):
+        asyncio.run(gestor._ejecutar_rsync("h:/src", str(tmp_path)))
+
+
+def test_rsync_reanuda_sobre_datos_parciales(gestor, tmp_path, monkeypatch):
+    registro = tmp_path / "args.log"
+    _comando_falso(tmp_path, monkeypatch, "rsync", f'echo "$*" >> {registro}\n')
+    asyncio.run(gestor._ejecutar_rsync("h:/src", str(tmp_path)))
+    asyncio.run(gestor._ejecutar_rsync("h:/src", str(tmp_path), reanudar=True))
+    normal, reanudado = [linea.split() for linea in registro.read_text().splitlines()]
+    assert "--partial" in normal and "--append-verify" not in normal
+    assert "--partial" in reanudado and "--append-verify" in reanudado
+
+
+def test_bytes_en_arbol(tmp_path):
+    from gestorftp import _bytes_en_arbol
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "x.bin").write_bytes(b"1" * 100)
+    (tmp_path / "y.bin").write_bytes(b"2" * 50)
+    (tmp_path / "enlace").symlink_to(tmp_path / "a")
+    assert _bytes_en_arbol(str(tmp_path)) == 150
+    assert _bytes_en_arbol(str(tmp_path / "no_existe")) == 0
+
+
+def test_progreso_se_persiste_durante_traslado(gestor, tmp_path, monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_PROGRESO_INTERVALO_S", "0.05")
+    _comando_falso(tmp_path, monkeypatch, "rsync",
+                   r"printf '  500  50%%  2.00kB/s  0:00:05\r'; sleep 0.3" "\n")
+    gestor.db.crear_solicitud("P1", "u@x.com", "h:/p", "traslado", {"usuario": "ftp_u_x"})
+    asyncio.run(gestor._rsync_con_progreso("P1", {"usuario": "ftp_u_x"}, "h:/src", str(tmp_path)))
+    status = asyncio.run(gestor.get_status("P1"))
+    assert status["status"] == "traslado"
+    assert status["progreso"]["porcentaje"] == 50
+    # Lo ya copiado deja de contar como reservado.
+    gestor.db.reservar_espacio("P1", 2000, 10_000, 0)
+    asyncio.run(gestor._rsync_con_progreso("P1", {"usuario": "ftp_u_x"}, "h:/src", str(tmp_path)))
+    assert gestor.db.espacio_reservado()["bytes"] == 1500
+
+
+def test_reserva_de_espacio_entre_copias_concurrentes(gestor, monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_ESPACIO_MARGEN_PCT", "5")
+    monkeypatch.setattr(gestorftp.shutil, "disk_usage",
+                        lambda ruta: shutil._ntuple_diskusage(total=2000, used=1000, free=1000))
+    for sid in ("E1", "E2"):
+        gestor.db.crear_solicitud(sid, "u@x.com", "h:/p", "preparando", {})
+    # Margen: 5 % de 2000 = 100. Cada una cabe sola en los 1000 libres, no ambas.
+    assert asyncio.run(gestor.reservar_espacio_data("E1", 500))
+    assert not asyncio.run(gestor.reservar_espacio_data("E2", 500))
+    assert asyncio.run(gestor.reservar_espacio_data("E2", 400))
+    assert asyncio.run(gestor.espacio_reservado()) == {"bytes": 900, "reservas": 2}
+
+
+def test_latido_del_cupo_sobrevive_a_un_error(gestor):
+    import sqlite3
+    gestor._rsync_lease_s = 0.3
+    renovar = gestor.adb.renovar_cupo_rsync
+    fallos = []
+
+    async def renovar_con_un_fallo(*args):
+        if not fallos:
+            fallos.append(args)
+            raise sqlite3.OperationalError("database is locked")
+        return await renovar(*args)
+
+    gestor.adb.renovar_cupo_rsync = renovar_con_un_fallo
+
+    async def escenario():
+        async with gestor._cupo_rsync("L1", "hostA", {}):
+            await asyncio.sleep(0.7)
+            # Pasado más de un lease: el cupo sigue vivo y hostA, lleno.
+            return gestor.db.solicitar_cupo_rsync("L2", "hostA", 60, 4, lambda h: 1)
+
+    assert asyncio.run(escenario()) == (False, 1)
+    assert len(fallos) == 1
+
+
+def test_admision_sobrevive_a_un_error(gestor):
+    import sqlite3
+    gestor._rsync_poll_s = 0.01
+    solicitar = gestor.adb.solicitar_cupo_rsync
+    fallos = []
+
+    async def solicitar_con_un_fallo(*args):
+        if not fallos:
+            fallos.append(args)
+            raise sqlite3.OperationalError("database is locked")
+        return await solicitar(*args)
+
+    gestor.adb.solicitar_cupo_rsync = solicitar_con_un_fallo
+
+    async def escenario():
+        async with gestor._cupo_rsync("A1", "hostA", {}):
+            return gestor.db.solicitar_cupo_rsync("A2", "hostA", 60, 4, lambda h: 1)
+
+    assert asyncio.run(escenario()) == (False, 1)
+    assert len(fallos) == 1
+
+
+# --- Pool MySQL compartido ---
+
+class _CursorFalso:
+    def __init__(self, filas):
+        self.filas = filas
+        self.rowcount = 1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=None):
+        self.sql = sql
+
+    async def fetchone(self):
+        return self.filas
+
+
+class _ConnFalsa:
+    def cursor(self):
+        return _CursorFalso((1,))
+
+    async def ping(self, reconnect=False):
+        pass
+
+
+class _PoolFalso:
+    minsize, maxsize = 1, 10
+
+    def __init__(self):
+        self.size, self.freesize = 1, 1
+
+    def acquire(self):
+        pool = self
+
+        class _Ctx:
+            async def __aenter__(self):
+                pool.freesize -= 1
+                return _ConnFalsa()
+
+            async def __aexit__(self, *exc):
+                pool.freesize += 1
+        return _Ctx()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+def test_operaciones_comparten_un_pool(gestor, monkeypatch):
+    import gestorftp
+    creados = []
+
+    async def create_pool(**kw):
+        creados.append(kw)
+        return _PoolFalso()
+    monkeypatch.setattr(gestorftp.aiomysql, "create_pool", create_pool)
+    monkeypatch.setenv("TEMPOFTP_MYSQL_POOL_MAX", "7")
+    monkeypatch.setattr(gestor, "_borrar_directorio_seguro", lambda path: False)
+    for id_ in ("B1", "B2"):
+        gestor.db.crear_solicitud(id_, "u@x.com", "h:/p", "listo", {"usuario": "ftp_u_x"})
+
+    async def escenario():
+        await gestor.iniciar()
+        await gestor.bloquear_solicitud("B1")
+        await gestor.bloquear_solicitud("B2")
+        await gestor.delete_ftp_user("ftp_u_x")
+        metricas = gestor.metricas_mysql()
+        await gestor.cerrar()
+        return metricas
+
+    metricas = asyncio.run(escenario())
+    assert len(creados) == 1
+    assert creados[0]["maxsize"] == 7
+    assert metricas["prestamos"] == 3
+    assert metricas["en_uso"] == 0 and metricas["ociosas"] == 1
+    # cerrar() también apaga el executor de SQLite y sus conexiones.
+    assert gestor.adb._executor._shutdown
+
+
+class _CursorRegistro(_CursorFalso):
+    """Cursor que registra cada sentencia (un round trip) y simula rowcount."""
+
+    def __init__(self, sentencias, rowcount=1, error=None):
+        super().__init__(None)
+        self.sentencias, self.rowcount, self.error = sentencias, rowcount, error
+
+    async def execute(self, sql, params=None):
+        self.sentencias.append((sql, params))
+        if self.error:
+            raise self.error
+
+
+def _mysql_con_registro(monkeypatch, **cursor_kw):
+    import gestorftp
+    sentencias = []
+
+    class _Conn(_ConnFalsa):
+        def cursor(self):
+            return _CursorRegistro(sentencias, **cursor_kw)
+
+    class _Pool(_PoolFalso):
+        def acquire(self):
+            ctx = super().acquire()
+
+            class _Ctx:
+                async def __aenter__(self):
+                    await ctx.__aenter__()
+                    return _Conn()
+
+                async def __aexit__(self, *exc):
+                    await ctx.__aexit__(*exc)
+            return _Ctx()
+
+    async def create_pool(**kw):
+        assert kw["client_flag"] & gestorftp.CLIENT.FOUND_ROWS
+        return _Pool()
+    monkeypatch.setattr(gestorftp.aiomysql, "create_pool", create_pool)
+    mysql = gestorftp.FTPDB_MySQL()
+
+    async def hash_fijo(password):
+        return "$argon2id$fijo"
+    monkeypatch.setattr(mysql, "_hash_password", hash_fijo)
+    return mysql, sentencias
+
+
+def test_operaciones_mysql_en_una_sentencia(monkeypatch):
+    mysql, sentencias = _mysql_con_registro(monkeypatch)
+
+    async def escenario():
+        return [await mysql.bloquear_usuario("u1"), await mysql.desbloquear_usuario("u1"),
+                await mysql.eliminar_usuario_ftp("u1"), await mysql.crear_usuario_ftp("u1", "p", "/data/u1")]
+
+    assert asyncio.run(escenario()) == [True, True, True, True]
+    assert [sql.split()[0] for sql, _ in sentencias] == ["UPDATE", "UPDATE", "DELETE", "INSERT"]
+
+
+def test_crear_usuario_existente_por_clave_duplicada(monkeypatch):
+    import aiomysql
+    mysql, sentencias = _mysql_con_registro(
+        monkeypatch, error=aiomysql.IntegrityError(1062, "Duplicate entry 'u1' for key 'PRIMARY'"))
+    assert asyncio.run(mysql.crear_usuario_ftp("u1", "p", "/data/u1")) is False
+    assert len(sentencias) == 1
+
+
+def test_cuota_ftp_desde_el_uso(monkeypatch):
+    # Margen por defecto: 2 %, redondeado hacia arriba.
+    assert gestorftp._cuota_ftp({"bytes": 100 * 1024 * 1024, "archivos": 40}) == (102, 41)
+    monkeypatch.setenv("TEMPOFTP_CUOTA_MARGEN_PCT", "0")
+    assert gestorftp._cuota_ftp({"bytes": 5 * 1024 * 1024 + 1, "archivos": 40}) == (6, 40)
+    assert gestorftp._cuota_ftp({"bytes": 0, "archivos": 0}) == (1, 1)
+    mysql, sentencias = _mysql_con_registro(monkeypatch)
+
+    async def escenario():
+        await mysql.guardar_usuario_ftp("u1", "p", "/data/u1", (6, 40))
+        await mysql.guardar_usuario_ftp("u2", "p", "/data/u2")
+        return await mysql.actualizar_cuotas({"u1": (3, 10), "u3": (1, 1)})
+
+    asyncio.run(escenario())
+    (con_cuota, params), (sin_cuota, _), (cuotas, filas) = sentencias
+    assert "QuotaSize=VALUES(QuotaSize), QuotaFiles=VALUES(QuotaFiles)" in con_cuota and params[-2:] == (6, 40)
+    assert "Quota" not in sin_cuota
+    assert cuotas.startswith("UPDATE users SET QuotaSize = CASE User WHEN %s THEN %s WHEN %s THEN %s END")
+    assert filas == ("u1", 3, "u3", 1, "u1", 10, "u3", 1, "u1", "u3")
+
+
+def test_actualizar_cuotas_una_sentencia_por_lote(monkeypatch):
+    monkeypatch.setattr(gestorftp, "_MYSQL_LOTE", 2)
+    mysql, sentencias = _mysql_con_registro(monkeypatch, rowcount=2)
+    cuotas = {f"u{i}": (i + 1, 10) for i in range(5)}
+    assert asyncio.run(mysql.actualizar_cuotas(cuotas)) == 6
+    assert len(sentencias) == 3
+    assert sentencias[-1][1] == ("u4", 5, "u4", 10, "u4")
+
+
+def test_variantes_masivas_por_lotes(monkeypatch):
+    import gestorftp
+    monkeypatch.setattr(gestorftp, "_MYSQL_LOTE", 2)
+    mysql, sentencias = _mysql_con_registro(monkeypatch, rowcount=2)
+    usuarios = ["a", "b", "c", "a"]   # duplicados se ignoran
+    assert asyncio.run(mysql.bloquear_usuarios(usuarios)) == 4
+    assert len(sentencias) == 2
+    assert sentencias[0][1] == (0, "a", "b") and sentencias[1][1] == (0, "c")
+    assert asyncio.run(mysql.eliminar_usuarios_ftp([])) == 0
+    assert len(sentencias) == 2
+
+
+# --- Limpieza de expiradas ---
+
+def test_eliminar_expiradas_en_paralelo_y_por_lotes(gestor, monkeypatch):
+    import threading
+    import time
+    monkeypatch.setenv("TEMPOFTP_CLEANUP_PARALELO", "2")
+    monkeypatch.setenv("TEMPOFTP_CLEANUP_LOTE", "3")
+    viejo = {"vigencia": 1, "created_at": "2026-01-01T00:00:00+00:00"}
+    for i in range(7):
+        gestor.db.crear_solicitud(f"E{i}", "u@x.com", "h:/p", "listo", {**viejo, "usuario": f"ftp_u{i % 3}_x"})
+    gestor.db.crear_solicitud("VIVA", "u@x.com", "h:/p", "listo", {"usuario": "ftp_u0_x", "vigencia": 5})
+    gestor.db.registrar_uso("E0", "ftp_u0_x", 10, 1)
+    gestor.db.registrar_uso("VIVA", "ftp_u0_x", 3 * 1024 * 1024, 20)
+
+    lock, en_curso, maximo = threading.Lock(), [0], [0]
+
+    def borrar_falso(path):
+        with lock:
+            en_curso[0] += 1
+            maximo[0] = max(maximo[0], en_curso[0])
+        time.sleep(0.05)
+        with lock:
+            en_curso[0] -= 1
+        return True
+    monkeypatch.setattr(gestor, "_borrar_directorio_seguro", borrar_falso)
+    monkeypatch.setattr(gestor, "_borrar_home_si_vacio", lambda ruta: None)
+    lotes = []
+    marcar = gestor.db.marcar_expiradas
+    monkeypatch.setattr(gestor.db, "marcar_expiradas", lambda ids: lotes.append(list(ids)) or marcar(ids))
+    gestor.mysql, sentencias = _mysql_con_registro(monkeypatch)
+
+    tiempos = {}
+    assert asyncio.run(gestor.eliminar_expiradas(tiempos=tiempos)) == 7
+    assert maximo[0] == 2
+    assert sorted(len(l) for l in lotes) == [1, 3, 3]
+    assert all(gestor.db.obtener_solicitud(f"E{i}")["estado"] == "expirado" for i in range(7))
+    # ftp_u0_x conserva VIVA: su cuota baja a lo que le queda, y sólo los
+    # otros dos salen de MySQL, en una sentencia.
+    assert len(sentencias) == 2
+    assert sentencias[0][0].startswith("UPDATE users SET QuotaSize") and sentencias[0][1] == ("ftp_u0_x", 4, "ftp_u0_x", 21, "ftp_u0_x")
+    assert sentencias[1][0].startswith("DELETE") and sentencias[1][1] == ("ftp_u1_x", "ftp_u2_x")
+    assert set(tiempos) == {"listar", "directorios", "sqlite", "mysql", "homes", "total"}
+    assert tiempos["directorios"] >= 0.15
+
+
+# --- Sondeos de tamaño remoto ---
+
+def _find_falso(tmp_path, monkeypatch):
+    """find RUTA -printf '%s\\t%P\\0' -> 7 entradas que suman 1234 bytes, en
+    dos de primer nivel. Registra las rutas."""
+    llamadas = tmp_path / "find.log"
+    _comando_falso(tmp_path, monkeypatch, "find",
+                   f'echo "$1" >> {llamadas}\nsleep 0.2\n'
+                   "printf '0\\t|1000\\ta|0\\tb|234\\tb/x|0\\tb/y|0\\tb/z|0\\tb/y/w|' | tr '|' '\\0'\n")
+    return llamadas
+
+
+def test_sondeos_concurrentes_comparten_uno_y_se_cachean(gestor, tmp_path, monkeypatch):
+    llamadas = _find_falso(tmp_path, monkeypatch)
+
+    async def escenario():
+        tamanos = await asyncio.gather(*(gestor._tamano_remoto("localhost:/datos/q1") for _ in range(5)))
+        tamanos.append(await gestor._tamano_remoto("localhost:/datos/q1/"))
+        tamanos.append(await gestor._tamano_remoto("localhost:/datos/q2"))
+        return tamanos
+
+    assert asyncio.run(escenario()) == [1234] * 7
+    sondeo = asyncio.run(gestor._sondeo_remoto("localhost:/datos/q1"))
+    assert (sondeo["bytes"], sondeo["archivos"]) == (1234, 7)
+    assert sorted(sondeo["primer_nivel"]) == [("a", 1000), ("b", 234)]
+    assert llamadas.read_text().split() == ["/datos/q1", "/datos/q2"]
+    resumen = gestor.db.resumen_sondeos()
+    assert [(r["host"], r["sondeos"], r["fallidos"]) for r in resumen] == [("localhost", 2, 0)]
+    assert resumen[0]["duracion_media_s"] >= 0.2
+
+
+def test_sondeo_sin_cache_y_errores_no_cacheados(gestor, tmp_path, monkeypatch):
+    llamadas = _find_falso(tmp_path, monkeypatch)
+    gestor._du_ttl_s = 0
+    asyncio.run(gestor._tamano_remoto("localhost:/datos/q1"))
+    asyncio.run(gestor._tamano_remoto("localhost:/datos/q1"))
+    assert len(llamadas.read_text().split()) == 2
+
+    _comando_falso(tmp_path, monkeypatch, "find", "echo 'no existe' >&2\nexit 1\n")
+    gestor._du_ttl_s = 300
+    with pytest.raises(Exception, match="no existe"):
+        asyncio.run(gestor._tamano_remoto("localhost:/datos/q3"))
+    assert not any(clave[2] == "/datos/q3" for clave in gestor._du_cache)
+    assert gestor.db.resumen_sondeos()[0]["fallidos"] == 1
+
+
+# --- Multiplexado SSH ---
+
+def test_sondeo_y_rsync_comparten_el_master_ssh(gestor, tmp_path, monkeypatch):
+    registro = tmp_path / "args.log"
+    _comando_falso(tmp_path, monkeypatch, "ssh", f'printf "%s\\n" "ssh $*" >> {registro}\nprintf "99 3\\n"\n')
+    _comando_falso(tmp_path, monkeypatch, "rsync", f'echo "rsync $*" >> {registro}\n')
+    gestor.ssh.persist_s = 30
+
+    assert asyncio.run(gestor.obtener_tamano_remoto("u@10.255.255.1:/datos/q1")) == 99
+    asyncio.run(gestor._ejecutar_rsync("u@10.255.255.1:/datos/q1", str(tmp_path)))
+    asyncio.run(gestor._ejecutar_rsync("/local/q1", str(tmp_path)))
+    ssh_du, rsync_remoto, rsync_local = registro.read_text().splitlines()
+
+    control_path = f"ControlPath={gestor.ssh.directorio}/%C"
+    assert ssh_du.startswith("ssh -o ControlMaster=auto") and control_path in ssh_du
+    assert "ControlPersist=30 u@10.255.255.1 bash -o pipefail -c 'find /datos/q1 -printf" in ssh_du
+    assert f"-e ssh -o ControlMaster=auto -o {control_path} -o ControlPersist=30" in rsync_remoto
+    assert "-e" not in rsync_local.split()
+
+    directorio = gestor.ssh.directorio
+    gestor.ssh.cerrar()
+    assert registro.read_text().splitlines()[-1] == f"ssh -o {control_path} -O exit u@10.255.255.1"
+    assert not os.path.exists(directorio)
+
+
+def test_multiplexado_desactivable(tmp_path, monkeypatch):
+    from sshmux import MultiplexorSSH
+    monkeypatch.setenv("TEMPOFTP_SSH_MULTIPLEX", "0")
+    mux = MultiplexorSSH()
+    assert mux.ssh("u@h") == ["ssh", "u@h"]
+    assert mux.rsync_rsh("u@h") == []
+    mux.cerrar()
+
+
+# --- Subprocesos asyncio (du, rsync, chown) ---
+
+def test_transferencias_concurrentes_no_ocupan_hilos(gestor, tmp_path, monkeypatch):
+    _comando_falso(tmp_path, monkeypatch, "rsync",
+                   r"printf '  500  50%%  2.00kB/s  0:00:05\r'; sleep 0.5" "\n")
+    monkeypatch.setenv("TEMPOFTP_PROGRESO_INTERVALO_S", "10")
+    ids = [f"C{i}" for i in range(50)]
+    for id_ in ids:
+        gestor.db.crear_solicitud(id_, "u@x.com", "h:/p", "traslado", {"usuario": "ftp_u_x"})
+
+    async def escenario():
+        from concurrent.futures import ThreadPoolExecutor
+        # Executor por defecto chico: con un hilo por rsync las 50 copias y
+        # cualquier to_thread quedarían en cola.
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=4))
+        t0 = time.perf_counter()
+        copias = asyncio.gather(*(gestor._rsync_con_progreso(id_, {"usuario": "ftp_u_x"}, "h:/src", str(tmp_path))
+                                  for id_ in ids))
+        await asyncio.sleep(0.2)
+        t_hilo = time.perf_counter()
+        await asyncio.to_thread(lambda: None)
+        espera_hilo = time.perf_counter() - t_hilo
+        await copias
+        return time.perf_counter() - t0, espera_hilo
+
+    total, espera_hilo = asyncio.run(escenario())
+    assert espera_hilo < 0.3
+    assert total < 5
+
+
+def _vivo(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().split(")")[-1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_sondeo_vencido_termina_el_grupo(gestor, tmp_path, monkeypatch):
+    hijo = tmp_path / "hijo.pid"
+    _comando_falso(tmp_path, monkeypatch, "find", f"sleep 30 &\necho $! > {hijo}\nwait\n")
+    monkeypatch.setenv("TEMPOFTP_DU_TIMEOUT_S", "0.5")
+    t0 = time.perf_counter()
+    with pytest.raises(Exception, match="superó"):
+        asyncio.run(gestor.obtener_tamano_remoto("localhost:/datos/q1"))
+    assert time.perf_counter() - t0 < 5
+    time.sleep(0.1)
+    assert not _vivo(int(hijo.read_text()))
+
+
+def test_cancelar_rsync_termina_el_grupo(gestor, tmp_path, monkeypatch):
+    hijo = tmp_path / "hijo.pid"
+    _comando_falso(tmp_path, monkeypatch, "rsync", f"sleep 30 &\necho $! > {hijo}\nwait\n")
+
+    async def escenario():
+        tarea = asyncio.create_task(gestor._ejecutar_rsync("h:/src", str(tmp_path)))
+        while not hijo.exists() or not hijo.read_text().strip():
+            await asyncio.sleep(0.05)
+        tarea.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await tarea
+
+    asyncio.run(asyncio.wait_for(escenario(), timeout=10))
+    time.sleep(0.1)
+    assert not _vivo(int(hijo.read_text()))
+
+
+def test_delete_de_solicitud_en_curso_la_cancela(gestor):
+    gestor.db.crear_solicitud("D1", "u@x.com", "h:/p", "recibido", {"usuario": "ftp_u_x"}, trabajo={})
+    gestor.db.crear_solicitud("D2", "u@x.com", "h:/p", "listo", {"usuario": "ftp_u_x"})
+    assert asyncio.run(gestor.delete_request("D1")) == {"status": "cancelado", "id": "D1"}
+    status = asyncio.run(gestor.get_status("D1"))
+    assert status["status"] == "cancelado" and "cancelada" in status["mensaje"]
+    assert gestor.db.reclamar_trabajo("w1", 60) is None
+    # Una solicitud ya terminada se sigue eliminando.
+    assert asyncio.run(gestor.delete_request("D2"))["status"] == "deleted"
+    assert gestor.db.obtener_solicitud("D2") is None
+
+
+# --- Reuso de contenido ya preparado ---
+
+def _ssh_local(tmp_path, monkeypatch):
+    """ssh falso: ignora opciones y destino y evalúa el comando remoto aquí."""
+    _comando_falso(tmp_path, monkeypatch, "ssh", 'for a; do ultimo=$a; done\neval "$ultimo"\n')
+
+
+def test_huella_remota_cambia_con_el_arbol(gestor, tmp_path, monkeypatch):
+    _ssh_local(tmp_path, monkeypatch)
+    origen = tmp_path / "origen"
+    (origen / "sub").mkdir(parents=True)
+    (origen / "sub" / "a.nc").write_bytes(b"x" * 10)
+    ruta = f"u@10.255.255.1:{origen}"
+    h1 = asyncio.run(gestor._huella_remota(ruta))
+    assert len(h1) == 64 and asyncio.run(gestor._huella_remota(ruta)) == h1
+    (origen / "sub" / "b.nc").write_bytes(b"y")
+    assert asyncio.run(gestor._huella_remota(ruta)) != h1
+    assert asyncio.run(gestor._huella_remota(f"u@10.255.255.1:{tmp_path}/no_existe")) is None
+
+
+def test_reuso_con_enlaces_duros(gestor, tmp_path):
+    preparado = tmp_path / "ftp_a" / "R1"
+    (preparado / "sub").mkdir(parents=True)
+    (preparado / "sub" / "a.nc").write_bytes(b"x" * 10)
+    gestor.db.crear_solicitud("R1", "a@x.com", "h:/p", "listo", {"usuario": "ftp_a"})
+    gestor.db.registrar_contenido("h", "/p", "f" * 64, str(preparado), 10, "R1")
+    # Más reciente, pero su árbol ya no existe.
+    gestor.db.registrar_contenido("h", "/p", "f" * 64, str(tmp_path / "ftp_a" / "borrado"), 10, "R1")
+
+    info = {"usuario": "ftp_b"}
+    destino = tmp_path / "ftp_b" / "R2"
+    destino.parent.mkdir()
+    assert asyncio.run(gestor._reusar_preparado("R2", info, "h", "/p", "f" * 64, str(destino)))
+    assert (destino / "sub" / "a.nc").stat().st_ino == (preparado / "sub" / "a.nc").stat().st_ino
+    assert info["reuso"] == {"solicitud": "R1", "bytes_ahorrados": 10}
+    # El candidato que ya no existe se olvidó; otra huella no encuentra nada.
+    assert [c["destino"] for c in gestor.db.buscar_contenido("h", "/p", "f" * 64)] == [str(preparado)]
+    assert not asyncio.run(gestor._reusar_preparado("R3", {}, "h", "/p", "0" * 64, str(tmp_path / "R3")))
+    assert asyncio.run(gestor.metricas_reuso()) == {
+        "consultas": 2, "aciertos": 1, "fallidos": 0, "tasa_aciertos": 0.5, "bytes_ahorrados": 10}
+
+    # Expirada la solicitud de origen, su árbol deja de ser candidato.
+    gestor.db.marcar_expiradas(["R1"])
+    assert gestor.db.buscar_contenido("h", "/p", "f" * 64) == []
+
+
+class _MySQLTrabajo:
+    """FTPDB_MySQL falso para procesar_trabajo: usuario nuevo, registra cuotas."""
+
+    def __init__(self):
+        self.cuotas = []
+
+    async def obtener_password_hash(self, user):
+        return None
+
+    async def guardar_usuario_ftp(self, user, password, homedir, cuota=None):
+        self.cuotas.append((user, cuota))
+        return "creado"
+
+
+def _trabajo_simulado(gestor, tmp_path, monkeypatch, eventos, es_local=False, sondeo=None):
+    """Prepara `gestor` para correr procesar_trabajo sin red, MySQL ni /data:
+    registra en `eventos` el orden de cupo, huella, reuso y rsync."""
+    from contextlib import asynccontextmanager
+    mysql = _MySQLTrabajo()
+    sondeo = sondeo or {"bytes": 1000, "archivos": 3, "primer_nivel": [("a", 600), ("b", 400)]}
+    cupo_real = gestor._cupo_rsync
+
+    @asynccontextmanager
+    async def cupo(id, host, info, intento=None):
+        async with cupo_real(id, host, info, intento):
+            eventos.append("cupo")
+            yield
+            eventos.append("fin_cupo")
+
+    async def huella(ruta):
+        eventos.append("huella")
+        return "f" * 64
+
+    async def reusar(id, info, host, ruta, huella_, contenido_dir):
+        eventos.append("reuso")
+        return True
+
+    async def preparar(usuario, id, ruta=None, crear=True):
+        base = tmp_path / usuario / id
+        base.mkdir(parents=True, exist_ok=True)
+        return str(base)
+
+    async def devolver(valor):
+        return valor
+
+    monkeypatch.setattr(gestor, "_mysql", lambda: devolver(mysql))
+    monkeypatch.setattr(gestor, "_sondeo_remoto", lambda ruta: devolver(dict(sondeo)))
+    monkeypatch.setattr(gestor, "_es_host_local", lambda host: devolver(es_local))
+    monkeypatch.setattr(gestor, "reservar_espacio_data", lambda id, bytes_, intento=None: devolver(True))
+    monkeypatch.setattr(gestor, "_preparar_directorio", preparar)
+    monkeypatch.setattr(gestor, "_crear_enlace_local", lambda origen, destino: None)
+    monkeypatch.setattr(gestor, "_cupo_rsync", cupo)
+    monkeypatch.setattr(gestor, "_huella_remota", huella)
+    monkeypatch.setattr(gestor, "_reusar_preparado", reusar)
+    return mysql
+
+
+def _procesar(gestor, id, ruta="u@10.255.255.1:/datos/p"):
+    gestor.db.crear_solicitud(id, "u@x.com", ruta, "preparando", {"usuario": "ftp_u_x", "vigencia": 5})
+    asyncio.run(gestor.procesar_trabajo({"id": 1, "solicitud_id": id,
+                                         "payload": {"email": "u@x.com", "ruta": ruta, "vigencia": 5}}))
+    return gestor.db.obtener_solicitud(id)
+
+
+def test_huella_dentro_del_cupo_de_rsync(gestor, tmp_path, monkeypatch):
+    """La huella recorre el origen por ssh: cuenta contra el cupo por host."""
+    eventos = []
+    _trabajo_simulado(gestor, tmp_path, monkeypatch, eventos)
+    assert _procesar(gestor, "H1")["estado"] == "listo"
+    assert eventos == ["cupo", "huella", "reuso", "fin_cupo"]
+
+
+def test_con_cupo_concedido_deja_de_estar_en_cola(gestor, tmp_path, monkeypatch):
+    """Durante la huella (dentro del cupo) GET /tmpftp/{id} no informa una
+    posición en la cola, ni la que quedó en info de un intento anterior."""
+    _trabajo_simulado(gestor, tmp_path, monkeypatch, [])
+    estados = []
+
+    async def huella(ruta):
+        solicitud = await gestor.adb.obtener_solicitud("Q1")
+        estados.append((solicitud["estado"], solicitud["info"].get("posicion_cola")))
+        return "f" * 64
+
+    monkeypatch.setattr(gestor, "_huella_remota", huella)
+    gestor.db.crear_solicitud("Q1", "u@x.com", "u@10.255.255.1:/datos/p", "en_cola",
+                              {"usuario": "ftp_u_x", "vigencia": 5, "posicion_cola": 3})
+    asyncio.run(gestor.procesar_trabajo({"id": 1, "solicitud_id": "Q1", "payload": {
+        "email": "u@x.com", "ruta": "u@10.255.255.1:/datos/p", "vigencia": 5}}))
+    assert estados == [("preparando", None)]
+    assert gestor.db.obtener_solicitud("Q1")["estado"] == "listo"
+
+
+def test_trabajo_de_solicitud_ya_terminada_no_se_rehace(gestor, tmp_path, monkeypatch):
+    """El worker murió tras marcarla 'listo' y antes de cerrar el trabajo: el
+    reintento no copia de nuevo ni cambia la contraseña FTP ya entregada."""
+    eventos = []
+    mysql = _trabajo_simulado(gestor, tmp_path, monkeypatch, eventos)
+    assert _procesar(gestor, "T1")["estado"] == "listo"
+    password = gestor.db.obtener_solicitud("T1")["info"]["password"]
+    eventos.clear()
+    mysql.cuotas.clear()
+    asyncio.run(gestor.procesar_trabajo({"id": 1, "solicitud_id": "T1", "payload": {
+        "email": "u@x.com", "ruta": "u@10.255.255.1:/datos/p", "vigencia": 5}}))
+    solicitud = gestor.db.obtener_solicitud("T1")
+    assert (solicitud["estado"], solicitud["info"]["password"]) == ("listo", password)
+    assert eventos == [] and mysql.cuotas == []
+
+
+def test_uso_registrado_segun_el_camino(gestor, tmp_path, monkeypatch):
+    """Un origen local (enlace simbólico) no suma al home; lo armado con
+    enlaces duros suma entero, pero queda registrado como compartido."""
+    mysql = _trabajo_simulado(gestor, tmp_path, monkeypatch, [], es_local=True)
+    assert _procesar(gestor, "L1")["estado"] == "listo"
+    assert gestor.db.uso_usuario("ftp_u_x") == {"bytes": 0, "compartidos": 0, "archivos": 0, "solicitudes": 1}
+    assert mysql.cuotas == [("ftp_u_x", (1, 1))]
+
+    original = tmp_path / "otra" / "a.nc"
+    original.parent.mkdir()
+    original.write_bytes(b"x" * 600)
+
+    async def reusar(id, info, host, ruta, huella, contenido_dir):
+        os.makedirs(contenido_dir, exist_ok=True)
+        os.link(original, os.path.join(contenido_dir, "a.nc"))
+        return True
+
+    async def remoto(host):
+        return False
+
+    monkeypatch.setattr(gestor, "_es_host_local", remoto)
+    monkeypatch.setattr(gestor, "_reusar_preparado", reusar)
+    assert _procesar(gestor, "R1")["estado"] == "listo"
+    assert gestor.db.uso_usuario("ftp_u_x") == {"bytes": 1000, "compartidos": 600, "archivos": 3, "solicitudes": 2}
+
+
+# --- rsync --link-dest contra copias anteriores ---
+
+def test_candidatos_link_dest(gestor, tmp_path):
+    home = tmp_path / "ftp_u_x"
+    base_dir = home / "HOY"
+    base_dir.mkdir(parents=True)
+    # Días anteriores del mismo usuario: uno con subdirectorio, otro volcado en su id.
+    (home / "AYER" / "2026-10-16").mkdir(parents=True)
+    (home / "ANTEAYER").mkdir()
+    (home / "LOCAL").symlink_to(tmp_path)                       # solicitud de host local
+    gestor.db.crear_solicitud("ANTEAYER", "u@x.com", "u@h:/sat/ANTEAYER", "listo", {"usuario": "ftp_u_x"})
+    gestor.db.crear_solicitud("LOCAL", "u@x.com", "u@h:/sat/otra/", "listo", {"usuario": "ftp_u_x"})
+    gestor.db.crear_solicitud("AYER", "u@x.com", "u@h:/sat/2026-10-16", "listo", {"usuario": "ftp_u_x"})
+    gestor.db.crear_solicitud("VIEJA", "u@x.com", "u@h:/sat/x", "expirado", {"usuario": "ftp_u_x"})
+    gestor.db.crear_solicitud("HOY", "u@x.com", "u@h:/sat/2026-10-17", "traslado", {"usuario": "ftp_u_x"})
+    # Árbol de otro usuario con el mismo origen (ya cambiado): va primero.
+    otro = tmp_path / "ftp_o_y" / "P1" / "2026-10-17"
+    otro.mkdir(parents=True)
+    gestor.db.crear_solicitud("P1", "o@y.com", "u@h:/sat/2026-10-17", "listo", {"usuario": "ftp_o_y"})
+    gestor.db.registrar_contenido("h", "/sat/2026-10-17", "a" * 64, str(otro), 10, "P1")
+
+    candidatos = asyncio.run(gestor._candidatos_link_dest("HOY", "ftp_u_x", "h", "/sat/2026-10-17", str(base_dir)))
+    assert candidatos == [str(otro), str(home / "AYER" / "2026-10-16"), str(home / "ANTEAYER")]
+    gestor._link_dest_max = 1
+    assert len(asyncio.run(gestor._candidatos_link_dest("HOY", "ftp_u_x", "h", "/sat/2026-10-17", str(base_dir)))) == 1
+
+
+def test_link_dest_alineado_al_subdirectorio(gestor, tmp_path, monkeypatch):
+    from gestorftp import _alinear_link_dest
+    previo = tmp_path / "AYER" / "2026-10-16"
+    previo.mkdir(parents=True)
+    (previo / "a.nc").write_bytes(b"x")
+    with _alinear_link_dest([str(previo)], None) as dirs:
+        assert dirs == [str(previo)]
+    with _alinear_link_dest([str(previo)], "2026-10-17") as dirs:
+        # rsync buscará DIR/2026-10-17/a.nc, que resuelve al árbol de ayer.
+        assert os.path.samefile(os.path.join(dirs[0], "2026-10-17", "a.nc"), previo / "a.nc")
+        shim = dirs[0]
+        registro = tmp_path / "args.log"
+        _comando_falso(tmp_path, monkeypatch, "rsync", f'echo "$*" >> {registro}\n')
+        asyncio.run(gestor._ejecutar_rsync("h:/sat/2026-10-17", str(tmp_path), link_dest=tuple(dirs)))
+        assert f"--link-dest={shim}" in registro.read_text().split()
+    assert not os.path.exists(shim)
+
+
+# --- rsync en particiones ---
+
+def test_repartir_y_combinar_progreso():
+    from gestorftp import _repartir, _combinar_progreso
+    grupos = _repartir([("a", 100), ("b", 60), ("c", 50), ("d", 40), ("e", 10)], 2)
+    pesos = sorted(sum({"a": 100, "b": 60, "c": 50, "d": 40, "e": 10}[n] for n in g) for g in grupos)
+    assert pesos == [120, 140]
+    assert _repartir([("solo", 5)], 4) == [["solo"]]
+    snap = _combinar_progreso({0: {"porcentaje": 50, "bytes": 300, "bytes_por_seg": 100, "eta": "0:00:03"},
+                               1: {"porcentaje": 10, "bytes": 100, "bytes_por_seg": 50, "eta": "0:01:00"}}, 1000)
+    assert snap == {"porcentaje": 40, "bytes": 400, "bytes_por_seg": 150, "eta": "0:00:04", "particiones": 2}
+
+
+def test_particiones_salen_del_sondeo(gestor, tmp_path, monkeypatch):
+    from gestorftp import _particionar
+    _ssh_local(tmp_path, monkeypatch)
+    origen = tmp_path / "origen"
+    for nombre, tamano in (("grande", 4000), ("mediano", 2500), ("chico", 1500)):
+        (origen / nombre / "sub").mkdir(parents=True)
+        (origen / nombre / "sub" / "f.bin").write_bytes(b"x" * tamano)
+    (origen / "suelto con\nsalto.txt").write_bytes(b"y" * 10)
+    sondeo = asyncio.run(gestor._contar_remoto(f"u@10.255.255.1:{origen}"))
+    assert sondeo["archivos"] == 11
+
+    def _aparente(ruta):
+        return os.lstat(ruta).st_size + sum(os.lstat(os.path.join(d, n)).st_size
+                                            for d, dirs, archivos in os.walk(ruta) for n in dirs + archivos)
+
+    assert dict(sondeo["primer_nivel"]) == {n: _aparente(origen / n) for n in os.listdir(origen)}
+    assert sondeo["bytes"] == _aparente(origen)
+    particiones = _particionar(sondeo["primer_nivel"], 2)
+    assert len(particiones) == 2
+    assert sorted(n for p in particiones for n in p) == ["chico", "grande", "mediano", "suelto con\nsalto.txt"]
+    (tmp_path / "unico" / "x").mkdir(parents=True)
+    unico = asyncio.run(gestor._contar_remoto(f"u@10.255.255.1:{tmp_path}/unico"))
+    assert _particionar(unico["primer_nivel"], 2) is None
+    archivo = asyncio.run(gestor._contar_remoto(f"u@10.255.255.1:{origen}/chico/sub/f.bin"))
+    assert archivo == {"bytes": 1500, "archivos": 1, "primer_nivel": []}
+
+
+def test_rsync_en_particiones(gestor, tmp_path, monkeypatch):
+    registro = tmp_path / "listas.log"
+    # Cada rsync falso anota su lista (NUL -> ',') y reporta 100 bytes.
+    _comando_falso(tmp_path, monkeypatch, "rsync",
+                   'for a; do case "$a" in --files-from=*) lista=${a#--files-from=};; esac; done\n'
+                   f'echo "$(tr "\\\\0" "," < "$lista")" >> {registro}\n'
+                   r"printf '  100  50%%  1.00kB/s  0:00:01\r'; sleep 0.8" "\n")
+    monkeypatch.setenv("TEMPOFTP_PROGRESO_INTERVALO_S", "0.1")
+    gestor.db.crear_solicitud("S1", "u@x.com", "h:/p", "traslado", {"usuario": "ftp_u_x"})
+    asyncio.run(gestor._rsync_con_progreso("S1", {"usuario": "ftp_u_x"}, "h:/src/", str(tmp_path),
+                                           particiones=[["a", "b"], ["c"]], total_bytes=1000))
+    assert sorted(registro.read_text().split()) == ["a,b,", "c,"]
+    progreso = asyncio.run(gestor.get_status("S1"))["progreso"]
+    assert progreso["bytes"] == 200 and progreso["porcentaje"] == 20 and progreso["particiones"] == 2
+
+
+def test_particion_fallida_cancela_las_demas(gestor, tmp_path, monkeypatch):
+    hijo = tmp_path / "hijo.pid"
+    _comando_falso(tmp_path, monkeypatch, "rsync",
+                   'for a; do case "$a" in --files-from=*) lista=${a#--files-from=};; esac; done\n'
+                   'if grep -q malo "$lista"; then sleep 0.3; echo "rsync error: some files vanished"; exit 24; fi\n'
+                   f"sleep 30 &\necho $! > {hijo}\nwait\n")
+    gestor.db.crear_solicitud("S2", "u@x.com", "h:/p", "traslado", {"usuario": "ftp_u_x"})
+    t0 = time.perf_counter()
+    with pytest.raises(Exception, match=r"Partición 2/2: .*vanished"):
+        asyncio.run(gestor._rsync_con_progreso("S2", {"usuario": "ftp_u_x"}, "h:/src/", str(tmp_path),
+                                               particiones=[["bueno"], ["malo"]], total_bytes=10))
+    assert time.perf_counter() - t0 < 10
+    time.sleep(0.1)
+    assert not _vivo(int(hijo.read_text()))
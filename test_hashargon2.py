@@ -0,0 +1,67 @@
+"""
+HashArgon2: validación de parámetros contra lo que acepta Pure-FTPd y pool
+acotado por el presupuesto de memoria.
+"""
+import asyncio
+
+import pytest
+from argon2 import PasswordHasher
+
+from hashargon2 import HashArgon2
+
+# Parámetros baratos para que los tests no tarden.
+_BARATO = dict(time_cost=1, memory_cost=1024, parallelism=1)
+
+
+def test_hash_en_formato_que_verifica_pure_ftpd():
+    h = HashArgon2(**_BARATO)
+    hashed = asyncio.run(h.hash("secreto"))
+    assert hashed.startswith("$argon2id$v=19$m=1024,t=1,p=1$")
+    assert PasswordHasher().verify(hashed, "secreto")
+    h.close()
+
+
+def test_defaults_iguales_a_password_hasher(monkeypatch):
+    for var in ("TYPE", "TIME_COST", "MEMORY_COST", "PARALLELISM", "HASH_LEN", "SALT_LEN"):
+        monkeypatch.delenv(f"TEMPOFTP_ARGON2_{var}", raising=False)
+    h, ph = HashArgon2(), PasswordHasher()
+    assert (h.time_cost, h.memory_cost, h.parallelism, h.hash_len, h.salt_len) == \
+        (ph.time_cost, ph.memory_cost, ph.parallelism, ph.hash_len, ph.salt_len)
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(tipo="d"),                                      # libsodium no verifica argon2d
+    dict(tipo="i", time_cost=2, memory_cost=1024),        # argon2i exige t >= 3
+    dict(time_cost=0),
+    dict(parallelism=4, memory_cost=16),                  # m < 8 * p
+    dict(hash_len=8),
+    dict(salt_len=8),
+    dict(memory_cost=65536, memoria_max_mib=32),          # un hash no cabe en el presupuesto
+])
+def test_parametros_invalidos(kwargs):
+    with pytest.raises(ValueError):
+        HashArgon2(**{**_BARATO, **kwargs})
+
+
+def test_parametros_desde_entorno(monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_ARGON2_TYPE", "i")
+    monkeypatch.setenv("TEMPOFTP_ARGON2_TIME_COST", "1")
+    with pytest.raises(ValueError, match="argon2i"):
+        HashArgon2()
+
+
+def test_presupuesto_acota_hashes_simultaneos_sin_bloquear_el_loop(medir_lag):
+    # 8 MiB por hash y 16 MiB de presupuesto: como mucho 2 a la vez.
+    h = HashArgon2(time_cost=3, memory_cost=8192, parallelism=1, memoria_max_mib=16, max_hilos=8)
+    assert h.max_concurrentes == 2
+
+    async def hashes_simultaneos():
+        return await asyncio.gather(*(h.hash(f"p{i}") for i in range(8)))
+
+    hashes, lag_max = asyncio.run(medir_lag(hashes_simultaneos(), 0.005))
+    assert len(set(hashes)) == 8
+    m = h.metricas()
+    assert m["hashes"] == 8 and m["en_curso"] == 0
+    assert m["en_curso_max"] <= 2
+    assert lag_max < 0.05
+    h.close()
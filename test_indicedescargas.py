@@ -0,0 +1,112 @@
+"""
+IndiceDescargas: lectura incremental de transfer.log (offset + inode),
+rotación y agregados por (usuario FTP, consulta).
+"""
+import asyncio
+import os
+import threading
+
+import pytest
+
+from indicedescargas import IndiceDescargas, _parse_linea
+from tmpftpdb import TMPFTPdb
+
+
+def _linea(ip, usuario, consulta, dia="26/Feb/2026", hora="09:21:27", status=200, metodo="GET"):
+    return (f'{ip} - {usuario} [{dia}:{hora} -0600] "{metodo} /data/{usuario}/{consulta}/a.nc" '
+            f'{status} 1234\n')
+
+
+@pytest.fixture
+def log(tmp_path):
+    return tmp_path / "transfer.log"
+
+
+@pytest.fixture
+def indice(log):
+    return IndiceDescargas(TMPFTPdb(db_path=':memory:'), log_path=str(log))
+
+
+def test_parse_linea():
+    assert _parse_linea(_linea("1.2.3.4", "ftp_u_x", "Q1")) == (
+        "ftp_u_x", "Q1", "1.2.3.4", "26/Feb/2026", "26/Feb/2026:09:21:27 -0600")
+    assert _parse_linea(_linea("1.2.3.4", "ftp_u_x", "Q1", status=550)) is None
+    assert _parse_linea(_linea("1.2.3.4", "ftp_u_x", "Q1", metodo="PUT")) is None
+
+
+def test_sesiones_por_ip_y_dia_filtradas_por_consulta(indice, log):
+    log.write_text(
+        _linea("1.1.1.1", "ftp_u_x", "Q1")
+        + _linea("1.1.1.1", "ftp_u_x", "Q1", hora="10:00:00")     # misma sesión
+        + _linea("2.2.2.2", "ftp_u_x", "Q1")
+        + _linea("1.1.1.1", "ftp_u_x", "Q1", dia="27/Feb/2026")
+        + _linea("1.1.1.1", "ftp_u_x", "Q2")
+        + _linea("1.1.1.1", "ftp_otro_x", "Q1")
+    )
+    indice.actualizar()
+    assert indice.estadisticas("ftp_u_x", "Q1") == {
+        "total_descargas": 3, "ultima_descarga": "27/Feb/2026:09:21:27 -0600"}
+    assert indice.estadisticas("ftp_u_x")["total_descargas"] == 3   # Q2 comparte (IP, día)
+    assert indice.estadisticas("ftp_nadie_x", "Q1") == {"total_descargas": 0, "ultima_descarga": None}
+
+
+def test_solo_lee_lo_nuevo_y_espera_lineas_completas(indice, log):
+    log.write_text(_linea("1.1.1.1", "ftp_u_x", "Q1"))
+    primera = indice.actualizar()
+    assert primera == os.path.getsize(log)
+    parcial = _linea("2.2.2.2", "ftp_u_x", "Q1")
+    with open(log, "a") as f:
+        f.write(parcial[:20])
+    assert indice.actualizar() == 0
+    with open(log, "a") as f:
+        f.write(parcial[20:])
+    assert indice.actualizar() == len(parcial)
+    assert indice.estadisticas("ftp_u_x", "Q1")["total_descargas"] == 2
+
+
+def test_rotacion_termina_el_rotado_y_sigue_con_el_nuevo(indice, log):
+    log.write_text(_linea("1.1.1.1", "ftp_u_x", "Q1"))
+    indice.actualizar()
+    with open(log, "a") as f:
+        f.write(_linea("2.2.2.2", "ftp_u_x", "Q1"))      # escrito justo antes de rotar
+    os.rename(log, str(log) + ".1")
+    log.write_text(_linea("3.3.3.3", "ftp_u_x", "Q1"))
+    indice.actualizar()
+    assert indice.estadisticas("ftp_u_x", "Q1")["total_descargas"] == 3
+
+
+def test_sin_log_devuelve_ceros(indice):
+    assert indice.estadisticas("ftp_u_x", "Q1") == {"total_descargas": 0, "ultima_descarga": None}
+
+
+def test_estadisticas_no_lee_el_log(indice, log):
+    log.write_text(_linea("1.1.1.1", "ftp_u_x", "Q1"))
+    assert indice.estadisticas("ftp_u_x", "Q1")["total_descargas"] == 0
+    indice.actualizar()
+    assert indice.estadisticas("ftp_u_x", "Q1")["total_descargas"] == 1
+
+
+def test_bucle_de_fondo_indexa_en_un_solo_hilo(log, tmp_path, monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_INDICE_DESCARGAS_INTERVALO_S", "0.01")
+    db = TMPFTPdb(db_path=str(tmp_path / "t.db"))
+    indice = IndiceDescargas(db, log_path=str(log))
+
+    async def escenario():
+        await indice.iniciar()
+        try:
+            for i in range(3):
+                with open(log, "a") as f:
+                    f.write(_linea(f"{i}.1.1.1", "ftp_u_x", "Q1"))
+                for _ in range(200):
+                    if indice.estadisticas("ftp_u_x", "Q1")["total_descargas"] == i + 1:
+                        break
+                    await asyncio.sleep(0.01)
+            hilos = [t for t in threading.enumerate() if t.name.startswith("indice-descargas")]
+        finally:
+            await indice.cerrar()
+        return hilos
+
+    hilos = asyncio.run(escenario())
+    assert indice.estadisticas("ftp_u_x", "Q1")["total_descargas"] == 3
+    assert len(hilos) == 1
+    assert len(db._conns) == 2      # la del test y la del hilo del índice
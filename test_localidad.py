@@ -0,0 +1,77 @@
+"""
+LocalidadHosts: direcciones locales leídas una vez, resolución fuera del
+event loop y caché positiva/negativa.
+"""
+import asyncio
+import socket
+import time
+
+import pytest
+
+import localidad
+from localidad import LocalidadHosts
+
+
+def _getaddrinfo_falso(respuestas, llamadas, demora=0.0):
+    def getaddrinfo(host, *args, **kwargs):
+        llamadas.append(host)
+        time.sleep(demora)
+        ips = respuestas.get(host)
+        if ips is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (ip, 0)) for ip in ips]
+    return getaddrinfo
+
+
+@pytest.fixture
+def loc(monkeypatch):
+    monkeypatch.setattr(localidad, "_direcciones_interfaces", lambda: frozenset({"127.0.0.1", "::1", "10.1.2.3"}))
+    return LocalidadHosts()
+
+
+def test_direcciones_de_interfaces_incluyen_loopback():
+    direcciones = localidad._direcciones_interfaces()
+    assert "127.0.0.1" in direcciones and "::1" in direcciones
+
+
+def test_atajos_sin_resolver(loc, monkeypatch):
+    llamadas = []
+    monkeypatch.setattr(socket, "getaddrinfo", _getaddrinfo_falso({}, llamadas))
+    assert asyncio.run(loc.es_local("localhost"))
+    assert asyncio.run(loc.es_local("10.1.2.3"))
+    assert asyncio.run(loc.es_local("127.0.0.2:/datos/x"))
+    assert not asyncio.run(loc.es_local("10.9.9.9"))
+    assert llamadas == []
+
+
+def test_resolucion_cacheada_y_fuera_del_loop(loc, monkeypatch, medir_lag):
+    llamadas = []
+    monkeypatch.setattr(socket, "getaddrinfo", _getaddrinfo_falso(
+        {"propio.ejemplo": ["10.1.2.3"], "origen.ejemplo": ["10.7.7.7"]}, llamadas, demora=0.3))
+
+    async def escenario():
+        return [await loc.es_local("propio.ejemplo"), await loc.es_local("origen.ejemplo"),
+                await loc.es_local("PROPIO.ejemplo")]
+
+    resultados, lag_max = asyncio.run(medir_lag(escenario(), 0.01))
+    assert resultados == [True, False, True]
+    assert llamadas == ["propio.ejemplo", "origen.ejemplo"]
+    assert lag_max < 0.1
+    m = loc.metricas()
+    assert m["resoluciones"] == 2 and m["aciertos_cache"] == 1
+    assert m["latencia_media_ms"] >= 300
+
+
+def test_fallo_se_cachea_con_ttl_negativo(loc, monkeypatch):
+    llamadas = []
+    monkeypatch.setattr(socket, "getaddrinfo", _getaddrinfo_falso({}, llamadas))
+    assert not asyncio.run(loc.es_local("noexiste.ejemplo"))
+    assert not asyncio.run(loc.es_local("noexiste.ejemplo"))
+    assert llamadas == ["noexiste.ejemplo"]
+    assert loc.metricas()["fallidas"] == 1
+
+    loc._ttl_negativo_s = 0
+    loc._cache.clear()
+    asyncio.run(loc.es_local("noexiste.ejemplo"))
+    asyncio.run(loc.es_local("noexiste.ejemplo"))
+    assert len(llamadas) == 3
@@ -59,6 +59,18 @@ def test_get_health(client):
     assert "ftpd" in data
     assert "database" in data
 
+def test_get_usage_desde_la_foto_del_escaner(client):
+    """GET /usage no recorre /data: sirve la última foto guardada, ordenada por tamaño."""
+    assert client.get("/usage").json() == {"actualizado": None, "antiguedad_s": None, "homes": []}
+    get_gestor().db.guardar_escaneo_uso(
+        [{"usuario": "ftp_a_x", "bytes": 10, "archivos": 1, "directorios": 1},
+         {"usuario": "ftp_b_x", "bytes": 500, "archivos": 4, "directorios": 2}],
+        1.5, {"leidos": 3, "reusados": 0})
+    data = client.get("/usage", params={"limite": 1}).json()
+    assert [h["usuario"] for h in data["homes"]] == ["ftp_b_x"]
+    assert data["bytes_total"] == 510
+    assert 0 <= data["antiguedad_s"] < 60
+
 def test_get_tmpftp_status_not_found(client):
     """Prueba que se devuelve un 404 para un ID que no existe."""
     response = client.get("/tmpftp/id_inexistente")
@@ -278,8 +290,7 @@ def test_bloqueada_cuenta_como_activa_dentro_de_vigencia():
     db = _mk_db()
     db.crear_solicitud("q_blk", "u@x.com", "h:/p", "bloqueado",
                        {"usuario": "ftp_u_x", "vigencia": 5})
-    activas = db.obtener_activas_por_usuario("ftp_u_x")
-    assert any(a["id"] == "q_blk" for a in activas)
+    assert db.usuarios_con_activas(["ftp_u_x"]) == {"ftp_u_x"}
 
 
 def test_listo_conserva_created_at(client, monkeypatch):
@@ -366,3 +377,62 @@ def test_listado_cuenta_las_que_no_pueden_vencer(client, monkeypatch):
     data = client.get("/tmpftp").json()
     assert data["sin_created_at"] == 1
     assert data["solicitudes"][0]["created_at"] is None
+
+
+def test_listado_sin_vencimiento(client, monkeypatch):
+    """?sin_vencimiento=true lista sólo las cuentas sin expires_at."""
+    _crear(client, monkeypatch, "VENCE001")
+    _crear(client, monkeypatch, "NUNCA001")
+    gestor = get_gestor()
+    sol = gestor.db.obtener_solicitud("NUNCA001")
+    info = dict(sol["info"])
+    info.pop("created_at", None)
+    gestor.db.actualizar_estado("NUNCA001", sol["estado"], info)
+
+    data = client.get("/tmpftp", params={"sin_vencimiento": "true"}).json()
+    assert [s["id"] for s in data["solicitudes"]] == ["NUNCA001"]
+
+
+def test_estado_en_cola_reporta_posicion(client):
+    """Una solicitud esperando cupo de rsync expone su posición en GET /tmpftp/{id}."""
+    gestor = get_gestor()
+    gestor.db.crear_solicitud("COLA0001", "u@x.com", "h:/p", "en_cola",
+                              {"usuario": "ftp_u_x", "posicion_cola": 3, "mensaje": "En cola"})
+    r = client.get("/tmpftp/COLA0001")
+    assert r.status_code == 202
+    assert r.json()["status"] == "en_cola"
+    assert r.json()["posicion"] == 3
+
+
+def test_cupo_rsync_serializa_copias_al_mismo_host(monkeypatch):
+    """Con TEMPOFTP_RSYNC_MAX_POR_HOST=1 la segunda copia al mismo host espera
+    en 'en_cola' hasta que la primera libera el cupo."""
+    monkeypatch.setenv("TEMPOFTP_RSYNC_MAX_POR_HOST", "1")
+    monkeypatch.setenv("TEMPOFTP_RSYNC_POLL_S", "0.01")
+    gestor = GestorFTP()
+    for id_ in ("C1", "C2"):
+        gestor.db.crear_solicitud(id_, "u@x.com", "h:/p", "preparando", {"usuario": "ftp_u_x"})
+
+    async def escenario():
+        orden = []
+        liberar = asyncio.Event()
+
+        async def copia(id_):
+            async with gestor._cupo_rsync(id_, "hostA", {"usuario": "ftp_u_x"}):
+                orden.append(id_)
+                if id_ == "C1":
+                    await liberar.wait()
+
+        t1 = asyncio.create_task(copia("C1"))
+        await asyncio.sleep(0.05)
+        t2 = asyncio.create_task(copia("C2"))
+        await asyncio.sleep(0.05)
+        estado_c2 = gestor.db.obtener_solicitud("C2")
+        liberar.set()
+        await asyncio.gather(t1, t2)
+        return orden, estado_c2
+
+    orden, estado_c2 = asyncio.run(escenario())
+    assert orden == ["C1", "C2"]
+    assert estado_c2["estado"] == "en_cola"
+    assert estado_c2["info"]["posicion_cola"] == 1
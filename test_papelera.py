@@ -0,0 +1,133 @@
+"""
+Papelera: mover a .trash es inmediato y el purgador borra después, retomando
+lo que haya quedado de una ejecución anterior.
+"""
+import asyncio
+import errno
+import fcntl
+import os
+
+import pytest
+
+from papelera import Papelera
+
+
+def _arbol(base, archivos=20, subdirs=3, tamano=100):
+    for d in range(subdirs):
+        sub = base / f"d{d}" / "interno"
+        sub.mkdir(parents=True)
+        for i in range(archivos):
+            (sub / f"f{i}.nc").write_bytes(b"x" * tamano)
+    (base / "raiz.txt").write_bytes(b"x" * tamano)
+    return (archivos * subdirs + 1) * tamano
+
+
+@pytest.fixture
+def papelera(tmp_path):
+    return Papelera(str(tmp_path), hilos=3, intervalo_s=60)
+
+
+def test_mover_es_inmediato_y_purgar_borra_todo(papelera, tmp_path):
+    total = _arbol(tmp_path / "ftp_u_x" / "Q1")
+    papelera.mover(str(tmp_path / "ftp_u_x" / "Q1"))
+    assert not (tmp_path / "ftp_u_x" / "Q1").exists()
+    assert papelera.metricas()["entradas_pendientes"] == 1
+
+    assert papelera.purgar() == total
+    assert papelera.entradas() == []
+    assert papelera.metricas() == {"entradas_pendientes": 0, "bytes_pendientes": 0, "en_cuarentena": 0}
+
+
+def test_otro_proceso_purgando_no_se_pisa(papelera, tmp_path):
+    _arbol(tmp_path / "Q1")
+    papelera.mover(str(tmp_path / "Q1"))
+    fd = os.open(os.path.join(papelera.ruta, ".lock"), os.O_CREAT | os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        # flock es por descripción de archivo abierto: el os.open de purgar() no lo comparte.
+        assert papelera.purgar() == 0
+        assert len(papelera.entradas()) == 1
+    finally:
+        os.close(fd)
+    assert papelera.purgar() > 0
+
+
+def test_errores_se_saltan_y_el_arbol_que_sigue_fallando_va_a_cuarentena(papelera, tmp_path, monkeypatch):
+    total = _arbol(tmp_path / "Q1")
+    _arbol(tmp_path / "Q2")
+    papelera.mover(str(tmp_path / "Q1"))
+    papelera.mover(str(tmp_path / "Q2"))
+    q2 = [n for n in papelera.entradas() if n.endswith("-Q2")][0]
+    unlink = os.unlink
+
+    def unlink_sin_permiso(path, *args, **kwargs):
+        if q2 in str(path) and str(path).endswith("f3.nc"):
+            raise PermissionError(errno.EACCES, "Permission denied", path)
+        return unlink(path, *args, **kwargs)
+    monkeypatch.setattr(os, "unlink", unlink_sin_permiso)
+
+    # Q2 no aborta la pasada: Q1 se borra entero y de Q2 queda sólo lo que falló.
+    assert papelera.purgar() == total + total - 3 * 100
+    assert papelera.entradas() == [q2]
+    restos = [os.path.join(b, f) for b, _, fs in os.walk(os.path.join(papelera.ruta, q2)) for f in fs]
+    assert sorted(os.path.basename(r) for r in restos) == ["f3.nc"] * 3
+
+    papelera.purgar()
+    assert papelera.entradas() == [q2]
+    papelera.purgar()
+    assert papelera.entradas() == []
+    assert os.listdir(papelera.cuarentena) == [q2]
+    assert papelera.metricas()["en_cuarentena"] == 1
+    assert papelera.purgar() == 0
+
+
+def test_arranque_retoma_lo_que_quedo(tmp_path):
+    # Un purgado interrumpido: entrada a medio borrar dentro de .trash.
+    restos = tmp_path / ".trash" / "123-abc-Q1"
+    _arbol(restos)
+    os.unlink(restos / "raiz.txt")
+    papelera = Papelera(str(tmp_path), hilos=2, intervalo_s=60)
+
+    async def escenario():
+        await papelera.iniciar()
+        for _ in range(100):
+            if not papelera.entradas():
+                break
+            await asyncio.sleep(0.02)
+        await papelera.cerrar()
+
+    asyncio.run(escenario())
+    assert papelera.entradas() == []
+
+
+def test_mover_despierta_al_purgador(papelera, tmp_path):
+    async def escenario():
+        await papelera.iniciar()
+        await asyncio.sleep(0.05)
+        _arbol(tmp_path / "Q2")
+        papelera.mover(str(tmp_path / "Q2"))
+        for _ in range(100):
+            if not papelera.entradas():
+                break
+            await asyncio.sleep(0.02)
+        await papelera.cerrar()
+
+    asyncio.run(escenario())
+    assert papelera.entradas() == []
+
+
+def test_otro_sistema_de_archivos_borra_en_el_momento(papelera, tmp_path, monkeypatch):
+    _arbol(tmp_path / "Q3")
+
+    def rename_exdev(origen, destino):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(os, "rename", rename_exdev)
+    papelera.mover(str(tmp_path / "Q3"))
+    assert not (tmp_path / "Q3").exists()
+    assert papelera.entradas() == []
+
+
+def test_contiene(papelera, tmp_path):
+    assert papelera.contiene(str(tmp_path / ".trash"))
+    assert papelera.contiene(str(tmp_path / ".trash" / "x"))
+    assert not papelera.contiene(str(tmp_path / ".trashy"))
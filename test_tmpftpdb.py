@@ -0,0 +1,395 @@
+"""
+TMPFTPdb sobre archivo: conexiones persistentes por hilo y PRAGMAs (WAL).
+Los tests de la lógica de solicitudes en ':memory:' siguen en test_main.py.
+"""
+import sqlite3
+import threading
+
+import pytest
+
+from tmpftpdb import TMPFTPdb
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = TMPFTPdb(db_path=str(tmp_path / "t.db"))
+    yield db
+    db.close()
+
+
+def test_archivo_en_modo_wal(db):
+    with db._get_conn() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+
+
+def test_pragmas_configurables_por_entorno(tmp_path, monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_SQLITE_BUSY_TIMEOUT_MS", "1234")
+    db = TMPFTPdb(db_path=str(tmp_path / "env.db"))
+    with db._get_conn() as conn:
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 1234
+    db.close()
+
+
+def test_una_conexion_por_hilo_reutilizada(db):
+    with db._get_conn() as c1:
+        pass
+    with db._get_conn() as c2:
+        pass
+    assert c1 is c2
+
+    otra = []
+    t = threading.Thread(target=lambda: otra.append(db._conn_hilo()))
+    t.start()
+    t.join()
+    assert otra[0] is not c1
+
+
+def test_fallo_no_deja_transaccion_abierta(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "listo", {"usuario": "ftp_u_x"})
+    with pytest.raises(sqlite3.IntegrityError):
+        db.crear_solicitud("q1", "u@x.com", "h:/p", "listo", {"usuario": "ftp_u_x"})
+    with db._get_conn() as conn:
+        assert not conn.in_transaction
+    db.actualizar_estado("q1", "expirado")
+    assert db.obtener_solicitud("q1")["estado"] == "expirado"
+
+
+def test_close_cierra_todas_las_conexiones(db):
+    with db._get_conn() as conn:
+        pass
+    db.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    # Tras close() la instancia sigue usable: abre conexiones nuevas a demanda.
+    assert db.obtener_solicitud("nada") is None
+
+
+def test_migracion_rellena_columnas_de_filas_antiguas(tmp_path):
+    """Una base creada con el esquema anterior (todo dentro de info_json) queda
+    con created_at/vigencia/expires_at rellenados al abrirla."""
+    import json
+    path = str(tmp_path / "vieja.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE solicitudes (id TEXT PRIMARY KEY, email TEXT, ruta TEXT, estado TEXT, info_json TEXT)")
+    conn.execute("INSERT INTO solicitudes VALUES (?, ?, ?, ?, ?)",
+                 ("q_vieja", "u@x.com", "h:/p", "listo",
+                  json.dumps({"vigencia": 5, "created_at": "2026-01-01T00:00:00+00:00"})))
+    conn.execute("INSERT INTO solicitudes VALUES (?, ?, ?, ?, ?)",
+                 ("q_sin", "u@x.com", "h:/p", "listo", json.dumps({"vigencia": 5})))
+    conn.commit()
+    conn.close()
+
+    db = TMPFTPdb(db_path=path)
+    with db._get_conn() as c:
+        filas = dict((r[0], r[1:]) for r in c.execute(
+            "SELECT id, created_at, vigencia, expires_at FROM solicitudes"))
+    assert filas["q_vieja"] == ("2026-01-01T00:00:00+00:00", 5, "2026-01-06T00:00:00.000000+00:00")
+    assert filas["q_sin"] == (None, 5, None)
+    db.close()
+
+
+def test_obtener_expiradas_usa_el_indice(db):
+    from datetime import datetime, timezone
+    with db._get_conn() as conn:
+        plan = " ".join(str(r) for r in conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM solicitudes "
+            "WHERE estado IN ('listo', 'bloqueado') AND expires_at <= ?",
+            (datetime.now(timezone.utc).isoformat(),)))
+    assert "idx_solicitudes_estado_expires" in plan
+
+
+def test_listar_sin_vencimiento(db):
+    db.crear_solicitud("q_ok", "u@x.com", "h:/p", "listo",
+                       {"vigencia": 5, "created_at": "2026-01-01T00:00:00+00:00"})
+    db.crear_solicitud("q_nunca", "u@x.com", "h:/p", "listo", {"vigencia": 5})
+    ids = [s["id"] for s in db.listar_solicitudes(sin_vencimiento=True)]
+    assert ids == ["q_nunca"]
+
+
+def test_usuarios_con_activas_en_una_consulta(db):
+    db.crear_solicitud("q1", "a@x.com", "h:/p", "listo", {"usuario": "ftp_a_x"})
+    db.crear_solicitud("q2", "b@x.com", "h:/p", "expirado", {"usuario": "ftp_b_x"})
+    db.crear_solicitud("q3", "c@x.com", "h:/p", "bloqueado", {"usuario": "ftp_c_x"})
+    db.crear_solicitud("q4", "d@x.com", "h:/p", "error", {"usuario": "ftp_d_x"})
+    candidatos = ["ftp_a_x", "ftp_b_x", "ftp_c_x", "ftp_d_x", "ftp_nadie_x"]
+    assert db.usuarios_con_activas(candidatos) == {"ftp_a_x", "ftp_c_x"}
+    assert db.usuarios_con_activas([]) == set()
+
+
+def test_migracion_rellena_usuario_en_base_ya_migrada(tmp_path):
+    """Una base con expires_at ya rellenado (esquema 1) recibe la columna
+    usuario y su backfill al subir _ESQUEMA_VERSION."""
+    import json
+    path = str(tmp_path / "v1.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE solicitudes (id TEXT PRIMARY KEY, email TEXT, ruta TEXT, estado TEXT, "
+                 "info_json TEXT, created_at TEXT, vigencia INTEGER, expires_at TEXT)")
+    conn.execute("INSERT INTO solicitudes VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                 ("q1", "u@x.com", "h:/p", "listo", json.dumps({"usuario": "ftp_u_x", "vigencia": 5}),
+                  None, 5, None))
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    db = TMPFTPdb(db_path=path)
+    assert db.usuarios_con_activas(["ftp_u_x"]) == {"ftp_u_x"}
+    db.close()
+
+
+def test_escritura_lenta_no_bloquea_el_event_loop(tmp_path, medir_lag):
+    """Con otro proceso/worker reteniendo el lock de escritura, la escritura
+    vía AsyncTMPFTPdb espera (busy_timeout) en el executor mientras el event
+    loop sigue atendiendo: el retraso máximo de un tick de 10 ms se mantiene
+    muy por debajo de lo que dura la espera."""
+    import asyncio
+    import time
+    from tmpftpdb import AsyncTMPFTPdb
+
+    path = str(tmp_path / "lag.db")
+    adb = AsyncTMPFTPdb(TMPFTPdb(db_path=path))
+    adb.db.crear_solicitud("q1", "u@x.com", "h:/p", "listo", {"usuario": "ftp_u_x"})
+
+    bloqueo = sqlite3.connect(path, check_same_thread=False)
+    bloqueo.execute("BEGIN IMMEDIATE")
+    liberar = threading.Timer(0.5, bloqueo.commit)
+
+    async def escritura():
+        liberar.start()
+        t0 = time.perf_counter()
+        await adb.actualizar_estado("q1", "expirado")
+        return time.perf_counter() - t0
+
+    duracion, lag_max = asyncio.run(medir_lag(escritura(), 0.01))
+    bloqueo.close()
+    assert duracion >= 0.4
+    assert lag_max < 0.1
+    assert adb.db.obtener_solicitud("q1")["estado"] == "expirado"
+    adb.close()
+
+
+# --- Cola de trabajos de copia ---
+
+def test_trabajo_se_encola_con_la_solicitud_y_se_reclama_una_vez(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {"usuario": "ftp_u_x"},
+                       trabajo={"email": "u@x.com", "ruta": "h:/p", "vigencia": 5})
+    t = db.reclamar_trabajo("w1", lease_s=60)
+    assert t["solicitud_id"] == "q1"
+    assert t["payload"]["ruta"] == "h:/p"
+    assert t["intentos"] == 1
+    assert db.reclamar_trabajo("w2", lease_s=60) is None
+
+
+def test_lease_vencido_se_puede_reclamar_de_nuevo(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    t = db.reclamar_trabajo("w1", lease_s=-1)      # lease ya vencido
+    t2 = db.reclamar_trabajo("w2", lease_s=60)
+    assert t2["id"] == t["id"] and t2["intentos"] == 2
+    # w1 perdió el lease: no puede renovarlo ni cerrarlo.
+    assert not db.renovar_lease(t["id"], "w1", 60)
+    assert not db.finalizar_trabajo(t["id"], "w1")
+    assert db.finalizar_trabajo(t["id"], "w2")
+    assert db.reclamar_trabajo("w3", lease_s=60) is None
+
+
+def test_liberar_trabajo_lo_devuelve_a_la_cola(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    t = db.reclamar_trabajo("w1", lease_s=60)
+    assert db.liberar_trabajo(t["id"], "w1")
+    t2 = db.reclamar_trabajo("w2", lease_s=60)
+    assert t2["id"] == t["id"] and t2["intentos"] == 1
+
+
+def test_id_duplicado_no_encola_trabajo(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    with pytest.raises(sqlite3.IntegrityError):
+        db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    db.reclamar_trabajo("w1", lease_s=60)
+    assert db.reclamar_trabajo("w1", lease_s=60) is None
+
+
+def test_cancelar_trabajo_en_curso_libera_su_cupo(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {"usuario": "ftp_u_x"}, trabajo={})
+    db.crear_solicitud("q2", "u@x.com", "h:/p", "recibido", {"usuario": "ftp_u_x"}, trabajo={})
+    t = db.reclamar_trabajo("w1", lease_s=60)
+    db.actualizar_estado("q1", "traslado", {"usuario": "ftp_u_x"})
+    assert db.solicitar_cupo_rsync("q1", "hostA", 60, 4, lambda h: 1) == (True, 0)
+    assert db.solicitar_cupo_rsync("q2", "hostA", 60, 4, lambda h: 1) == (False, 1)
+
+    assert db.cancelar_solicitud("q1", {"usuario": "ftp_u_x", "mensaje": "x"}) == {
+        "estado": "traslado", "trabajo": "en_curso"}
+    assert db.trabajo_cancelado(t["id"])
+    # El cupo pasa al siguiente sin esperar al worker; el lease ya no se renueva.
+    assert db.solicitar_cupo_rsync("q2", "hostA", 60, 4, lambda h: 1) == (True, 0)
+    assert not db.renovar_lease(t["id"], "w1", 60)
+    # La copia que se detiene no puede reescribir el estado.
+    assert not db.actualizar_estado("q1", "listo", {"usuario": "ftp_u_x"})
+    assert db.obtener_solicitud("q1")["estado"] == "cancelado"
+    assert db.usuarios_con_activas(["ftp_u_x"]) == {"ftp_u_x"}     # q2 sigue activa
+    # Ya terminal: no se cancela de nuevo.
+    assert db.cancelar_solicitud("q1", {}) is None
+
+
+def test_cancelar_trabajo_pendiente_no_se_reclama(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    assert db.cancelar_solicitud("q1", {}) == {"estado": "recibido", "trabajo": "pendiente"}
+    assert db.reclamar_trabajo("w1", lease_s=60) is None
+    db.crear_solicitud("q2", "u@x.com", "h:/p", "listo", {})
+    assert db.cancelar_solicitud("q2", {}) is None
+    assert db.cancelar_solicitud("nada", {}) is None
+
+
+def test_recuperar_trabajos_huerfanos_y_solicitudes_sin_trabajo(db):
+    db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={"ruta": "h:/p"})
+    db.crear_solicitud("q2", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    db.reclamar_trabajo("muerto:1", lease_s=600)
+    db.reclamar_trabajo("vivo:2", lease_s=600)
+    # Anterior a la cola de trabajos: en 'traslado' sin trabajo.
+    db.crear_solicitud("q3", "v@x.com", "h:/q", "traslado", {"vigencia": 7})
+    db.crear_solicitud("q4", "v@x.com", "h:/q", "listo", {"vigencia": 7})
+
+    assert db.recuperar_trabajos(lambda owner: owner != "muerto:1") == {"liberados": 1, "reencolados": 1}
+    reclamados = {}
+    while (t := db.reclamar_trabajo("nuevo", lease_s=60)) is not None:
+        reclamados[t["solicitud_id"]] = t
+    assert set(reclamados) == {"q1", "q3"}
+    assert reclamados["q1"]["payload"] == {"ruta": "h:/p"}
+    assert reclamados["q3"]["payload"] == {"email": "v@x.com", "ruta": "h:/q", "vigencia": 7}
+    # Idempotente: todo tiene ya trabajo abierto.
+    assert db.recuperar_trabajos(lambda owner: True) == {"liberados": 0, "reencolados": 0}
+
+
+# --- Admisión de rsync ---
+
+def _pedir(db, sid, host, max_global=4, max_host=1):
+    return db.solicitar_cupo_rsync(sid, host, 60, max_global, lambda h: max_host)
+
+
+def test_cupo_por_host_y_posicion_en_cola(db):
+    assert _pedir(db, "a1", "hostA") == (True, 0)
+    assert _pedir(db, "a2", "hostA") == (False, 1)
+    assert _pedir(db, "a3", "hostA") == (False, 2)
+    # Otro host no queda detrás de los que esperan a hostA.
+    assert _pedir(db, "b1", "hostB") == (True, 0)
+    db.liberar_cupo_rsync("a1")
+    # a3 no se salta a a2: el primero en espera con cupo es a2.
+    assert _pedir(db, "a3", "hostA") == (False, 2)
+    assert _pedir(db, "a2", "hostA") == (True, 0)
+    assert _pedir(db, "a3", "hostA") == (False, 1)
+
+
+def test_cupo_global(db):
+    assert _pedir(db, "a1", "hostA", max_global=1, max_host=5) == (True, 0)
+    assert _pedir(db, "b1", "hostB", max_global=1, max_host=5) == (False, 1)
+
+
+def test_cupo_de_proceso_muerto_vence(db):
+    assert db.solicitar_cupo_rsync("a1", "hostA", -1, 4, lambda h: 1) == (True, 0)
+    assert _pedir(db, "a2", "hostA") == (True, 0)
+
+
+def test_latido_repone_un_cupo_vencido(db):
+    assert db.solicitar_cupo_rsync("a1", "hostA", -1, 4, lambda h: 1) == (True, 0)
+    assert _pedir(db, "b1", "hostB") == (True, 0)   # purga el cupo vencido de a1
+    assert db.renovar_cupo_rsync("a1", "hostA", 60) is False
+    assert db.renovar_cupo_rsync("a1", "hostA", 60) is True
+    # a1 sigue copiando: vuelve a contar contra el límite de hostA.
+    assert _pedir(db, "a2", "hostA") == (False, 1)
+
+
+def test_un_intento_viejo_no_libera_lo_del_nuevo(db):
+    """El trabajo se reclamó de nuevo (intento 1:2) mientras el 1:1 se detenía:
+    la limpieza del viejo no borra el cupo ni la reserva del nuevo."""
+    db.crear_solicitud("a1", "u@x.com", "h:/p", "traslado", {})
+    assert db.solicitar_cupo_rsync("a1", "hostA", 60, 4, lambda h: 1, "1:1") == (True, 0)
+    db.reservar_espacio("a1", 400, 1000, 0, "1:1")
+    assert db.solicitar_cupo_rsync("a1", "hostA", 60, 4, lambda h: 1, "1:2") == (True, 0)
+    db.reservar_espacio("a1", 400, 1000, 0, "1:2")
+    assert db.renovar_cupo_rsync("a1", "hostA", 60, "1:1") is False
+    db.liberar_cupo_rsync("a1", "1:1")
+    db.liberar_reserva("a1", "1:1")
+    assert _pedir(db, "a2", "hostA") == (False, 1)
+    assert db.espacio_reservado() == {"bytes": 400, "reservas": 1}
+    db.liberar_cupo_rsync("a1", "1:2")
+    db.liberar_reserva("a1", "1:2")
+    assert _pedir(db, "a2", "hostA") == (True, 0)
+    assert db.espacio_reservado() == {"bytes": 0, "reservas": 0}
+
+
+# --- Reservas de espacio ---
+
+def test_reservas_descuentan_lo_pendiente_de_otras_copias(db):
+    for sid in ("r1", "r2", "r3"):
+        db.crear_solicitud(sid, "u@x.com", "h:/p", "preparando", {})
+    # 1000 libres, margen 100: caben dos de 400, la tercera no.
+    assert db.reservar_espacio("r1", 400, 1000, 100) == (True, 0)
+    assert db.reservar_espacio("r2", 400, 1000, 100) == (True, 400)
+    assert db.reservar_espacio("r3", 400, 1000, 100) == (False, 800)
+    assert db.espacio_reservado() == {"bytes": 800, "reservas": 2}
+    # r1 ya escribió 300 (el espacio libre ya los descuenta): sólo quedan 100 pendientes.
+    db.ajustar_reserva("r1", 300)
+    db.ajustar_reserva("r1", 200)          # nunca baja
+    assert db.espacio_reservado() == {"bytes": 500, "reservas": 2}
+    db.liberar_reserva("r2")
+    assert db.reservar_espacio("r3", 400, 700, 100) == (True, 100)
+    assert db.espacio_reservado() == {"bytes": 500, "reservas": 2}
+
+
+def test_reservas_de_copias_terminadas_no_cuentan(db):
+    for sid in ("r1", "r2", "r3"):
+        db.crear_solicitud(sid, "u@x.com", "h:/p", "traslado", {}, trabajo={})
+    db.reservar_espacio("r1", 400, 1000, 0)
+    db.reservar_espacio("r2", 400, 1000, 0)
+    # r1 quedó en 'error' sin liberar (worker muerto); r2 se cancela.
+    db.actualizar_estado("r1", "error", {})
+    db.cancelar_solicitud("r2", {})
+    assert db.espacio_reservado() == {"bytes": 0, "reservas": 0}
+    assert db.reservar_espacio("r3", 1000, 1000, 0) == (True, 0)
+    # Re-reservar (reintento) reemplaza la reserva propia en lugar de sumarla.
+    assert db.reservar_espacio("r3", 900, 1000, 0) == (True, 0)
+    with db._get_conn() as conn:
+        assert conn.execute("SELECT solicitud_id FROM reservas_espacio").fetchall() == [("r3",)]
+
+
+# --- Uso por usuario ---
+
+def test_uso_por_usuario_se_mantiene_al_terminar_y_al_borrar(db):
+    for sid in ("u1", "u2", "u3"):
+        db.crear_solicitud(sid, "a@x.com", "h:/p", "listo", {"usuario": "ftp_a"})
+    db.crear_solicitud("v1", "b@x.com", "h:/p", "listo", {"usuario": "ftp_b"})
+    db.registrar_uso("u1", "ftp_a", 100, 3)
+    db.registrar_uso("u2", "ftp_a", 50, 2, compartidos=50)
+    db.registrar_uso("u3", "ftp_a", 10, 1)
+    assert db.registrar_uso("v1", "ftp_b", 500, 9) == {"bytes": 500, "compartidos": 0, "archivos": 9, "solicitudes": 1}
+    # Reintento de la misma solicitud: reemplaza, no suma dos veces.
+    assert db.registrar_uso("u2", "ftp_a", 60, 2, compartidos=20) == {
+        "bytes": 170, "compartidos": 20, "archivos": 6, "solicitudes": 3}
+
+    db.eliminar_solicitud("u1")
+    db.marcar_expiradas(["u2"])
+    assert db.uso_usuario("ftp_a") == {"bytes": 10, "compartidos": 0, "archivos": 1, "solicitudes": 1}
+    assert [(u["usuario"], u["bytes"]) for u in db.listar_uso()] == [("ftp_b", 500), ("ftp_a", 10)]
+    db.descontar_uso(["u3"])
+    assert db.usos_usuarios(["ftp_a", "ftp_b"]) == {
+        "ftp_a": {"bytes": 0, "compartidos": 0, "archivos": 0, "solicitudes": 0},
+        "ftp_b": {"bytes": 500, "compartidos": 0, "archivos": 9, "solicitudes": 1}}
+    db.olvidar_uso_usuario("ftp_b")
+    assert db.listar_uso() == []
+
+
+def test_marcar_expiradas_en_una_transaccion(db, monkeypatch):
+    import tmpftpdb
+    monkeypatch.setattr(tmpftpdb, "_MAX_PARAMS", 2)
+    for i in range(5):
+        db.crear_solicitud(f"q{i}", "u@x.com", "h:/p", "listo", {"usuario": "ftp_u_x"})
+    assert db.marcar_expiradas([f"q{i}" for i in range(4)] + ["nada"]) == 4
+    assert [db.obtener_solicitud(f"q{i}")["estado"] for i in range(5)] == ["expirado"] * 4 + ["listo"]
+
+
+def test_resumen_sondeos_por_host(db):
+    db.registrar_sondeo("lento", "/a", 10, 30.0, True)
+    db.registrar_sondeo("lento", "/b", None, 50.0, False)
+    db.registrar_sondeo("rapido", "/c", 10, 0.5, True)
+    resumen = db.resumen_sondeos()
+    assert [(r["host"], r["sondeos"], r["fallidos"], r["duracion_max_s"]) for r in resumen] == [
+        ("lento", 2, 1, 50.0), ("rapido", 1, 0, 0.5)]
@@ -0,0 +1,170 @@
+"""
+transfer_worker.py: reclama trabajos de la cola SQLite, los ejecuta con
+gestor.procesar_trabajo y los cierra; con la cola vacía espera sin girar.
+El gestor es un doble con la AsyncTMPFTPdb real en memoria.
+"""
+import asyncio
+from unittest.mock import patch
+
+import transfer_worker
+from gestorftpbase import GestorFTPBase
+from tmpftpdb import TMPFTPdb, AsyncTMPFTPdb
+
+
+class _GestorFalso(GestorFTPBase):
+    def __init__(self):
+        self.db = TMPFTPdb(db_path=':memory:')
+        self.adb = AsyncTMPFTPdb(self.db)
+        self.procesados = []
+
+    async def procesar_trabajo(self, trabajo):
+        self.procesados.append(trabajo["solicitud_id"])
+        await self.adb.actualizar_estado(trabajo["solicitud_id"], "listo")
+
+
+def _correr_hasta(gestor, condicion, monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_JOB_POLL_S", "0.01")
+
+    async def escenario():
+        stop = asyncio.Event()
+        tarea = asyncio.create_task(transfer_worker._run(stop))
+        for _ in range(200):
+            if condicion():
+                break
+            await asyncio.sleep(0.01)
+        stop.set()
+        await tarea
+
+    with patch("gestorftpbase.select_gestor", return_value=gestor):
+        asyncio.run(escenario())
+
+
+def test_worker_procesa_y_cierra_los_trabajos(monkeypatch):
+    gestor = _GestorFalso()
+    for i in range(3):
+        gestor.db.crear_solicitud(f"q{i}", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    _correr_hasta(gestor, lambda: len(gestor.procesados) == 3, monkeypatch)
+    assert sorted(gestor.procesados) == ["q0", "q1", "q2"]
+    assert all(gestor.db.obtener_solicitud(f"q{i}")["estado"] == "listo" for i in range(3))
+    assert gestor.db.reclamar_trabajo("otro", 60) is None
+
+
+def test_trabajo_con_demasiados_intentos_se_marca_error(monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_JOB_MAX_INTENTOS", "1")
+    gestor = _GestorFalso()
+    gestor.db.crear_solicitud("q1", "u@x.com", "h:/p", "traslado", {"usuario": "ftp_u_x"}, trabajo={})
+    gestor.db.reclamar_trabajo("muerto", lease_s=-1)   # un worker anterior murió con él
+    _correr_hasta(gestor, lambda: gestor.db.obtener_solicitud("q1")["estado"] == "error", monkeypatch)
+    assert gestor.procesados == []
+    assert gestor.db.obtener_solicitud("q1")["estado"] == "error"
+
+
+class _GestorLento(_GestorFalso):
+    """Copia que no termina sola; registra cancelación y limpieza."""
+    def __init__(self):
+        super().__init__()
+        self.cancelados = []
+        self.limpiadas = []
+
+    async def procesar_trabajo(self, trabajo):
+        await self.adb.actualizar_estado(trabajo["solicitud_id"], "traslado")
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            self.cancelados.append(trabajo["solicitud_id"])
+            raise
+        await self.adb.actualizar_estado(trabajo["solicitud_id"], "listo")
+
+    async def limpiar_cancelada(self, id):
+        self.limpiadas.append(id)
+
+
+def test_cancelacion_detiene_el_trabajo_en_curso(monkeypatch):
+    monkeypatch.setenv("TEMPOFTP_JOB_CANCEL_POLL_S", "0.02")
+    gestor = _GestorLento()
+    gestor.db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+
+    def condicion():
+        if gestor.db.obtener_solicitud("q1")["estado"] == "traslado":
+            gestor.db.cancelar_solicitud("q1", {"mensaje": "cancelada"})
+        return gestor.limpiadas == ["q1"]
+
+    _correr_hasta(gestor, condicion, monkeypatch)
+    assert gestor.cancelados == ["q1"]
+    assert gestor.limpiadas == ["q1"]
+    assert gestor.db.obtener_solicitud("q1")["estado"] == "cancelado"
+    assert gestor.db.reclamar_trabajo("otro", 60) is None
+
+
+def test_lease_perdido_espera_a_que_la_copia_termine_de_cancelarse():
+    class _GestorConLimpieza(_GestorLento):
+        async def procesar_trabajo(self, trabajo):
+            try:
+                await super().procesar_trabajo(trabajo)
+            finally:
+                # Como liberar_reserva/liberar_cupo_rsync: tarda un poco.
+                await asyncio.sleep(0.05)
+                self.limpiadas.append(trabajo["solicitud_id"])
+
+    gestor = _GestorConLimpieza()
+    gestor.db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    trabajo = gestor.db.reclamar_trabajo("yo", 60)
+
+    async def lease_perdido(*args):
+        return False
+
+    gestor.adb.renovar_lease = lease_perdido
+    asyncio.run(transfer_worker._ejecutar_trabajo(gestor, trabajo, "yo", lease_s=0.06, max_intentos=3,
+                                                  cancel_poll_s=0.01))
+    assert gestor.cancelados == ["q1"]
+    assert gestor.limpiadas == ["q1"]
+
+
+def test_errores_pasajeros_de_sqlite_no_abandonan_la_copia():
+    import sqlite3
+
+    class _GestorBreve(_GestorFalso):
+        async def procesar_trabajo(self, trabajo):
+            await asyncio.sleep(0.2)
+            await super().procesar_trabajo(trabajo)
+
+    gestor = _GestorBreve()
+    gestor.db.crear_solicitud("q1", "u@x.com", "h:/p", "recibido", {}, trabajo={})
+    trabajo = gestor.db.reclamar_trabajo("yo", 60)
+    fallos = []
+
+    def una_vez(fn):
+        async def envoltura(*args):
+            if fn.__name__ not in fallos:
+                fallos.append(fn.__name__)
+                raise sqlite3.OperationalError("database is locked")
+            return await fn(*args)
+        return envoltura
+
+    gestor.adb.trabajo_cancelado = una_vez(gestor.adb.trabajo_cancelado)
+    gestor.adb.renovar_lease = una_vez(gestor.adb.renovar_lease)
+    asyncio.run(transfer_worker._ejecutar_trabajo(gestor, trabajo, "yo", lease_s=0.06, max_intentos=3,
+                                                  cancel_poll_s=0.01))
+    assert sorted(fallos) == ["renovar_lease", "trabajo_cancelado"]
+    assert gestor.procesados == ["q1"]
+    assert gestor.db.obtener_solicitud("q1")["estado"] == "listo"
+    assert gestor.db.reclamar_trabajo("otro", 60) is None
+
+
+def test_al_arrancar_retoma_trabajos_de_un_worker_muerto(monkeypatch):
+    import socket
+    gestor = _GestorFalso()
+    gestor.db.crear_solicitud("q1", "u@x.com", "h:/p", "traslado", {}, trabajo={})
+    # El worker anterior (pid inexistente en este host) lo tenía con lease largo.
+    gestor.db.reclamar_trabajo(f"{socket.gethostname()}:999999999", lease_s=3600)
+    _correr_hasta(gestor, lambda: gestor.procesados == ["q1"], monkeypatch)
+    assert gestor.procesados == ["q1"]
+    assert gestor.db.obtener_solicitud("q1")["estado"] == "listo"
+
+
+def test_owner_vivo():
+    import os
+    import socket
+    assert transfer_worker._owner_vivo(transfer_worker._owner())
+    assert not transfer_worker._owner_vivo(f"{socket.gethostname()}:999999999")
+    assert transfer_worker._owner_vivo(f"otro-host-{os.getpid()}:1")
@@ -0,0 +1,115 @@
+"""
+EscanerUso: uso por home con os.scandir, reutilizando los directorios cuyo
+mtime no cambió, sin entrar en .trash; foto servida desde SQLite.
+"""
+import asyncio
+import fcntl
+import os
+import shutil
+
+import pytest
+
+from tmpftpdb import AsyncTMPFTPdb, TMPFTPdb
+from usodisco import EscanerUso
+
+
+def _archivos(directorio, n, tamano):
+    directorio.mkdir(parents=True, exist_ok=True)
+    for i in range(n):
+        (directorio / f"f{i}.nc").write_bytes(b"x" * tamano)
+
+
+@pytest.fixture
+def raiz(tmp_path):
+    _archivos(tmp_path / "ftp_a_x" / "Q1" / "sub", 3, 100)
+    _archivos(tmp_path / "ftp_b_x" / "Q2", 2, 1000)
+    _archivos(tmp_path / ".trash" / "123-abc-Q0", 5, 10_000)
+    (tmp_path / "ftp_c_x").mkdir()
+    (tmp_path / "ftp_c_x" / "Q3").symlink_to(tmp_path / ".trash")
+    (tmp_path / "otro").mkdir()
+    return tmp_path
+
+
+def test_uso_por_home_sin_papelera_ni_enlaces(raiz):
+    filas = EscanerUso(str(raiz), intervalo_s=0).escanear()
+    assert filas == [
+        {"usuario": "ftp_a_x", "bytes": 300, "archivos": 3, "directorios": 3},
+        {"usuario": "ftp_b_x", "bytes": 2000, "archivos": 2, "directorios": 2},
+        # El enlace cuenta como una entrada: no se sigue.
+        {"usuario": "ftp_c_x", "bytes": os.lstat(raiz / "ftp_c_x" / "Q3").st_size, "archivos": 1,
+         "directorios": 1},
+    ]
+
+
+def test_directorios_sin_cambios_no_se_releen(raiz, monkeypatch):
+    escaner = EscanerUso(str(raiz), intervalo_s=0, pasada_completa=3)
+    escaner.escanear()
+    assert escaner.stats == {"leidos": 6, "reusados": 0}
+
+    listados = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda ruta: listados.append(str(ruta)) or scandir(ruta))
+    _archivos(raiz / "ftp_a_x" / "Q1" / "sub", 4, 100)      # f3 nuevo: cambia el mtime de sub
+    filas = escaner.escanear()
+    assert escaner.stats == {"leidos": 1, "reusados": 5}
+    # Sólo /data (para listar homes) y el directorio que cambió.
+    assert listados == [str(raiz), str(raiz / "ftp_a_x" / "Q1" / "sub")]
+    assert filas[0]["bytes"] == 400
+
+    # Solicitud borrada: el padre cambia y el árbol sale de la caché.
+    shutil.rmtree(raiz / "ftp_b_x" / "Q2")
+    filas = escaner.escanear()
+    assert escaner.stats == {"leidos": 1, "reusados": 4}
+    assert filas[1] == {"usuario": "ftp_b_x", "bytes": 0, "archivos": 0, "directorios": 1}
+    assert not any("Q2" in ruta for ruta in escaner._cache)
+    # Cada pasada_completa pasadas se relee todo igual.
+    escaner.escanear()
+    assert escaner.stats == {"leidos": 5, "reusados": 0}
+
+
+def test_otro_proceso_escaneando_no_se_pisa(raiz):
+    escaner = EscanerUso(str(raiz), intervalo_s=0)
+    fd = os.open(raiz / ".uso.lock", os.O_CREAT | os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        assert escaner.escanear() is None
+    finally:
+        os.close(fd)
+    assert escaner.escanear() is not None
+
+
+def test_foto_en_sqlite_ordenada_y_en_segundo_plano(raiz):
+    """Las pasadas corren en un único hilo de baja prioridad que sólo recorre;
+    la foto se guarda por la fachada async, sin abrir conexiones por pasada."""
+    import threading
+    db = TMPFTPdb(db_path=str(raiz / "t.db"))
+    adb = AsyncTMPFTPdb(db, max_workers=1)
+    assert db.escaneo_uso() == {"escaneo": None, "bytes_total": 0, "homes": []}
+    db.crear_solicitud("Q2", "b@x.com", "h:/p", "listo", {"usuario": "ftp_b_x"})
+    db.registrar_uso("Q2", "ftp_b_x", 1500, 2)
+    escaner = EscanerUso(str(raiz), guardar=adb.guardar_escaneo_uso, intervalo_s=0.01)
+    guardar, pasadas, hilos = escaner.guardar, [], set()
+
+    async def contar(*args):
+        hilos.update(t.ident for t in threading.enumerate() if t.name.startswith("uso-disco"))
+        pasadas.append(args)
+        await guardar(*args)
+    escaner.guardar = contar
+
+    async def escenario():
+        await escaner.iniciar()
+        for _ in range(200):
+            if len(pasadas) >= 5:
+                break
+            await asyncio.sleep(0.02)
+        await escaner.cerrar()
+
+    asyncio.run(escenario())
+    assert len(pasadas) >= 5 and len(hilos) == 1
+    # La conexión del hilo principal y la del executor de la fachada: nada más.
+    assert len(db._conns) == 2
+    foto = db.escaneo_uso()
+    assert foto["escaneo"]["leidos"] + foto["escaneo"]["reusados"] == 6
+    assert foto["bytes_total"] == sum(h["bytes"] for h in foto["homes"])
+    assert [(h["usuario"], h["bytes_registrados"]) for h in foto["homes"]][:2] == [("ftp_b_x", 1500), ("ftp_a_x", 0)]
+    adb.close()
@@ -1,19 +1,204 @@
 import sqlite3
+import asyncio
+import functools
 import json
 import os
-from typing import Optional
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 from contextlib import contextmanager
 
+
+# PRAGMAs aplicados a cada conexión de archivo. WAL deja que los lectores (los
+# GET /tmpftp/{id} de los pollers) no esperen a los escritores y viceversa;
+# synchronous=NORMAL es seguro con WAL (sólo arriesga la última transacción
+# ante un corte de luz, nunca corrompe). busy_timeout evita el "database is
+# locked" inmediato cuando dos workers de uvicorn escriben a la vez.
+_DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,          # ms
+    "cache_size": -16000,          # negativo = KiB (≈16 MiB por conexión)
+    "mmap_size": 268435456,        # 256 MiB
+    "temp_store": "MEMORY",
+}
+
+_PRAGMA_ENV = {
+    "busy_timeout": "TEMPOFTP_SQLITE_BUSY_TIMEOUT_MS",
+    "cache_size": "TEMPOFTP_SQLITE_CACHE_SIZE",
+    "mmap_size": "TEMPOFTP_SQLITE_MMAP_SIZE",
+    "synchronous": "TEMPOFTP_SQLITE_SYNCHRONOUS",
+}
+
+
+def _pragmas_configurados() -> dict:
+    """_DEFAULT_PRAGMAS con los overrides de entorno (TEMPOFTP_SQLITE_*)."""
+    pragmas = dict(_DEFAULT_PRAGMAS)
+    for nombre, var in _PRAGMA_ENV.items():
+        valor = os.getenv(var)
+        if valor:
+            pragmas[nombre] = valor.strip()
+    return pragmas
+
+
+# Columnas promovidas desde info_json para poder filtrar e indexar sin
+# decodificar el JSON de cada fila. info_json sigue siendo la fuente completa;
+# estas columnas se mantienen en cada escritura que trae `info`.
+_COLUMNAS_PROMOVIDAS = (
+    ("created_at", "TEXT"),
+    ("vigencia", "INTEGER"),
+    ("expires_at", "TEXT"),
+    ("usuario", "TEXT"),
+)
+
+# Columnas agregadas a tablas que ya existían: (tabla, columna, tipo).
+_COLUMNAS_AGREGADAS = (
+    ("uso_solicitudes", "compartidos", "INTEGER NOT NULL DEFAULT 0"),
+    ("uso_usuarios", "compartidos", "INTEGER NOT NULL DEFAULT 0"),
+    ("cupos_rsync", "intento", "TEXT"),
+    ("reservas_espacio", "intento", "TEXT"),
+)
+
+_INDICES = (
+    "CREATE INDEX IF NOT EXISTS idx_solicitudes_estado_expires ON solicitudes (estado, expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_solicitudes_usuario_estado ON solicitudes (usuario, estado)",
+    "CREATE INDEX IF NOT EXISTS idx_trabajos_estado_lease ON trabajos (estado, lease_until)",
+    "CREATE INDEX IF NOT EXISTS idx_sondeos_tamano_ts ON sondeos_tamano (ts)",
+    "CREATE INDEX IF NOT EXISTS idx_contenido_origen ON contenido_preparado (host, ruta, huella)",
+)
+
+# Días que se conservan los registros de sondeos de tamaño (du remoto).
+_SONDEOS_RETENCION_DIAS = 30
+
+# Versión del esquema (PRAGMA user_version). Se incrementa cada vez que se
+# agrega una columna promovida, para que el backfill vuelva a recorrer la
+# tabla una única vez y rellene la nueva columna en las filas existentes.
+_ESQUEMA_VERSION = 2
+
+# Estados en los que una solicitud ya no retiene al usuario FTP.
+_ESTADOS_TERMINALES = ('expirado', 'error', 'cancelado')
+_MARCAS_TERMINALES = ", ".join("?" * len(_ESTADOS_TERMINALES))
+
+# Estados de una solicitud cuya copia aún no termina (DELETE la cancela).
+_ESTADOS_EN_CURSO = ('recibido', 'en_cola', 'preparando', 'traslado')
+_MARCAS_EN_CURSO = ", ".join("?" * len(_ESTADOS_EN_CURSO))
+
+# Bytes reservados y aún no escritos de las copias en curso (reservas_espacio).
+_PENDIENTE_RESERVAS = (
+    "SELECT COALESCE(SUM(MAX(r.bytes - r.escritos, 0)), 0) FROM reservas_espacio r "
+    f"JOIN solicitudes s ON s.id = r.solicitud_id WHERE s.estado IN ({_MARCAS_EN_CURSO})"
+)
+
+# Límite de parámetros por sentencia (SQLITE_MAX_VARIABLE_NUMBER es 999 en
+# builds antiguos de SQLite); las consultas IN (...) se parten en trozos.
+_MAX_PARAMS = 900
+
+# Tamaño de lote del backfill: cada lote es su propia transacción corta, para
+# no retener el lock de escritura mientras otro worker atiende requests.
+_BACKFILL_LOTE = 500
+
+
+def _iso_utc(dt: datetime) -> str:
+    """ISO-8601 UTC de ancho fijo (con microsegundos), comparable como texto."""
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def _columnas_expiracion(info: dict) -> Tuple[Optional[str], Optional[int], Optional[str]]:
+    """
+    (created_at, vigencia, expires_at) a partir de info. expires_at queda en
+    None si falta created_at/vigencia o no se pueden interpretar: son justo las
+    solicitudes que nunca vencen y que GET /tmpftp?sin_vencimiento=true lista.
+    """
+    created_at = info.get("created_at")
+    vigencia = info.get("vigencia")
+    try:
+        vigencia = int(vigencia) if vigencia is not None else None
+    except (ValueError, TypeError):
+        vigencia = None
+    expires_at = None
+    if created_at and vigencia is not None:
+        try:
+            creado = datetime.fromisoformat(created_at)
+            if creado.tzinfo is None:
+                creado = creado.replace(tzinfo=timezone.utc)
+            expires_at = _iso_utc(creado + timedelta(days=vigencia))
+        except (ValueError, TypeError, OverflowError):
+            expires_at = None
+    return created_at, vigencia, expires_at
+
+
+def _columnas_promovidas(info: dict) -> tuple:
+    """Valores de _COLUMNAS_PROMOVIDAS, en el mismo orden, a partir de info."""
+    return (*_columnas_expiracion(info), info.get("usuario"))
+
+
+_SET_PROMOVIDAS = ", ".join(f"{nombre} = ?" for nombre, _ in _COLUMNAS_PROMOVIDAS)
+
+
 class TMPFTPdb:
+    """
+    Acceso a la tabla de solicitudes en SQLite.
+
+    Las conexiones de archivo son de larga vida: una por hilo (threading.local),
+    abierta la primera vez que ese hilo la pide y reutilizada después. Antes se
+    abría y cerraba una conexión por sentencia, y con --workers 4 y pollers cada
+    10 s ese connect/close dominaba el costo de cada GET. Con ':memory:' hay una
+    única conexión compartida (cada connect a ':memory:' sería otra base),
+    serializada con un lock.
+    """
+
     @contextmanager
     def _get_conn(self):
-        """Provee una conexión a la BD y se encarga de cerrarla."""
-        conn = self._memory_conn if self._memory_conn else sqlite3.connect(self.db_path, check_same_thread=False)
+        """Provee la conexión del hilo actual (o la compartida en ':memory:')."""
+        if self._memory_conn is not None:
+            with self._memory_lock:
+                yield from self._con_rollback(self._memory_conn)
+            return
+        yield from self._con_rollback(self._conn_hilo())
+
+    @staticmethod
+    def _con_rollback(conn: sqlite3.Connection):
+        # La conexión sobrevive a la sentencia: si ésta falla (p. ej. el INSERT
+        # de un id duplicado) no puede quedar una transacción abierta a medias
+        # para la siguiente llamada del mismo hilo.
         try:
             yield conn
-        finally:
-            if not self._memory_conn:
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _conn_hilo(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        # Una conexión heredada por fork no es utilizable en el hijo: se reabre.
+        if conn is not None and getattr(self._local, "pid", None) == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._aplicar_pragmas(conn)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    def _aplicar_pragmas(self, conn: sqlite3.Connection) -> None:
+        for nombre, valor in self._pragmas.items():
+            conn.execute(f"PRAGMA {nombre}={valor}")
+
+    def close(self) -> None:
+        """Cierra todas las conexiones abiertas por esta instancia (todos los hilos)."""
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            try:
                 conn.close()
+            except sqlite3.ProgrammingError:
+                pass
+        self._local = threading.local()
+        if self._memory_conn is not None:
+            self._memory_conn.close()
+            self._memory_conn = None
 
     def _init_db(self):
         with self._get_conn() as conn:
@@ -27,7 +212,157 @@ class TMPFTPdb:
                     info_json TEXT
                 )
             ''')
+            existentes = {r[1] for r in cursor.execute("PRAGMA table_info(solicitudes)")}
+            for nombre, tipo in _COLUMNAS_PROMOVIDAS:
+                if nombre in existentes:
+                    continue
+                try:
+                    cursor.execute(f"ALTER TABLE solicitudes ADD COLUMN {nombre} {tipo}")
+                except sqlite3.OperationalError as e:
+                    # Otro worker arrancando a la vez ya la agregó.
+                    if "duplicate column" not in str(e):
+                        raise
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS trabajos (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    solicitud_id TEXT NOT NULL UNIQUE,
+                    payload_json TEXT,
+                    estado TEXT NOT NULL,
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_until REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS cupos_rsync (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    solicitud_id TEXT NOT NULL UNIQUE,
+                    host TEXT NOT NULL,
+                    estado TEXT NOT NULL,
+                    lease_until REAL NOT NULL,
+                    intento TEXT
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sondeos_tamano (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    host TEXT NOT NULL,
+                    ruta TEXT NOT NULL,
+                    bytes INTEGER,
+                    duracion_s REAL NOT NULL,
+                    ok INTEGER NOT NULL,
+                    ts REAL NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS contenido_preparado (
+                    destino TEXT PRIMARY KEY,
+                    host TEXT NOT NULL,
+                    ruta TEXT NOT NULL,
+                    huella TEXT NOT NULL,
+                    bytes INTEGER,
+                    solicitud_id TEXT NOT NULL,
+                    ts REAL NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS reservas_espacio (
+                    solicitud_id TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    escritos INTEGER NOT NULL DEFAULT 0,
+                    ts REAL NOT NULL,
+                    intento TEXT
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS uso_solicitudes (
+                    solicitud_id TEXT PRIMARY KEY,
+                    usuario TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    archivos INTEGER NOT NULL,
+                    ts REAL NOT NULL,
+                    compartidos INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS uso_usuarios (
+                    usuario TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    archivos INTEGER NOT NULL,
+                    solicitudes INTEGER NOT NULL,
+                    actualizado REAL NOT NULL,
+                    compartidos INTEGER NOT NULL DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS uso_escaneo (
+                    usuario TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL,
+                    archivos INTEGER NOT NULL,
+                    directorios INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS escaneos_uso (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    ts REAL NOT NULL,
+                    duracion_s REAL NOT NULL,
+                    leidos INTEGER NOT NULL,
+                    reusados INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS contadores (
+                    nombre TEXT PRIMARY KEY,
+                    valor INTEGER NOT NULL
+                )
+            ''')
+            for tabla, nombre, tipo in _COLUMNAS_AGREGADAS:
+                if nombre in {r[1] for r in cursor.execute(f"PRAGMA table_info({tabla})")}:
+                    continue
+                try:
+                    cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}")
+                except sqlite3.OperationalError as e:
+                    if "duplicate column" not in str(e):
+                        raise
+            for ddl in _INDICES:
+                cursor.execute(ddl)
             conn.commit()
+        self._backfill_columnas()
+
+    def _backfill_columnas(self) -> None:
+        """
+        Migración en línea: rellena las columnas promovidas de filas creadas
+        antes de que existieran. Sólo corre si PRAGMA user_version es menor que
+        _ESQUEMA_VERSION; avanza por rowid en lotes cortos (una transacción por
+        lote) y recalcula desde info_json, así que es idempotente aunque dos
+        workers arranquen a la vez.
+        """
+        with self._get_conn() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= _ESQUEMA_VERSION:
+                return
+        ultimo = 0
+        while True:
+            with self._get_conn() as conn:
+                rows = conn.execute(
+                    "SELECT rowid, info_json FROM solicitudes "
+                    "WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                    (ultimo, _BACKFILL_LOTE),
+                ).fetchall()
+                if not rows:
+                    conn.execute(f"PRAGMA user_version = {_ESQUEMA_VERSION}")
+                    conn.commit()
+                    return
+                cambios = [
+                    (*_columnas_promovidas(json.loads(info_json) if info_json else {}), rowid)
+                    for rowid, info_json in rows
+                ]
+                conn.executemany(f"UPDATE solicitudes SET {_SET_PROMOVIDAS} WHERE rowid = ?", cambios)
+                conn.commit()
+                ultimo = rows[-1][0]
+
     def __init__(self, db_path: str = None):
         # Si se usa ':memory:', mantener la conexión viva para toda la instancia
         self._memory_conn = None
@@ -37,34 +372,72 @@ class TMPFTPdb:
             self.db_path = "tempoftp_simulacro.db"
         else:
             self.db_path = "tempoftp.db"
+        self._pragmas = _pragmas_configurados()
+        self._local = threading.local()
+        self._conns: list = []
+        self._conns_lock = threading.Lock()
+        self._memory_lock = threading.RLock()
         if self.db_path == ':memory:':
             self._memory_conn = sqlite3.connect(':memory:', check_same_thread=False)
         self._init_db()
 
 
-    def crear_solicitud(self, id: str, email: str, ruta: str, estado: str, info: dict):
+    def crear_solicitud(self, id: str, email: str, ruta: str, estado: str, info: dict,
+                        trabajo: Optional[dict] = None):
+        """Inserta la solicitud. Si se pasa `trabajo`, encola en la misma
+        transacción el trabajo de copia que la procesará (ver reclamar_trabajo):
+        o quedan las dos filas o ninguna, así que no hay solicitudes huérfanas
+        en 'recibido' sin nadie que las atienda."""
         with self._get_conn() as conn:
             info_json = json.dumps(info)
+            promovidas = _columnas_promovidas(info)
+            columnas = ", ".join(nombre for nombre, _ in _COLUMNAS_PROMOVIDAS)
+            marcas = ", ".join("?" * len(promovidas))
             # Cambiamos a INSERT para que falle si el ID ya existe,
             # permitiendo que la lógica de negocio maneje el error de duplicado.
             conn.execute(
-                'INSERT INTO solicitudes (id, email, ruta, estado, info_json) VALUES (?, ?, ?, ?, ?)',
-                (id, email, ruta, estado, info_json)
+                f'INSERT INTO solicitudes (id, email, ruta, estado, info_json, {columnas}) '
+                f'VALUES (?, ?, ?, ?, ?, {marcas})',
+                (id, email, ruta, estado, info_json, *promovidas)
             )
+            if trabajo is not None:
+                ahora = time.time()
+                conn.execute(
+                    "INSERT INTO trabajos (solicitud_id, payload_json, estado, created_at, updated_at) "
+                    "VALUES (?, ?, 'pendiente', ?, ?)",
+                    (id, json.dumps(trabajo), ahora, ahora)
+                )
             conn.commit()
 
-    def actualizar_estado(self, id: str, estado: str, info: Optional[dict] = None):
+    def actualizar_estado(self, id: str, estado: str, info: Optional[dict] = None) -> bool:
+        """Cambia estado (e info). Una solicitud 'cancelado' no se reescribe: la
+        copia que se está deteniendo no puede dejarla en 'listo' o 'error'.
+        Devuelve False si no se actualizó."""
         with self._get_conn() as conn:
             if info is not None:
                 info_json = json.dumps(info)
-                conn.execute('''
-                    UPDATE solicitudes SET estado = ?, info_json = ? WHERE id = ?
-                ''', (estado, info_json, id))
+                cur = conn.execute(
+                    f"UPDATE solicitudes SET estado = ?, info_json = ?, {_SET_PROMOVIDAS} "
+                    f"WHERE id = ? AND estado IS NOT 'cancelado'",
+                    (estado, info_json, *_columnas_promovidas(info), id)
+                )
             else:
-                conn.execute('''
-                    UPDATE solicitudes SET estado = ? WHERE id = ?
+                cur = conn.execute('''
+                    UPDATE solicitudes SET estado = ? WHERE id = ? AND estado IS NOT 'cancelado'
                 ''', (estado, id))
             conn.commit()
+            return cur.rowcount == 1
+
+    def actualizar_info_si_estado(self, id: str, estado: str, info: dict) -> bool:
+        """Reemplaza info sólo si la solicitud sigue en `estado`. Para escrituras
+        de fondo (progreso) que no deben revertir una transición posterior."""
+        with self._get_conn() as conn:
+            cur = conn.execute(
+                f'UPDATE solicitudes SET info_json = ?, {_SET_PROMOVIDAS} WHERE id = ? AND estado = ?',
+                (json.dumps(info), *_columnas_promovidas(info), id, estado)
+            )
+            conn.commit()
+            return cur.rowcount == 1
 
     def obtener_solicitud(self, id: str) -> Optional[dict]:
         with self._get_conn() as conn:
@@ -81,7 +454,8 @@ class TMPFTPdb:
                 }
             return None
 
-    def listar_solicitudes(self, estado: Optional[str] = None, limite: int = 500) -> list:
+    def listar_solicitudes(self, estado: Optional[str] = None, limite: int = 500,
+                           sin_vencimiento: bool = False) -> list:
         """Lista solicitudes para inventario y reconciliación.
 
         Devuelve sólo lo necesario para identificar y auditar una cuenta: id,
@@ -90,33 +464,38 @@ class TMPFTPdb:
         credenciales es otra cosa. Quien necesite una concreta sigue pidiendo
         /tmpftp/{id}.
 
-        created_at y vigencia viven dentro de info_json, no como columnas; salen
-        en None cuando faltan, que es justo el caso que interesa detectar: sin
-        created_at, obtener_expiradas() no las ve y la cuenta no vence nunca.
+        created_at y vigencia salen en None cuando faltan, que es justo el caso
+        que interesa detectar: sin ellos no hay expires_at, obtener_expiradas()
+        no las ve y la cuenta no vence nunca. Con sin_vencimiento=True se
+        listan sólo ésas (expires_at IS NULL).
         """
-        sql = 'SELECT id, email, ruta, estado, info_json FROM solicitudes'
+        sql = 'SELECT id, email, ruta, estado, created_at, vigencia FROM solicitudes'
+        condiciones = []
         params = []
         if estado:
-            sql += ' WHERE estado = ?'
+            condiciones.append('estado = ?')
             params.append(estado)
+        if sin_vencimiento:
+            condiciones.append('expires_at IS NULL')
+        if condiciones:
+            sql += ' WHERE ' + ' AND '.join(condiciones)
         sql += ' ORDER BY rowid LIMIT ?'
         params.append(int(limite))
 
         with self._get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(sql, params)
-            solicitudes = []
-            for row in cursor.fetchall():
-                info = json.loads(row[4]) if row[4] else {}
-                solicitudes.append({
+            return [
+                {
                     "id": row[0],
                     "email": row[1],
                     "ruta": row[2],
                     "estado": row[3],
-                    "created_at": info.get("created_at"),
-                    "vigencia": info.get("vigencia"),
-                })
-            return solicitudes
+                    "created_at": row[4],
+                    "vigencia": row[5],
+                }
+                for row in cursor.fetchall()
+            ]
 
     def obtener_password_cifrada_por_email(self, email: str) -> Optional[str]:
         """Devuelve la contraseña cifrada más reciente de un email con estado 'listo'."""
@@ -135,13 +514,32 @@ class TMPFTPdb:
     def eliminar_solicitud(self, id: str):
         with self._get_conn() as conn:
             conn.execute('DELETE FROM solicitudes WHERE id = ?', (id,))
+            conn.execute('DELETE FROM contenido_preparado WHERE solicitud_id = ?', (id,))
+            conn.execute('DELETE FROM reservas_espacio WHERE solicitud_id = ?', (id,))
+            self._descontar_uso(conn, [id])
             conn.commit()
 
-    def marcar_expirada(self, id: str) -> None:
-        """Marca una solicitud como expirada sin eliminar el registro histórico."""
+    def marcar_expiradas(self, ids) -> int:
+        """Marca como expiradas todas las solicitudes dadas en una sola
+        transacción (un UPDATE por cada _MAX_PARAMS ids). Devuelve cuántas filas
+        cambiaron. eliminar_expiradas la llama por lotes en lugar de un commit
+        por solicitud."""
+        ids = list(ids)
+        total = 0
         with self._get_conn() as conn:
-            conn.execute("UPDATE solicitudes SET estado = 'expirado' WHERE id = ?", (id,))
+            for i in range(0, len(ids), _MAX_PARAMS):
+                trozo = ids[i:i + _MAX_PARAMS]
+                marcas = ', '.join('?' * len(trozo))
+                cursor = conn.execute(
+                    f"UPDATE solicitudes SET estado = 'expirado' WHERE id IN ({marcas})",
+                    trozo,
+                )
+                total += cursor.rowcount
+                # Sus árboles van a la papelera: ya no sirven para reuso.
+                conn.execute(f"DELETE FROM contenido_preparado WHERE solicitud_id IN ({marcas})", trozo)
+                self._descontar_uso(conn, trozo)
             conn.commit()
+        return total
 
     def obtener_expiradas(self, now_utc) -> list:
         """
@@ -151,58 +549,671 @@ class TMPFTPdb:
         expirar por su vigencia original (el bloqueo solo deshabilita el login
         antes de tiempo; no extiende ni cancela la retención). Dentro de la
         vigencia sigue siendo reactivable vía desbloquear_solicitud.
-        Requiere que info_json contenga 'created_at' (ISO datetime) y 'vigencia' (días).
-        Las solicitudes sin 'created_at' se omiten silenciosamente.
+        Es una sola consulta por rango sobre idx_solicitudes_estado_expires;
+        las solicitudes sin expires_at (sin 'created_at'/'vigencia' válidos)
+        no vencen y se omiten.
         """
-        from datetime import datetime, timezone, timedelta
-        result = []
         with self._get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT id, email, ruta, estado, info_json FROM solicitudes "
-                "WHERE estado IN ('listo', 'bloqueado')"
+                "WHERE estado IN ('listo', 'bloqueado') AND expires_at <= ?",
+                (_iso_utc(now_utc),),
             )
             rows = cursor.fetchall()
-        for row in rows:
-            info = json.loads(row[4]) if row[4] else {}
-            created_at_str = info.get('created_at')
-            vigencia = info.get('vigencia')
-            if not created_at_str or vigencia is None:
-                continue
-            try:
-                created_at = datetime.fromisoformat(created_at_str)
-                if created_at.tzinfo is None:
-                    created_at = created_at.replace(tzinfo=timezone.utc)
-                expiry = created_at + timedelta(days=int(vigencia))
-                if now_utc >= expiry:
-                    result.append({
-                        "id": row[0],
-                        "email": row[1],
-                        "ruta": row[2],
-                        "estado": row[3],
-                        "info": info,
-                    })
-            except (ValueError, TypeError):
-                continue
-        return result
-
-    def obtener_activas_por_usuario(self, usuario: str) -> list:
-        """
-        Devuelve solicitudes que NO están en estado terminal ('expirado', 'error')
-        y cuyo info_json.usuario coincide con el username FTP dado.
-        """
-        estados_terminales = ('expirado', 'error')
-        result = []
+        return [
+            {
+                "id": row[0],
+                "email": row[1],
+                "ruta": row[2],
+                "estado": row[3],
+                "info": json.loads(row[4]) if row[4] else {},
+            }
+            for row in rows
+        ]
+
+    def usuarios_con_activas(self, usuarios) -> set:
+        """
+        De los usernames FTP dados, devuelve el subconjunto que todavía tiene
+        alguna solicitud no terminal. Una consulta por cada _MAX_PARAMS
+        usuarios (en la práctica, un solo viaje), en lugar de una consulta
+        por usuario.
+        """
+        usuarios = list(dict.fromkeys(u for u in usuarios if u))
+        activos = set()
         with self._get_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, email, ruta, estado, info_json FROM solicitudes "
-                "WHERE estado NOT IN (?, ?)",
-                estados_terminales,
+            for i in range(0, len(usuarios), _MAX_PARAMS):
+                trozo = usuarios[i:i + _MAX_PARAMS]
+                marcas = ", ".join("?" * len(trozo))
+                cursor = conn.execute(
+                    f"SELECT DISTINCT usuario FROM solicitudes "
+                    f"WHERE usuario IN ({marcas}) AND estado NOT IN ({_MARCAS_TERMINALES})",
+                    (*trozo, *_ESTADOS_TERMINALES),
+                )
+                activos.update(row[0] for row in cursor)
+        return activos
+
+
+    # --- Cola de trabajos de copia -------------------------------------------
+    #
+    # Estados: 'pendiente' -> 'en_curso' (con lease) -> 'hecho' | 'fallido',
+    # o 'cancelado' desde cualquiera de los dos primeros (DELETE /tmpftp/{id}).
+    # Un trabajo 'en_curso' cuyo lease venció (el worker murió o se reinició
+    # sin liberarlo) vuelve a ser reclamable. `intentos` cuenta reclamos, para
+    # no reintentar indefinidamente una copia que tumba al worker.
+
+    def reclamar_trabajo(self, owner: str, lease_s: float) -> Optional[dict]:
+        """
+        Reclama atómicamente el trabajo más antiguo disponible (pendiente o con
+        lease vencido) para `owner` durante `lease_s` segundos. BEGIN IMMEDIATE
+        toma el lock de escritura antes del SELECT, así que dos workers nunca
+        reclaman el mismo trabajo. Devuelve None si no hay nada que hacer.
+        """
+        ahora = time.time()
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, solicitud_id, payload_json, intentos FROM trabajos "
+                "WHERE estado = 'pendiente' OR (estado = 'en_curso' AND lease_until < ?) "
+                "ORDER BY id LIMIT 1",
+                (ahora,)
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE trabajos SET estado = 'en_curso', intentos = intentos + 1, "
+                "lease_owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                (owner, ahora + lease_s, ahora, row[0])
             )
-            rows = cursor.fetchall()
-        for row in rows:
-            info = json.loads(row[4]) if row[4] else {}
-            if info.get('usuario') == usuario:
-                result.append({"id": row[0], "estado": row[3], "info": info})
-        return result
\ No newline at end of file
+            conn.commit()
+        return {
+            "id": row[0],
+            "solicitud_id": row[1],
+            "payload": json.loads(row[2]) if row[2] else {},
+            "intentos": row[3] + 1,
+        }
+
+    def renovar_lease(self, trabajo_id: int, owner: str, lease_s: float) -> bool:
+        """Extiende el lease si `owner` aún lo tiene. False = lo perdió (otro
+        worker lo reclamó tras vencer) y debe abandonar el trabajo."""
+        ahora = time.time()
+        with self._get_conn() as conn:
+            cur = conn.execute(
+                "UPDATE trabajos SET lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND estado = 'en_curso'",
+                (ahora + lease_s, ahora, trabajo_id, owner)
+            )
+            conn.commit()
+            return cur.rowcount == 1
+
+    def finalizar_trabajo(self, trabajo_id: int, owner: str, estado: str = 'hecho') -> bool:
+        """Cierra el trabajo ('hecho' o 'fallido') si `owner` aún tiene el lease."""
+        with self._get_conn() as conn:
+            cur = conn.execute(
+                "UPDATE trabajos SET estado = ?, lease_owner = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND estado = 'en_curso'",
+                (estado, time.time(), trabajo_id, owner)
+            )
+            conn.commit()
+            return cur.rowcount == 1
+
+    def liberar_trabajo(self, trabajo_id: int, owner: str) -> bool:
+        """Devuelve el trabajo a 'pendiente' sin esperar a que venza el lease
+        (apagado ordenado del worker): otro lo retoma de inmediato."""
+        with self._get_conn() as conn:
+            cur = conn.execute(
+                "UPDATE trabajos SET estado = 'pendiente', intentos = MAX(intentos - 1, 0), "
+                "lease_owner = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND estado = 'en_curso'",
+                (time.time(), trabajo_id, owner)
+            )
+            conn.commit()
+            return cur.rowcount == 1
+
+    def recuperar_trabajos(self, owner_vivo) -> Dict[str, int]:
+        """
+        Recuperación al arrancar el worker de transferencias, en una
+        transacción:
+
+        - Los trabajos 'en_curso' cuyo dueño ya no corre (`owner_vivo(owner)`
+          devuelve False: el worker anterior murió sin liberarlos) vuelven a
+          'pendiente' en el acto, sin esperar a que venza su lease.
+        - Las solicitudes que siguen en _ESTADOS_EN_CURSO sin trabajo abierto
+          (creadas antes de la cola, o cuyo trabajo se cerró sin llevarlas a un
+          estado terminal) se encolan de nuevo con su email, ruta y vigencia.
+
+        Devuelve {"liberados": n, "reencolados": m}.
+        """
+        ahora = time.time()
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            huerfanos = [
+                id_ for id_, owner in conn.execute(
+                    "SELECT id, lease_owner FROM trabajos WHERE estado = 'en_curso'")
+                if not owner_vivo(owner or "")
+            ]
+            for i in range(0, len(huerfanos), _MAX_PARAMS):
+                trozo = huerfanos[i:i + _MAX_PARAMS]
+                conn.execute(
+                    f"UPDATE trabajos SET estado = 'pendiente', lease_owner = NULL, lease_until = NULL, "
+                    f"updated_at = ? WHERE id IN ({', '.join('?' * len(trozo))})",
+                    (ahora, *trozo)
+                )
+            marcas = ", ".join("?" * len(_ESTADOS_EN_CURSO))
+            sin_trabajo = conn.execute(
+                f"SELECT s.id, s.email, s.ruta, s.info_json FROM solicitudes s "
+                f"LEFT JOIN trabajos t ON t.solicitud_id = s.id AND t.estado IN ('pendiente', 'en_curso') "
+                f"WHERE s.estado IN ({marcas}) AND t.id IS NULL",
+                _ESTADOS_EN_CURSO
+            ).fetchall()
+            for id_, email, ruta, info_json in sin_trabajo:
+                info = json.loads(info_json) if info_json else {}
+                payload = json.dumps({"email": email, "ruta": ruta, "vigencia": info.get("vigencia")})
+                conn.execute(
+                    "INSERT INTO trabajos (solicitud_id, payload_json, estado, created_at, updated_at) "
+                    "VALUES (?, ?, 'pendiente', ?, ?) "
+                    "ON CONFLICT(solicitud_id) DO UPDATE SET estado = 'pendiente', payload_json = excluded.payload_json, "
+                    "lease_owner = NULL, lease_until = NULL, updated_at = excluded.updated_at",
+                    (id_, payload, ahora, ahora)
+                )
+            conn.commit()
+        return {"liberados": len(huerfanos), "reencolados": len(sin_trabajo)}
+
+    def cancelar_solicitud(self, id: str, info: dict) -> Optional[dict]:
+        """
+        Cancela una solicitud cuya copia no terminó (_ESTADOS_EN_CURSO), en una
+        sola transacción: la deja en 'cancelado' con `info`, marca su trabajo
+        'cancelado' (ya no es reclamable; el worker que lo tenga lo ve en
+        trabajo_cancelado y detiene la copia) y libera su cupo de rsync para
+        que la siguiente copia en cola arranque sin esperar.
+
+        Devuelve None si la solicitud no existe o ya no está en curso; si no,
+        {"estado": estado previo, "trabajo": estado previo del trabajo o None}.
+        """
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT estado FROM solicitudes WHERE id = ?", (id,)).fetchone()
+            if row is None or row[0] not in _ESTADOS_EN_CURSO:
+                conn.commit()
+                return None
+            trabajo = conn.execute(
+                "SELECT estado FROM trabajos WHERE solicitud_id = ? AND estado IN ('pendiente', 'en_curso')",
+                (id,)
+            ).fetchone()
+            conn.execute(
+                f"UPDATE solicitudes SET estado = 'cancelado', info_json = ?, {_SET_PROMOVIDAS} WHERE id = ?",
+                (json.dumps(info), *_columnas_promovidas(info), id)
+            )
+            conn.execute(
+                "UPDATE trabajos SET estado = 'cancelado', updated_at = ? "
+                "WHERE solicitud_id = ? AND estado IN ('pendiente', 'en_curso')",
+                (time.time(), id)
+            )
+            conn.execute("DELETE FROM cupos_rsync WHERE solicitud_id = ?", (id,))
+            conn.execute("DELETE FROM reservas_espacio WHERE solicitud_id = ?", (id,))
+            conn.commit()
+        return {"estado": row[0], "trabajo": trabajo[0] if trabajo else None}
+
+    def trabajo_cancelado(self, trabajo_id: int) -> bool:
+        """True si el trabajo fue cancelado (ver cancelar_solicitud)."""
+        with self._get_conn() as conn:
+            row = conn.execute("SELECT estado FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        return row is not None and row[0] == 'cancelado'
+
+    # --- Admisión de rsync: cupos global y por host de origen ----------------
+    #
+    # Cada copia remota pide cupo antes de lanzar rsync. La tabla es la misma
+    # para todos los procesos, así que los límites valen entre workers. Las
+    # filas llevan lease: quien espera lo refresca en cada sondeo y quien copia
+    # con un latido; si el proceso muere, su fila vence y se purga sola.
+
+    def solicitar_cupo_rsync(self, solicitud_id: str, host: str, lease_s: float,
+                             max_global: int, max_por_host, intento: Optional[str] = None) -> Tuple[bool, int]:
+        """
+        Pide (o re-pide) cupo para copiar desde `host`. `max_por_host` es un
+        callable host -> límite. Devuelve (True, 0) si la copia puede empezar,
+        o (False, posición en la cola, desde 1).
+
+        La cola es FIFO salvo por bloqueo de cabeza: se concede al primero en
+        espera cuyo host tenga cupo, de modo que diez solicitudes contra un host
+        saturado no frenan a una contra otro host distinto.
+
+        `intento` identifica el intento del trabajo que pide el cupo (ver
+        liberar_cupo_rsync); un intento nuevo de la misma solicitud toma el cupo.
+        """
+        ahora = time.time()
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM cupos_rsync WHERE lease_until < ?", (ahora,))
+            conn.execute(
+                "INSERT INTO cupos_rsync (solicitud_id, host, estado, lease_until, intento) "
+                "VALUES (?, ?, 'esperando', ?, ?) "
+                "ON CONFLICT(solicitud_id) DO UPDATE SET lease_until = excluded.lease_until, intento = excluded.intento",
+                (solicitud_id, host, ahora + lease_s, intento)
+            )
+            filas = conn.execute("SELECT solicitud_id, host, estado FROM cupos_rsync ORDER BY id").fetchall()
+            activos_por_host: dict = {}
+            for _, h, estado in filas:
+                if estado == 'activo':
+                    activos_por_host[h] = activos_por_host.get(h, 0) + 1
+            if any(sid == solicitud_id and estado == 'activo' for sid, _, estado in filas):
+                conn.commit()
+                return True, 0
+            esperando = [(sid, h) for sid, h, estado in filas if estado == 'esperando']
+            concedido = False
+            if sum(activos_por_host.values()) < max_global:
+                for sid, h in esperando:
+                    if activos_por_host.get(h, 0) < max_por_host(h):
+                        concedido = sid == solicitud_id
+                        break
+            if concedido:
+                conn.execute("UPDATE cupos_rsync SET estado = 'activo' WHERE solicitud_id = ?", (solicitud_id,))
+                conn.commit()
+                return True, 0
+            conn.commit()
+        posicion = next(i for i, (sid, _) in enumerate(esperando, 1) if sid == solicitud_id)
+        return False, posicion
+
+    def renovar_cupo_rsync(self, solicitud_id: str, host: str, lease_s: float,
+                           intento: Optional[str] = None) -> bool:
+        """
+        Latido de una copia en curso. Si su cupo ya no existe (venció porque
+        fallaron latidos y otra admisión lo purgó) se repone como activo: la
+        copia sigue corriendo y tiene que contar contra los límites. Si lo
+        tiene otro intento de la misma solicitud, no se toca. Devuelve False
+        en ambos casos.
+        """
+        with self._get_conn() as conn:
+            cur = conn.execute(
+                "UPDATE cupos_rsync SET lease_until = ? WHERE solicitud_id = ? AND intento IS ?",
+                (time.time() + lease_s, solicitud_id, intento)
+            )
+            if cur.rowcount == 1:
+                conn.commit()
+                return True
+            conn.execute(
+                "INSERT INTO cupos_rsync (solicitud_id, host, estado, lease_until, intento) "
+                "VALUES (?, ?, 'activo', ?, ?) ON CONFLICT(solicitud_id) DO NOTHING",
+                (solicitud_id, host, time.time() + lease_s, intento)
+            )
+            conn.commit()
+            return False
+
+    def liberar_cupo_rsync(self, solicitud_id: str, intento: Optional[str] = None) -> None:
+        """
+        Libera el cupo (o abandona la espera) de una solicitud. Con `intento`,
+        sólo si sigue siendo de ese intento: un intento que se detiene después
+        de que el trabajo fue reclamado de nuevo no le quita el cupo al nuevo.
+        """
+        with self._get_conn() as conn:
+            if intento is None:
+                conn.execute("DELETE FROM cupos_rsync WHERE solicitud_id = ?", (solicitud_id,))
+            else:
+                conn.execute("DELETE FROM cupos_rsync WHERE solicitud_id = ? AND intento = ?",
+                             (solicitud_id, intento))
+            conn.commit()
+
+    # --- Reservas de espacio en /data ----------------------------------------
+    #
+    # Cada copia reserva, antes de empezar, los bytes que va a escribir; la
+    # admisión compara el espacio libre con lo que ya tienen reservado las
+    # demás copias en curso (de cualquier proceso). Lo pendiente de una reserva
+    # es bytes - escritos: a medida que la copia escribe, esos bytes ya se
+    # descuentan del espacio libre y dejan de contarse dos veces. Las reservas
+    # de solicitudes que ya no están en curso (terminadas, canceladas, o cuyo
+    # worker murió sin liberarlas y luego pasaron a 'error') no cuentan y se
+    # purgan en la siguiente admisión.
+
+    def reservar_espacio(self, solicitud_id: str, bytes_: int, libres: int, margen: int,
+                         intento: Optional[str] = None) -> Tuple[bool, int]:
+        """
+        Reserva `bytes_` para la copia de `solicitud_id` si caben en `libres`
+        descontando lo pendiente de las demás reservas y `margen`. Re-reservar
+        (reintento de la misma solicitud) reemplaza la reserva anterior.
+        Devuelve (concedida, bytes pendientes de las demás reservas).
+        """
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "DELETE FROM reservas_espacio WHERE solicitud_id NOT IN "
+                f"(SELECT id FROM solicitudes WHERE estado IN ({_MARCAS_EN_CURSO}))",
+                _ESTADOS_EN_CURSO
+            )
+            conn.execute("DELETE FROM reservas_espacio WHERE solicitud_id = ?", (solicitud_id,))
+            otras = conn.execute(_PENDIENTE_RESERVAS, _ESTADOS_EN_CURSO).fetchone()[0]
+            concedida = libres - otras - margen >= bytes_
+            if concedida:
+                conn.execute(
+                    "INSERT INTO reservas_espacio (solicitud_id, bytes, escritos, ts, intento) VALUES (?, ?, 0, ?, ?)",
+                    (solicitud_id, bytes_, time.time(), intento)
+                )
+            conn.commit()
+        return concedida, otras
+
+    def ajustar_reserva(self, solicitud_id: str, escritos: int) -> None:
+        """Registra cuántos bytes de la reserva ya están en disco (nunca baja)."""
+        with self._get_conn() as conn:
+            conn.execute(
+                "UPDATE reservas_espacio SET escritos = MAX(escritos, ?) WHERE solicitud_id = ?",
+                (escritos, solicitud_id)
+            )
+            conn.commit()
+
+    def liberar_reserva(self, solicitud_id: str, intento: Optional[str] = None) -> None:
+        """Borra la reserva; con `intento`, sólo si es de ese intento (como liberar_cupo_rsync)."""
+        with self._get_conn() as conn:
+            if intento is None:
+                conn.execute("DELETE FROM reservas_espacio WHERE solicitud_id = ?", (solicitud_id,))
+            else:
+                conn.execute("DELETE FROM reservas_espacio WHERE solicitud_id = ? AND intento = ?",
+                             (solicitud_id, intento))
+            conn.commit()
+
+    def espacio_reservado(self) -> Dict[str, int]:
+        """Bytes reservados y aún no escritos por las copias en curso."""
+        with self._get_conn() as conn:
+            pendiente = conn.execute(_PENDIENTE_RESERVAS, _ESTADOS_EN_CURSO).fetchone()[0]
+            reservas = conn.execute(
+                "SELECT COUNT(*) FROM reservas_espacio r JOIN solicitudes s ON s.id = r.solicitud_id "
+                f"WHERE s.estado IN ({_MARCAS_EN_CURSO})", _ESTADOS_EN_CURSO
+            ).fetchone()[0]
+        return {"bytes": pendiente, "reservas": reservas}
+
+    # --- Uso de /data por usuario FTP ---------------------------------------
+    #
+    # Lo que el sondeo midió de cada solicitud terminada (uso_solicitudes) y su
+    # suma por usuario (uso_usuarios), mantenida en la misma transacción que
+    # registra o borra la solicitud. Responde cuánto ocupa cada usuario sin
+    # recorrer /data, y es lo que se escribe como cuota en MySQL.
+
+    def _descontar_uso(self, conn: sqlite3.Connection, ids) -> None:
+        """Quita del uso de su usuario las solicitudes `ids` (dentro de la
+        transacción de quien llama; como mucho _MAX_PARAMS ids)."""
+        marcas = ", ".join("?" * len(ids))
+        filas = conn.execute(
+            f"SELECT usuario, SUM(bytes), SUM(compartidos), SUM(archivos), COUNT(*) FROM uso_solicitudes "
+            f"WHERE solicitud_id IN ({marcas}) GROUP BY usuario", list(ids)
+        ).fetchall()
+        if not filas:
+            return
+        ahora = time.time()
+        conn.executemany(
+            "UPDATE uso_usuarios SET bytes = bytes - ?, compartidos = compartidos - ?, archivos = archivos - ?, "
+            "solicitudes = solicitudes - ?, actualizado = ? WHERE usuario = ?",
+            [(bytes_, compartidos, archivos, n, ahora, usuario) for usuario, bytes_, compartidos, archivos, n in filas]
+        )
+        conn.execute("DELETE FROM uso_usuarios WHERE solicitudes <= 0")
+        conn.execute(f"DELETE FROM uso_solicitudes WHERE solicitud_id IN ({marcas})", list(ids))
+
+    def registrar_uso(self, solicitud_id: str, usuario: str, bytes_: int, archivos: int,
+                      compartidos: int = 0) -> Dict[str, int]:
+        """Registra lo que ocupa una solicitud terminada en el home de su
+        usuario (reemplaza un registro anterior de la misma solicitud) y
+        devuelve el uso total del usuario. `compartidos` es la parte de
+        `bytes_` en enlaces duros a otros árboles de /data (reuso,
+        --link-dest): está en el home pero no ocupa disco de nuevo."""
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._descontar_uso(conn, [solicitud_id])
+            conn.execute(
+                "INSERT INTO uso_solicitudes (solicitud_id, usuario, bytes, compartidos, archivos, ts) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (solicitud_id, usuario, bytes_, compartidos, archivos, time.time())
+            )
+            conn.execute(
+                "INSERT INTO uso_usuarios (usuario, bytes, compartidos, archivos, solicitudes, actualizado) "
+                "VALUES (?, ?, ?, ?, 1, ?) ON CONFLICT(usuario) DO UPDATE SET "
+                "bytes = bytes + excluded.bytes, compartidos = compartidos + excluded.compartidos, "
+                "archivos = archivos + excluded.archivos, "
+                "solicitudes = solicitudes + 1, actualizado = excluded.actualizado",
+                (usuario, bytes_, compartidos, archivos, time.time())
+            )
+            conn.commit()
+        return self.uso_usuario(usuario)
+
+    def descontar_uso(self, ids) -> None:
+        """Quita del uso las solicitudes `ids` (p. ej. canceladas tras registrarse)."""
+        ids = list(ids)
+        with self._get_conn() as conn:
+            for i in range(0, len(ids), _MAX_PARAMS):
+                self._descontar_uso(conn, ids[i:i + _MAX_PARAMS])
+            conn.commit()
+
+    def olvidar_uso_usuario(self, usuario: str) -> None:
+        """Borra el uso de un usuario cuyo home se eliminó entero."""
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM uso_solicitudes WHERE usuario = ?", (usuario,))
+            conn.execute("DELETE FROM uso_usuarios WHERE usuario = ?", (usuario,))
+            conn.commit()
+
+    def uso_usuario(self, usuario: str) -> Dict[str, int]:
+        with self._get_conn() as conn:
+            row = conn.execute(
+                "SELECT bytes, compartidos, archivos, solicitudes FROM uso_usuarios WHERE usuario = ?", (usuario,)
+            ).fetchone()
+        bytes_, compartidos, archivos, solicitudes = row or (0, 0, 0, 0)
+        return {"bytes": bytes_, "compartidos": compartidos, "archivos": archivos, "solicitudes": solicitudes}
+
+    def usos_usuarios(self, usuarios) -> Dict[str, Dict[str, int]]:
+        """{usuario: uso} de los `usuarios` dados (0 para los que no tienen)."""
+        usuarios = list(dict.fromkeys(usuarios))
+        usos = {u: {"bytes": 0, "compartidos": 0, "archivos": 0, "solicitudes": 0} for u in usuarios}
+        with self._get_conn() as conn:
+            for i in range(0, len(usuarios), _MAX_PARAMS):
+                trozo = usuarios[i:i + _MAX_PARAMS]
+                for usuario, bytes_, compartidos, archivos, solicitudes in conn.execute(
+                    f"SELECT usuario, bytes, compartidos, archivos, solicitudes FROM uso_usuarios "
+                    f"WHERE usuario IN ({', '.join('?' * len(trozo))})", trozo
+                ):
+                    usos[usuario] = {"bytes": bytes_, "compartidos": compartidos, "archivos": archivos,
+                                     "solicitudes": solicitudes}
+        return usos
+
+    def listar_uso(self, limite: int = 100) -> List[Dict[str, Any]]:
+        """Usuarios de mayor a menor uso."""
+        with self._get_conn() as conn:
+            filas = conn.execute(
+                "SELECT usuario, bytes, compartidos, archivos, solicitudes, actualizado FROM uso_usuarios "
+                "ORDER BY bytes DESC LIMIT ?", (limite,)
+            ).fetchall()
+        return [{"usuario": u, "bytes": b, "compartidos": c, "archivos": a, "solicitudes": n, "actualizado": ts}
+                for u, b, c, a, n, ts in filas]
+
+    # --- Escaneo de uso de /data (usodisco.py) --------------------------------
+    #
+    # La última foto completa del escáner: una fila por home y una fila con
+    # cuándo se tomó. Cada pasada reemplaza la anterior en una transacción.
+
+    def guardar_escaneo_uso(self, filas: List[Dict[str, Any]], duracion_s: float, stats: Dict[str, int]) -> None:
+        with self._get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM uso_escaneo")
+            conn.executemany(
+                "INSERT INTO uso_escaneo (usuario, bytes, archivos, directorios) VALUES (?, ?, ?, ?)",
+                [(f["usuario"], f["bytes"], f["archivos"], f["directorios"]) for f in filas]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO escaneos_uso (id, ts, duracion_s, leidos, reusados) VALUES (1, ?, ?, ?, ?)",
+                (time.time(), duracion_s, stats.get("leidos", 0), stats.get("reusados", 0))
+            )
+            conn.commit()
+
+    def escaneo_uso(self, limite: int = 500) -> Dict[str, Any]:
+        """{"escaneo": {ts, duracion_s, leidos, reusados} o None, "bytes_total",
+        "homes": [...]},
+        los homes de mayor a menor tamaño, con el uso registrado de cada
+        usuario (uso_usuarios) al lado para comparar."""
+        with self._get_conn() as conn:
+            escaneo = conn.execute("SELECT ts, duracion_s, leidos, reusados FROM escaneos_uso WHERE id = 1").fetchone()
+            filas = conn.execute(
+                "SELECT e.usuario, e.bytes, e.archivos, e.directorios, u.bytes, u.compartidos FROM uso_escaneo e "
+                "LEFT JOIN uso_usuarios u ON u.usuario = e.usuario ORDER BY e.bytes DESC, e.usuario LIMIT ?",
+                (limite,)
+            ).fetchall()
+            total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM uso_escaneo").fetchone()[0]
+        return {
+            "escaneo": dict(zip(("ts", "duracion_s", "leidos", "reusados"), escaneo)) if escaneo else None,
+            "bytes_total": total,
+            "homes": [{"usuario": u, "bytes": b, "archivos": a, "directorios": d, "bytes_registrados": r or 0,
+                       "bytes_compartidos": c or 0}
+                      for u, b, a, d, r, c in filas],
+        }
+
+    # --- Sondeos de tamaño remoto -------------------------------------------
+    #
+    # Cada `du -sb` contra un host de origen deja su duración aquí, para ver
+    # qué hosts tardan en recorrer sus árboles (GET /health, sondeos_du).
+
+    def registrar_sondeo(self, host: str, ruta: str, bytes_: Optional[int], duracion_s: float, ok: bool) -> None:
+        ahora = time.time()
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT INTO sondeos_tamano (host, ruta, bytes, duracion_s, ok, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                (host, ruta, bytes_, duracion_s, 1 if ok else 0, ahora)
+            )
+            conn.execute("DELETE FROM sondeos_tamano WHERE ts < ?",
+                         (ahora - _SONDEOS_RETENCION_DIAS * 86400,))
+            conn.commit()
+
+    def resumen_sondeos(self, dias: float = 7) -> List[Dict[str, Any]]:
+        """Por host, de los últimos `dias`: cantidad, fallidos, duración media y
+        máxima, ordenado del más lento (media) al más rápido."""
+        with self._get_conn() as conn:
+            filas = conn.execute(
+                "SELECT host, COUNT(*), SUM(1 - ok), AVG(duracion_s), MAX(duracion_s), MAX(ts) "
+                "FROM sondeos_tamano WHERE ts >= ? GROUP BY host ORDER BY AVG(duracion_s) DESC",
+                (time.time() - dias * 86400,)
+            ).fetchall()
+        return [
+            {
+                "host": host,
+                "sondeos": n,
+                "fallidos": fallidos,
+                "duracion_media_s": round(media, 3),
+                "duracion_max_s": round(maxima, 3),
+                "ultimo": datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+            }
+            for host, n, fallidos, media, maxima, ts in filas
+        ]
+
+    # --- Contenido ya preparado en /data ------------------------------------
+    #
+    # Cada copia terminada registra qué origen (host, ruta) y qué huella
+    # (listado de tamaños y mtimes) tiene su árbol en /data. Otra solicitud del
+    # mismo origen sin cambios lo arma con enlaces duros en vez de copiarlo.
+
+    def registrar_contenido(self, host: str, ruta: str, huella: str, destino: str,
+                            bytes_: Optional[int], solicitud_id: str) -> None:
+        with self._get_conn() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO contenido_preparado (destino, host, ruta, huella, bytes, solicitud_id, ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (destino, host, ruta, huella, bytes_, solicitud_id, time.time())
+            )
+            conn.commit()
+
+    def buscar_contenido(self, host: str, ruta: str, huella: str) -> List[Dict[str, Any]]:
+        """Árboles registrados para ese origen y huella, del más reciente al más
+        antiguo. Sólo los de solicitudes que siguen vigentes ('listo' o
+        'bloqueado'): los de expiradas o eliminadas ya van a la papelera."""
+        with self._get_conn() as conn:
+            filas = conn.execute(
+                "SELECT c.destino, c.bytes, c.solicitud_id FROM contenido_preparado c "
+                "JOIN solicitudes s ON s.id = c.solicitud_id "
+                "WHERE c.host = ? AND c.ruta = ? AND c.huella = ? AND s.estado IN ('listo', 'bloqueado') "
+                "ORDER BY c.ts DESC",
+                (host, ruta, huella)
+            ).fetchall()
+        return [{"destino": d, "bytes": b, "solicitud_id": sid} for d, b, sid in filas]
+
+    def contenido_por_origen(self, host: str, ruta: str, limite: int = 5) -> List[str]:
+        """Árboles vigentes de ese origen con cualquier huella (el origen
+        cambió desde que se copiaron), del más reciente al más antiguo."""
+        with self._get_conn() as conn:
+            filas = conn.execute(
+                "SELECT c.destino FROM contenido_preparado c "
+                "JOIN solicitudes s ON s.id = c.solicitud_id "
+                "WHERE c.host = ? AND c.ruta = ? AND s.estado IN ('listo', 'bloqueado') "
+                "ORDER BY c.ts DESC LIMIT ?",
+                (host, ruta, limite)
+            ).fetchall()
+        return [f[0] for f in filas]
+
+    def solicitudes_recientes(self, usuario: str, limite: int = 5) -> List[Tuple[str, str]]:
+        """(id, ruta) de las últimas solicitudes vigentes del usuario FTP."""
+        with self._get_conn() as conn:
+            filas = conn.execute(
+                "SELECT id, ruta FROM solicitudes WHERE usuario = ? AND estado IN ('listo', 'bloqueado') "
+                "ORDER BY rowid DESC LIMIT ?",
+                (usuario, limite)
+            ).fetchall()
+        return [(id_, ruta) for id_, ruta in filas]
+
+    def olvidar_contenido(self, destino: str) -> None:
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM contenido_preparado WHERE destino = ?", (destino,))
+            conn.commit()
+
+    def sumar_contadores(self, incrementos: Dict[str, int]) -> None:
+        """Suma a contadores persistentes (compartidos entre procesos)."""
+        with self._get_conn() as conn:
+            conn.executemany(
+                "INSERT INTO contadores (nombre, valor) VALUES (?, ?) "
+                "ON CONFLICT(nombre) DO UPDATE SET valor = valor + excluded.valor",
+                list(incrementos.items())
+            )
+            conn.commit()
+
+    def contadores(self, prefijo: str = "") -> Dict[str, int]:
+        with self._get_conn() as conn:
+            filas = conn.execute(
+                "SELECT nombre, valor FROM contadores WHERE substr(nombre, 1, ?) = ? ORDER BY nombre",
+                (len(prefijo), prefijo)
+            ).fetchall()
+        return dict(filas)
+
+
+class AsyncTMPFTPdb:
+    """
+    Fachada asíncrona de TMPFTPdb para los handlers y gestores async.
+
+    Cada método público de TMPFTPdb está disponible aquí como corrutina con la
+    misma firma (`await adb.obtener_solicitud(id)`), ejecutado en un executor
+    propio. Así un commit lento (otro worker con el lock de escritura, disco
+    ocupado) espera en un hilo del executor y no congela el event loop del
+    worker de uvicorn. El executor es dedicado y no el por defecto de asyncio
+    para que lo que aún corre con asyncio.to_thread (la purga de la papelera,
+    _crear_enlace_local, los recorridos y borrados de árboles en /data) no le
+    quite hilos a la base ni al revés; rsync, el sondeo y chown ya son
+    subprocesos asyncio y no ocupan hilos. Con conexiones por hilo, su tamaño
+    (TEMPOFTP_SQLITE_THREADS, 4 por defecto) es también el número de
+    conexiones abiertas.
+    """
+
+    def __init__(self, db: TMPFTPdb, max_workers: Optional[int] = None) -> None:
+        self.db = db
+        if max_workers is None:
+            max_workers = int(os.getenv("TEMPOFTP_SQLITE_THREADS", "4"))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tmpftpdb")
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def __getattr__(self, nombre: str):
+        if nombre.startswith("_"):
+            raise AttributeError(nombre)
+        fn = getattr(self.db, nombre)
+        if not callable(fn):
+            return fn
+
+        @functools.wraps(fn)
+        async def _async(*args, **kwargs):
+            return await self._run(fn, *args, **kwargs)
+        return _async
+
+    def close(self) -> None:
+        """Cierra el executor (esperando lo pendiente) y las conexiones."""
+        self._executor.shutdown(wait=True)
+        self.db.close()
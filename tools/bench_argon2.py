@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Benchmark de HashArgon2: hashes/s y latencia (p50/p99, incluida la espera en
+cola) para varias combinaciones de time_cost/memory_cost, con una ráfaga de
+altas concurrentes como la que recibe el worker de transferencias.
+
+La latencia de cada hash se mide desde que se pide hasta que vuelve, así que
+con más pedidos que cupos del presupuesto refleja también la cola.
+
+Uso:
+    python tools/bench_argon2.py [--hashes 64] [--memoria-mib 256] [--costos 1:19456,2:19456,3:65536]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hashargon2 import HashArgon2  # noqa: E402
+
+
+def _percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+async def _rafaga(h: HashArgon2, n: int):
+    latencias = []
+
+    async def uno(i: int) -> None:
+        t0 = time.perf_counter()
+        await h.hash(f"password-{i}")
+        latencias.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(uno(i) for i in range(n)))
+    return n / (time.perf_counter() - t0), latencias
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hashes", type=int, default=64, help="hashes por ráfaga")
+    parser.add_argument("--memoria-mib", type=int, default=256, help="TEMPOFTP_ARGON2_MEMORIA_MAX_MIB")
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--costos", default="1:19456,2:19456,3:65536,4:131072",
+                        help="pares time_cost:memory_cost_kib separados por coma")
+    args = parser.parse_args()
+
+    print(f"{'t':>3} {'m (KiB)':>9} {'cupos':>6} {'hash/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for par in args.costos.split(","):
+        t, m = (int(x) for x in par.split(":"))
+        try:
+            h = HashArgon2(time_cost=t, memory_cost=m, parallelism=args.parallelism,
+                           memoria_max_mib=args.memoria_mib)
+        except ValueError as e:
+            print(f"{t:>3} {m:>9}  omitido: {e}")
+            continue
+        tasa, latencias = asyncio.run(_rafaga(h, args.hashes))
+        h.close()
+        print(f"{t:>3} {m:>9} {h.max_concurrentes:>6} {tasa:>9.1f} "
+              f"{_percentil(latencias, 50) * 1000:>9.1f} {_percentil(latencias, 99) * 1000:>9.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
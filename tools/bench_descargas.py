@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark de estadísticas de descarga: lectura completa de transfer.log en
+cada consulta (el _leer_log anterior de GestorFTP.obtener_estadisticas_descargas)
+contra IndiceDescargas (indexado incremental + lectura por clave en SQLite).
+
+Genera un log sintético en un directorio temporal. Reporta la latencia por
+consulta (lo que ven los pollers en GET /tmpftp/{id}) y, aparte, lo que cuesta
+en el worker de transferencias la indexación inicial (una sola vez) y cada
+pasada de fondo con N líneas nuevas.
+
+Uso:
+    python tools/bench_descargas.py [--lineas 2000000] [--usuarios 300] [--consultas 20]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from indicedescargas import IndiceDescargas  # noqa: E402
+from tmpftpdb import TMPFTPdb  # noqa: E402
+
+
+def _leer_log_completo(log_path: str, usuario_ftp: str, consulta_id: str):
+    """Copia del lector anterior: recorre todo el log por consulta."""
+    path_filter = f"/{consulta_id}/"
+    sesiones = set()
+    last_date = None
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if usuario_ftp not in line or path_filter not in line:
+                continue
+            if '"GET ' not in line or ' 200 ' not in line:
+                continue
+            parts = line.split()
+            start, end = line.find('['), line.find(']')
+            if start == -1 or end == -1:
+                continue
+            timestamp = line[start + 1:end]
+            sesiones.add((parts[0], timestamp.split(':')[0]))
+            last_date = timestamp
+    return {"total_descargas": len(sesiones), "ultima_descarga": last_date}
+
+
+def _linea(rnd: random.Random, usuarios: int) -> str:
+    u = rnd.randrange(usuarios)
+    ip = f"10.{rnd.randrange(256)}.{rnd.randrange(256)}.{rnd.randrange(256)}"
+    dia = f"{rnd.randrange(1, 29):02d}/Feb/2026"
+    return (f'{ip} - ftp_u{u}_x [{dia}:09:21:27 -0600] "GET /data/ftp_u{u}_x/Q{u % 7}/f{rnd.randrange(1000)}.nc" '
+            f'200 {rnd.randrange(10**6)}\n')
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lineas", type=int, default=2_000_000)
+    parser.add_argument("--usuarios", type=int, default=300)
+    parser.add_argument("--consultas", type=int, default=20)
+    parser.add_argument("--nuevas", type=int, default=100, help="líneas agregadas entre pasadas de fondo")
+    args = parser.parse_args()
+
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, "transfer.log")
+        with open(log_path, "w") as f:
+            f.writelines(_linea(rnd, args.usuarios) for _ in range(args.lineas))
+        print(f"log: {args.lineas} líneas, {os.path.getsize(log_path) / 1e6:.1f} MB")
+
+        objetivos = [(f"ftp_u{u}_x", f"Q{u % 7}") for u in (rnd.randrange(args.usuarios) for _ in range(args.consultas))]
+
+        t0 = time.perf_counter()
+        for usuario, consulta in objetivos:
+            _leer_log_completo(log_path, usuario, consulta)
+        completo = (time.perf_counter() - t0) / len(objetivos)
+
+        indice = IndiceDescargas(TMPFTPdb(db_path=os.path.join(tmp, "bench.db")), log_path=log_path)
+        t0 = time.perf_counter()
+        indice.actualizar()
+        inicial = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for usuario, consulta in objetivos:
+            indice.estadisticas(usuario, consulta)
+        consulta_t = (time.perf_counter() - t0) / len(objetivos)
+
+        pasada = 0.0
+        for _ in objetivos:
+            with open(log_path, "a") as f:
+                f.writelines(_linea(rnd, args.usuarios) for _ in range(args.nuevas))
+            t0 = time.perf_counter()
+            indice.actualizar()
+            pasada += time.perf_counter() - t0
+        pasada /= len(objetivos)
+
+        usuario, consulta = objetivos[0]
+        assert indice.estadisticas(usuario, consulta) == _leer_log_completo(log_path, usuario, consulta)
+
+    print(f"lectura completa por consulta:            {completo * 1000:10.2f} ms")
+    print(f"índice por consulta:                      {consulta_t * 1000:10.2f} ms")
+    print(f"worker: indexación inicial (una vez):     {inicial * 1000:10.2f} ms")
+    print(f"worker: pasada de fondo (+{args.nuevas} líneas):   {pasada * 1000:10.2f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
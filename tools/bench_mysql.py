@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Benchmark de FTPDB_MySQL: round trips y latencia de las operaciones de una
+sentencia (actuales) contra el camino anterior (SELECT COUNT(*) + DML), de
+las variantes masivas contra N llamadas individuales y de actualizar_cuotas
+(UPDATE ... CASE) contra el executemany de UPDATE (una sentencia por fila).
+
+Por defecto corre contra un sustituto local de MySQL: un pool falso sobre
+SQLite en memoria que agrega --rtt-ms de latencia por sentencia (lo que cuesta
+un round trip real a MySQL en la red del servidor). Con --mysql usa el MySQL de
+FTP_DB_* (tabla users de Pure-FTPd; crea y borra usuarios bench_*).
+
+Uso:
+    python tools/bench_mysql.py [--usuarios 200] [--rtt-ms 0.5] [--mysql]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+from contextlib import asynccontextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+if not os.getenv("TEMPOFTP_ENCRYPTION_KEY"):
+    # gestorftp importa cifrado, que la exige; el benchmark no cifra nada.
+    from cryptography.fernet import Fernet
+    os.environ["TEMPOFTP_ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+
+from gestorftp import FTPDB_MySQL  # noqa: E402
+
+
+class _CursorSustituto:
+    def __init__(self, conn: sqlite3.Connection, rtt_s: float, contador: list) -> None:
+        self.conn, self.rtt_s, self.contador = conn, rtt_s, contador
+        self.rowcount, self._filas = 0, []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=()):
+        self.contador[0] += 1
+        await asyncio.sleep(self.rtt_s)
+        sql = sql.replace("%s", "?").replace(
+            "ON DUPLICATE KEY UPDATE Password=VALUES(Password)",
+            "ON CONFLICT(User) DO UPDATE SET Password=excluded.Password")
+        cur = self.conn.execute(sql, params or ())
+        self._filas = cur.fetchall()
+        # SQLite cuenta filas coincidentes en UPDATE, como MySQL con CLIENT.FOUND_ROWS.
+        self.rowcount = cur.rowcount
+
+    async def executemany(self, sql, filas):
+        # Como aiomysql: sólo el INSERT ... VALUES se agrupa; el resto es un
+        # execute (un round trip) por fila.
+        total = 0
+        for fila in filas:
+            await self.execute(sql, fila)
+            total += self.rowcount
+        self.rowcount = total
+
+    async def fetchone(self):
+        return self._filas[0] if self._filas else None
+
+    async def fetchall(self):
+        return self._filas
+
+
+class FTPDB_Sustituto(FTPDB_MySQL):
+    """FTPDB_MySQL cuyo pool es SQLite en memoria con latencia por sentencia."""
+
+    def __init__(self, rtt_s: float) -> None:
+        super().__init__()
+        self.rtt_s = rtt_s
+        self.sentencias = [0]
+        self._sqlite = sqlite3.connect(":memory:")
+        self._sqlite.isolation_level = None
+        self._sqlite.execute("CREATE TABLE users (User TEXT PRIMARY KEY, Password TEXT, Uid INT, Gid INT, "
+                             "Dir TEXT, Status TEXT, QuotaSize INT, QuotaFiles INT)")
+
+    @asynccontextmanager
+    async def _acquire(self):
+        class _Conn:
+            def cursor(conn_self):
+                return _CursorSustituto(self._sqlite, self.rtt_s, self.sentencias)
+        yield _Conn()
+
+    async def _hash_password(self, password: str) -> str:
+        return "$argon2id$bench"
+
+
+class Anterior:
+    """Las operaciones como eran antes: SELECT COUNT(*) y luego el DML."""
+
+    def __init__(self, db: FTPDB_MySQL) -> None:
+        self.db = db
+
+    async def _contar_y(self, user: str, sql: str) -> bool:
+        async with self.db._acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT COUNT(*) FROM users WHERE User=%s", (user,))
+                if (await cur.fetchone())[0] == 0:
+                    return False
+                await cur.execute(sql, (user,))
+                return True
+
+    async def bloquear_usuario(self, user):
+        return await self._contar_y(user, "UPDATE users SET Status=0 WHERE User=%s")
+
+    async def desbloquear_usuario(self, user):
+        return await self._contar_y(user, "UPDATE users SET Status=1 WHERE User=%s")
+
+    async def eliminar_usuario_ftp(self, user):
+        return await self._contar_y(user, "DELETE FROM users WHERE User=%s")
+
+    async def crear_usuario_ftp(self, user, password, homedir):
+        async with self.db._acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT COUNT(*) FROM users WHERE User=%s", (user,))
+                if (await cur.fetchone())[0] > 0:
+                    return
+                await cur.execute("INSERT INTO users (User, Password, Uid, Gid, Dir, Status) "
+                                  "VALUES (%s, %s, %s, %s, %s, %s)", (user, "x", 2001, 2001, homedir, "1"))
+
+    async def actualizar_cuotas(self, cuotas):
+        async with self.db._acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany("UPDATE users SET QuotaSize=%s, QuotaFiles=%s WHERE User=%s",
+                                      [(mb, archivos, user) for user, (mb, archivos) in cuotas.items()])
+                return cur.rowcount
+
+
+def _contador(db) -> int:
+    return db.sentencias[0] if hasattr(db, "sentencias") else 0
+
+
+async def _medir(db, nombre: str, coro_factory, n: int) -> None:
+    antes = _contador(db)
+    t0 = time.perf_counter()
+    await coro_factory()
+    ms = (time.perf_counter() - t0) * 1000
+    rt = _contador(db) - antes
+    rt_txt = f"{rt:>6}" if hasattr(db, "sentencias") else "     -"
+    print(f"{nombre:<40} {rt_txt} {ms:>10.1f} ms  ({ms / n:.3f} ms/usuario)")
+
+
+async def _escenario(db, n: int) -> None:
+    usuarios = [f"bench_{i}" for i in range(n)]
+    anterior = Anterior(db)
+
+    async def uno_a_uno(obj, metodo, *args):
+        for u in usuarios:
+            await getattr(obj, metodo)(u, *args)
+
+    print(f"{'operación':<40} {'RT':>6} {'tiempo':>13}")
+    for etiqueta, obj in (("anterior", anterior), ("actual", db)):
+        await _medir(db, f"crear x{n} ({etiqueta})", lambda: uno_a_uno(obj, "crear_usuario_ftp", "p", "/data/b"), n)
+        await _medir(db, f"bloquear x{n} ({etiqueta})", lambda: uno_a_uno(obj, "bloquear_usuario"), n)
+        await _medir(db, f"desbloquear x{n} ({etiqueta})", lambda: uno_a_uno(obj, "desbloquear_usuario"), n)
+        await _medir(db, f"eliminar x{n} ({etiqueta})", lambda: uno_a_uno(obj, "eliminar_usuario_ftp"), n)
+
+    await uno_a_uno(db, "crear_usuario_ftp", "p", "/data/b")
+    await _medir(db, f"bloquear_usuarios({n})", lambda: db.bloquear_usuarios(usuarios), n)
+    await _medir(db, f"desbloquear_usuarios({n})", lambda: db.desbloquear_usuarios(usuarios), n)
+    await _medir(db, f"estado_usuarios({n})", lambda: db.estado_usuarios(usuarios), n)
+    cuotas = {u: (i + 1, 10) for i, u in enumerate(usuarios)}
+    await _medir(db, f"actualizar_cuotas({n}) (executemany)", lambda: anterior.actualizar_cuotas(cuotas), n)
+    await _medir(db, f"actualizar_cuotas({n}) (CASE)", lambda: db.actualizar_cuotas(cuotas), n)
+    await _medir(db, f"eliminar_usuarios_ftp({n})", lambda: db.eliminar_usuarios_ftp(usuarios), n)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="latencia por sentencia del sustituto")
+    parser.add_argument("--mysql", action="store_true", help="usar el MySQL de FTP_DB_* en vez del sustituto")
+    args = parser.parse_args()
+
+    async def correr():
+        if args.mysql:
+            db = FTPDB_MySQL()
+
+            async def hash_fijo(password):
+                return "$argon2id$bench"
+            db._hash_password = hash_fijo
+            await db.connect()
+        else:
+            db = FTPDB_Sustituto(args.rtt_ms / 1000)
+        try:
+            await _escenario(db, args.usuarios)
+        finally:
+            await db.close()
+            await asyncio.to_thread(db.hasher.close)
+
+    asyncio.run(correr())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
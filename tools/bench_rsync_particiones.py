@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la copia en particiones (TEMPOFTP_RSYNC_PARTICIONES): throughput
+de un solo rsync contra N rsync simultáneos sobre particiones del primer nivel
+de la ruta, por el mismo camino que usa procesar_trabajo
+(el sondeo de GestorFTP._contar_remoto, _particionar y _rsync_con_progreso).
+
+Un solo flujo TCP hacia un host lejano queda limitado por ventana/RTT, no por
+el enlace. Para reproducirlo sin un host remoto, el benchmark pone en el PATH
+un sustituto de rsync que copia de verdad (respeta --files-from/--from0 y
+emite --info=progress2) pero limita cada proceso a --ventana-kib por
+--rtt-ms, y un ssh sustituto que corre el comando "remoto" (find | awk) localmente.
+El árbol de origen es sintético: --entradas directorios de tamaño desparejo
+que suman --mib MiB.
+
+Uso:
+    python tools/bench_rsync_particiones.py [--mib 64] [--entradas 16]
+        [--rtt-ms 80] [--ventana-kib 1024] [--particiones 1,2,4,8]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv  # noqa: E402
+load_dotenv()
+if not os.getenv("TEMPOFTP_ENCRYPTION_KEY"):
+    # gestorftp importa cifrado, que la exige; el benchmark no cifra nada.
+    from cryptography.fernet import Fernet
+    os.environ["TEMPOFTP_ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+
+from gestorftp import GestorFTP, _particionar  # noqa: E402
+from tmpftpdb import TMPFTPdb, AsyncTMPFTPdb  # noqa: E402
+
+# rsync sustituto: copia lo pedido a velocidad ventana/RTT por proceso.
+_RSYNC = r'''#!{python}
+import os, sys, time
+ventana, rtt = {ventana}, {rtt}
+args, lista, i = sys.argv[1:], None, 0
+posicionales = []
+while i < len(args):
+    a = args[i]
+    if a == "-e":
+        i += 1
+    elif a.startswith("--files-from="):
+        lista = a.split("=", 1)[1]
+    elif not a.startswith("-"):
+        posicionales.append(a)
+    i += 1
+origen, destino = posicionales[-2], posicionales[-1]
+origen = origen.split(":", 1)[1] if ":" in origen.split("/", 1)[0] else origen
+if not origen.endswith("/"):
+    destino = os.path.join(destino, os.path.basename(origen))
+    origen += "/"
+if lista:
+    with open(lista, "rb") as f:
+        nombres = [n.decode() for n in f.read().split(b"\0") if n]
+else:
+    nombres = os.listdir(origen)
+archivos = []
+for nombre in nombres:
+    ruta = os.path.join(origen, nombre)
+    if os.path.isdir(ruta):
+        for base, _, fs in os.walk(ruta):
+            archivos += [os.path.relpath(os.path.join(base, f), origen) for f in fs]
+    else:
+        archivos.append(nombre)
+total = sum(os.path.getsize(os.path.join(origen, a)) for a in archivos) or 1
+copiados, t0 = 0, time.monotonic()
+for rel in archivos:
+    os.makedirs(os.path.dirname(os.path.join(destino, rel)), exist_ok=True)
+    with open(os.path.join(origen, rel), "rb") as src, open(os.path.join(destino, rel), "wb") as dst:
+        while True:
+            bloque = src.read(ventana)
+            if not bloque:
+                break
+            time.sleep(rtt)          # un RTT por ventana: techo de un flujo TCP
+            dst.write(bloque)
+            copiados += len(bloque)
+            vel = copiados / max(time.monotonic() - t0, 1e-6)
+            sys.stdout.write("\r  %d %3d%%  %.2fMB/s  0:00:00" % (copiados, copiados * 100 // total, vel / 1048576))
+            sys.stdout.flush()
+sys.stdout.write("\n")
+'''
+
+# ssh sustituto: ignora opciones y destino, corre el último argumento aquí.
+_SSH = '#!/bin/sh\nfor a; do ultimo=$a; done\neval "$ultimo"\n'
+
+
+def _instalar(bin_dir: str, nombre: str, contenido: str) -> None:
+    ruta = os.path.join(bin_dir, nombre)
+    with open(ruta, "w") as f:
+        f.write(contenido)
+    os.chmod(ruta, os.stat(ruta).st_mode | stat.S_IEXEC)
+
+
+def _arbol(origen: str, mib: int, entradas: int) -> int:
+    """Directorios de peso desparejo (el i-ésimo pesa ~1/(i+1)), 1 MiB por archivo."""
+    pesos = [1 / (i + 1) for i in range(entradas)]
+    total = 0
+    for i, peso in enumerate(pesos):
+        d = os.path.join(origen, f"producto_{i:02d}")
+        os.makedirs(d)
+        restante = max(1, int(mib * 1048576 * peso / sum(pesos)))
+        n = 0
+        while restante > 0:
+            tamano = min(restante, 1048576)
+            with open(os.path.join(d, f"f{n:04d}.bin"), "wb") as f:
+                f.write(os.urandom(tamano))
+            restante -= tamano
+            total += tamano
+            n += 1
+    return total
+
+
+async def _medir(gestor: GestorFTP, ruta_remota: str, destino: str, n: int, total: int):
+    t0 = time.perf_counter()
+    particiones = None
+    if n > 1:
+        particiones = _particionar((await gestor._contar_remoto(ruta_remota))["primer_nivel"], n)
+    origen = ruta_remota.rstrip("/") + "/"
+    await gestor._rsync_con_progreso("bench", {}, origen, destino, particiones=particiones, total_bytes=total)
+    return time.perf_counter() - t0, len(particiones or [None])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mib", type=int, default=64)
+    parser.add_argument("--entradas", type=int, default=16)
+    parser.add_argument("--rtt-ms", type=float, default=80)
+    parser.add_argument("--ventana-kib", type=int, default=1024)
+    parser.add_argument("--particiones", default="1,2,4,8")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bin_dir = os.path.join(tmp, "bin")
+        os.mkdir(bin_dir)
+        _instalar(bin_dir, "rsync", _RSYNC.format(python=sys.executable, ventana=args.ventana_kib * 1024,
+                                                  rtt=args.rtt_ms / 1000))
+        _instalar(bin_dir, "ssh", _SSH)
+        os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+        os.environ["TEMPOFTP_PROGRESO_INTERVALO_S"] = "3600"
+        origen = os.path.join(tmp, "origen")
+        total = _arbol(origen, args.mib, args.entradas)
+
+        os.chdir(tmp)
+        gestor = GestorFTP()
+        gestor.db = TMPFTPdb(db_path=":memory:")
+        gestor.adb = AsyncTMPFTPdb(gestor.db)
+        techo = args.ventana_kib * 1024 / (args.rtt_ms / 1000) / 1048576
+        print(f"origen: {total / 1048576:.0f} MiB en {args.entradas} entradas; "
+              f"techo por flujo {techo:.1f} MiB/s (ventana {args.ventana_kib} KiB / RTT {args.rtt_ms:g} ms)")
+        base = None
+        for n in (int(x) for x in args.particiones.split(",")):
+            destino = os.path.join(tmp, f"destino_{n}")
+            os.mkdir(destino)
+            duracion, usadas = asyncio.run(_medir(gestor, f"bench@10.255.255.1:{origen}", destino, n, total))
+            mib_s = total / duracion / 1048576
+            base = base or mib_s
+            print(f"particiones={n:<3} (usadas {usadas:<2}) {duracion:7.2f} s  {mib_s:8.1f} MiB/s  x{mib_s / base:.2f}")
+            shutil.rmtree(destino)
+        gestor.ssh.cerrar()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
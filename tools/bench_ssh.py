@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark del multiplexado SSH (sshmux.MultiplexorSSH): latencia por comando
+remoto con una sesión SSH nueva por comando (antes) contra sesiones sobre un
+master ControlMaster ya autenticado (ahora), que es lo que ahorra cada
+solicitud en el sondeo de tamaño y el arranque de rsync.
+
+Por defecto levanta un sshd descartable en 127.0.0.1 (claves temporales,
+puerto alto, sin root) como sustituto del host de origen. Con --host usa un
+host real al que ya haya acceso por clave (p. ej. un host de origen de
+prueba); en ese caso no se levanta sshd.
+
+Uso:
+    python tools/bench_ssh.py [--comandos 30] [--host usuario@host]
+"""
+import argparse
+import getpass
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sshmux import MultiplexorSSH  # noqa: E402
+
+
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _levantar_sshd(tmp: str):
+    """sshd en primer plano con claves propias. Devuelve (proceso, opciones de cliente, destino)."""
+    sshd = shutil.which("sshd") or "/usr/sbin/sshd"
+    if not os.path.exists(sshd):
+        raise SystemExit("No hay sshd en este sistema; usar --host usuario@host.")
+    for nombre in ("host_key", "user_key"):
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", os.path.join(tmp, nombre)], check=True)
+    shutil.copy(os.path.join(tmp, "user_key.pub"), os.path.join(tmp, "authorized_keys"))
+    puerto = _puerto_libre()
+    config = os.path.join(tmp, "sshd_config")
+    with open(config, "w") as f:
+        f.write(f"Port {puerto}\nListenAddress 127.0.0.1\nHostKey {tmp}/host_key\n"
+                f"AuthorizedKeysFile {tmp}/authorized_keys\nPidFile {tmp}/sshd.pid\n"
+                "UsePAM no\nStrictModes no\nPasswordAuthentication no\n")
+    proc = subprocess.Popen([sshd, "-D", "-e", "-f", config], stderr=subprocess.DEVNULL)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", puerto), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    opciones = ["-i", os.path.join(tmp, "user_key"), "-p", str(puerto)]
+    return proc, opciones, f"{getpass.getuser()}@127.0.0.1"
+
+
+def _medir(cmd_base, n: int):
+    latencias = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        subprocess.run(cmd_base + ["true"], check=True, capture_output=True)
+        latencias.append(time.perf_counter() - t0)
+    latencias.sort()
+    return latencias
+
+
+def _reporte(nombre: str, latencias) -> float:
+    media = sum(latencias) / len(latencias)
+    p99 = latencias[min(len(latencias) - 1, int(round(0.99 * (len(latencias) - 1))))]
+    print(f"{nombre:<28} media {media * 1000:8.1f} ms   p50 {latencias[len(latencias) // 2] * 1000:8.1f} ms"
+          f"   p99 {p99 * 1000:8.1f} ms")
+    return media
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--comandos", type=int, default=30)
+    parser.add_argument("--host", help="usuario@host real en lugar del sshd local")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        proc = None
+        if args.host:
+            opciones, destino = [], args.host
+        else:
+            proc, opciones, destino = _levantar_sshd(tmp)
+        comunes = ["-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=no",
+                   "-o", "UserKnownHostsFile=/dev/null", "-o", "LogLevel=ERROR", *opciones]
+        mux = MultiplexorSSH(directorio=os.path.join(tmp, "cm"), persist_s=60, activo=True)
+        try:
+            sin = _reporte("sesión nueva por comando", _medir(["ssh", *comunes, destino], args.comandos))
+            cmd_mux = mux.ssh(destino)
+            cmd_mux[1:1] = comunes
+            subprocess.run(cmd_mux + ["true"], check=True, capture_output=True)   # crea el master
+            con = _reporte("sobre ControlMaster", _medir(cmd_mux, args.comandos))
+            print(f"ahorro por comando: {(sin - con) * 1000:.1f} ms ({(1 - con / sin) * 100:.0f}%);"
+                  f" una solicitud remota hace al menos 2 (sondeo + rsync)")
+        finally:
+            # %C incluye el puerto: el -O exit necesita las mismas opciones que el master.
+            subprocess.run(["ssh", *comunes, *mux._opciones_control(), "-O", "exit", destino], capture_output=True)
+            mux.cerrar()
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark de TMPFTPdb: conexión persistente por hilo + WAL (actual) contra el
+camino anterior de una conexión por llamada en modo rollback journal.
+
+Mide lecturas (obtener_solicitud, lo que hace cada GET /tmpftp/{id}) y
+escrituras (actualizar_estado) con varios hilos concurrentes, sobre un archivo
+temporal. No toca tempoftp.db.
+
+Uso:
+    python tools/bench_tmpftpdb.py [--filas 2000] [--ops 5000] [--hilos 4]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tmpftpdb import TMPFTPdb  # noqa: E402
+
+
+class TMPFTPdbPorLlamada(TMPFTPdb):
+    """Reproduce el _get_conn anterior: connect/close por sentencia, sin PRAGMAs."""
+
+    @contextmanager
+    def _get_conn(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+
+def _poblar(db: TMPFTPdb, filas: int) -> None:
+    for i in range(filas):
+        db.crear_solicitud(f"q{i}", f"u{i}@x.com", "h:/p", "listo",
+                           {"usuario": f"ftp_u{i}_x", "vigencia": 5,
+                            "created_at": "2026-01-01T00:00:00+00:00"})
+
+
+def _correr(db: TMPFTPdb, ops: int, hilos: int, filas: int, escritura: bool) -> float:
+    por_hilo = ops // hilos
+
+    def trabajo(n: int) -> None:
+        for i in range(por_hilo):
+            id_ = f"q{(n * por_hilo + i) % filas}"
+            if escritura:
+                db.actualizar_estado(id_, "listo")
+            else:
+                db.obtener_solicitud(id_)
+
+    threads = [threading.Thread(target=trabajo, args=(n,)) for n in range(hilos)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (por_hilo * hilos) / (time.perf_counter() - t0)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, default=2000)
+    parser.add_argument("--ops", type=int, default=5000)
+    parser.add_argument("--hilos", type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"{'modo':<22} {'lecturas/s':>12} {'escrituras/s':>14}")
+    for nombre, cls in (("por llamada (antes)", TMPFTPdbPorLlamada), ("persistente + WAL", TMPFTPdb)):
+        with tempfile.TemporaryDirectory() as tmp:
+            db = cls(db_path=os.path.join(tmp, "bench.db"))
+            _poblar(db, args.filas)
+            lecturas = _correr(db, args.ops, args.hilos, args.filas, escritura=False)
+            escrituras = _correr(db, args.ops, args.hilos, args.filas, escritura=True)
+            if hasattr(db, "close"):
+                db.close()
+        print(f"{nombre:<22} {lecturas:>12.0f} {escrituras:>14.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Worker de transferencias: atiende la cola de trabajos de copia (tabla
+`trabajos` en tempoftp.db) que encola POST /tmpftp.
+
+Antes cada POST lanzaba proceso_copia con asyncio.create_task dentro del
+worker de uvicorn que lo recibía: un reinicio (o el reciclado de un worker)
+dejaba la solicitud para siempre en 'preparando'/'traslado', y los 4 workers
+no compartían ningún límite de copias simultáneas. Ahora la API sólo encola y
+este proceso, uno solo (deployment/tempoftp-transfer.service), reclama
+trabajos con lease, lo renueva mientras copia y lo cierra al terminar. Si
+muere, al volver a arrancar libera los trabajos que dejó en curso y reencola
+las solicitudes a medio copiar que no tengan trabajo abierto; rsync retoma
+lo ya copiado (--partial/--append-verify).
+
+Variables de entorno:
+    TEMPOFTP_TRANSFER_CONCURRENCY  trabajos simultáneos (8; los rsync además
+                                   pasan por la admisión TEMPOFTP_RSYNC_*)
+    TEMPOFTP_JOB_LEASE_S           duración del lease en segundos (60)
+    TEMPOFTP_JOB_POLL_S            espera entre consultas con la cola vacía (2)
+    TEMPOFTP_JOB_MAX_INTENTOS      reclamos antes de dar la solicitud por fallida (3)
+    TEMPOFTP_JOB_CANCEL_POLL_S     cada cuánto se revisa si un trabajo en curso
+                                   fue cancelado con DELETE /tmpftp/{id} (1)
+    TEMPOFTP_METRICAS_INTERVALO_S  cada cuánto se loguean las métricas del proceso (300)
+
+Uso:
+    python transfer_worker.py
+"""
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+)
+logger = logging.getLogger("tempoftp.transfer")
+
+
+def _owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _owner_vivo(owner: str) -> bool:
+    """¿Sigue corriendo el worker `owner` (host:pid)? Los de otro host se dan
+    por vivos: su lease vencerá solo si no lo están."""
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+async def _cancelado(gestor, trabajo: dict) -> None:
+    logger.info("Trabajo %s (solicitud %s) cancelado.", trabajo["id"], trabajo["solicitud_id"])
+    if hasattr(gestor, "limpiar_cancelada"):
+        await gestor.limpiar_cancelada(trabajo["solicitud_id"])
+
+
+async def _ejecutar_trabajo(gestor, trabajo: dict, owner: str, lease_s: float, max_intentos: int,
+                            cancel_poll_s: float = 1.0) -> None:
+    """Procesa un trabajo renovando su lease cada lease_s/3 hasta que termine.
+    Cada cancel_poll_s revisa si DELETE /tmpftp/{id} lo canceló; en ese caso
+    cancela la tarea (rsync y su ssh se terminan con ella) y borra el destino
+    parcial."""
+    adb = gestor.adb
+    if trabajo["intentos"] > max_intentos:
+        logger.error("Trabajo %s (solicitud %s) superó %d intentos; se marca fallido.",
+                     trabajo["id"], trabajo["solicitud_id"], max_intentos)
+        solicitud = await adb.obtener_solicitud(trabajo["solicitud_id"])
+        if solicitud:
+            await adb.actualizar_estado(trabajo["solicitud_id"], "error", {
+                **solicitud["info"],
+                "mensaje": f"La copia se interrumpió {max_intentos} veces; se abandona.",
+            })
+        await adb.finalizar_trabajo(trabajo["id"], owner, "fallido")
+        return
+
+    loop = asyncio.get_running_loop()
+    tarea = asyncio.create_task(gestor.procesar_trabajo(trabajo))
+    renovar_en = loop.time() + lease_s / 3
+    try:
+        while True:
+            done, _ = await asyncio.wait({tarea}, timeout=min(cancel_poll_s, lease_s / 3))
+            if done:
+                break
+            # Un error pasajero (database is locked) no abandona la copia: se
+            # reintenta en la siguiente vuelta, antes de que venza el lease.
+            try:
+                cancelado = await adb.trabajo_cancelado(trabajo["id"])
+            except Exception as e:
+                logger.warning("Trabajo %s: no se pudo consultar si fue cancelado: %s", trabajo["id"], e)
+                cancelado = False
+            if cancelado:
+                tarea.cancel()
+                await asyncio.gather(tarea, return_exceptions=True)
+                await _cancelado(gestor, trabajo)
+                return
+            if loop.time() >= renovar_en:
+                try:
+                    renovado = await adb.renovar_lease(trabajo["id"], owner, lease_s)
+                except Exception as e:
+                    logger.warning("Trabajo %s: no se pudo renovar el lease: %s", trabajo["id"], e)
+                    continue
+                if not renovado:
+                    logger.error("Trabajo %s: lease perdido, se abandona la copia.", trabajo["id"])
+                    return
+                renovar_en = loop.time() + lease_s / 3
+        tarea.result()
+        if await adb.finalizar_trabajo(trabajo["id"], owner, "hecho"):
+            logger.info("Trabajo %s (solicitud %s) terminado.", trabajo["id"], trabajo["solicitud_id"])
+        elif await adb.trabajo_cancelado(trabajo["id"]):
+            # Cancelado entre el último sondeo y el final de la copia.
+            await _cancelado(gestor, trabajo)
+    except asyncio.CancelledError:
+        # Apagado ordenado: devolver el trabajo a la cola sin esperar al lease,
+        # pero sólo cuando la copia terminó de detenerse (su finally libera la
+        # reserva y el cupo), para que otro intento no corra a la par.
+        await asyncio.shield(_detener(tarea))
+        await asyncio.shield(adb.liberar_trabajo(trabajo["id"], owner))
+        raise
+    finally:
+        # Cualquier otra salida (lease perdido, error inesperado) tampoco deja
+        # la copia corriendo sin nadie que renueve su lease.
+        await asyncio.shield(_detener(tarea))
+
+
+async def _detener(tarea: asyncio.Task) -> None:
+    """Cancela la tarea, si sigue corriendo, y espera a que termine."""
+    if not tarea.done():
+        tarea.cancel()
+    await asyncio.gather(tarea, return_exceptions=True)
+
+
+async def _esperar_cupo(cupo: asyncio.Semaphore, stop: asyncio.Event) -> bool:
+    """Adquiere un cupo del semáforo, o devuelve False si llega la señal de parada
+    antes (con todos los cupos ocupados por copias largas, acquire() podría
+    tardar horas y el worker no atendería el SIGTERM)."""
+    adquirir = asyncio.ensure_future(cupo.acquire())
+    parar = asyncio.ensure_future(stop.wait())
+    await asyncio.wait({adquirir, parar}, return_when=asyncio.FIRST_COMPLETED)
+    parar.cancel()
+    if adquirir.done():
+        return True
+    adquirir.cancel()
+    return False
+
+
+async def _reportar_metricas(gestor, intervalo_s: float) -> None:
+    """Loguea cada intervalo_s las métricas en memoria del gestor. Los
+    sondeos, hashes y resoluciones DNS ocurren en este proceso, así que el
+    /health de la API (otro proceso) no las ve."""
+    while True:
+        await asyncio.sleep(intervalo_s)
+        metricas = {nombre: getattr(gestor, f"metricas_{nombre}")()
+                    for nombre in ("mysql", "argon2", "dns") if hasattr(gestor, f"metricas_{nombre}")}
+        if metricas:
+            logger.info("Métricas: %s", json.dumps(metricas, sort_keys=True))
+
+
+async def _run(stop: asyncio.Event) -> None:
+    # Import diferido a después de load_dotenv(), como en cleanup_expired.py.
+    from gestorftpbase import select_gestor
+
+    concurrencia = int(os.getenv("TEMPOFTP_TRANSFER_CONCURRENCY", "8"))
+    lease_s = float(os.getenv("TEMPOFTP_JOB_LEASE_S", "60"))
+    poll_s = float(os.getenv("TEMPOFTP_JOB_POLL_S", "2"))
+    max_intentos = int(os.getenv("TEMPOFTP_JOB_MAX_INTENTOS", "3"))
+    cancel_poll_s = float(os.getenv("TEMPOFTP_JOB_CANCEL_POLL_S", "1"))
+
+    gestor = select_gestor()
+    await gestor.iniciar()
+    # Papelera, escáner de uso e índice de descargas: en este proceso y no en
+    # la API, para que corran una sola vez.
+    await gestor.iniciar_tareas_fondo()
+    owner = _owner()
+    # Copias que un worker anterior dejó a medias: se retoman ya, sobre los
+    # datos parciales (ver procesar_trabajo), sin esperar a que venza su lease.
+    recuperados = await gestor.adb.recuperar_trabajos(_owner_vivo)
+    if any(recuperados.values()):
+        logger.info("Recuperación al arrancar: %d trabajos huérfanos liberados, %d solicitudes reencoladas",
+                    recuperados["liberados"], recuperados["reencolados"])
+    cupo = asyncio.Semaphore(concurrencia)
+    en_curso: set = set()
+    logger.info("Worker de transferencias %s: concurrencia=%d lease=%ss", owner, concurrencia, lease_s)
+    reporte = asyncio.create_task(
+        _reportar_metricas(gestor, float(os.getenv("TEMPOFTP_METRICAS_INTERVALO_S", "300"))))
+
+    try:
+        while not stop.is_set():
+            if not await _esperar_cupo(cupo, stop):
+                break
+            trabajo = await gestor.adb.reclamar_trabajo(owner, lease_s)
+            if trabajo is None:
+                cupo.release()
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=poll_s)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            logger.info("Trabajo %s reclamado (solicitud %s, intento %d)",
+                        trabajo["id"], trabajo["solicitud_id"], trabajo["intentos"])
+            tarea = asyncio.create_task(_ejecutar_trabajo(gestor, trabajo, owner, lease_s, max_intentos, cancel_poll_s))
+            en_curso.add(tarea)
+            tarea.add_done_callback(en_curso.discard)
+            tarea.add_done_callback(lambda _t: cupo.release())
+    finally:
+        reporte.cancel()
+        for tarea in list(en_curso):
+            tarea.cancel()
+        await asyncio.gather(*en_curso, return_exceptions=True)
+        await gestor.cerrar()
+
+
+async def _main_async() -> None:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await _run(stop)
+
+
+def main() -> int:
+    try:
+        asyncio.run(_main_async())
+        return 0
+    except Exception:
+        logger.exception("Error en el worker de transferencias")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
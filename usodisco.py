@@ -0,0 +1,217 @@
+"""
+Uso de /data por home FTP, medido en segundo plano (GET /usage).
+
+Cuando /data se llenaba, la única forma de encontrar a los responsables era
+correr `du` a mano sobre cientos de /data/ftp_*, compitiendo por el disco con
+las descargas FTP. Ahora un escáner recorre los homes periódicamente y deja
+el resultado en SQLite (tabla uso_escaneo), de donde GET /usage lo sirve al
+instante, ordenado por tamaño y con la antigüedad de la foto:
+
+- un solo hilo, el mismo en todas las pasadas, con os.scandir, prioridad de
+  E/S idle y nice 19 (sólo ese hilo), cada TEMPOFTP_USO_INTERVALO_S segundos
+  (900). El hilo sólo recorre: la foto se guarda desde el event loop, por la
+  fachada async de la base (sin abrir conexiones SQLite en ese hilo);
+- por cada directorio guarda su mtime, lo que suman sus archivos y sus
+  subdirectorios. Si en la pasada siguiente el mtime no cambió (no se creó,
+  borró ni renombró nada en él) reutiliza eso sin listarlo ni hacer stat de
+  sus archivos: sólo cuesta un stat por directorio. Se baja igual a sus
+  subdirectorios, porque un cambio más abajo no toca el mtime del padre;
+- el mtime no cambia si un archivo crece en su lugar (rsync --append-verify
+  al retomar una copia), así que cada TEMPOFTP_USO_PASADA_COMPLETA pasadas
+  (24; 0 = nunca) se relee todo;
+- no entra en /data/.trash (la papelera lleva su propia cuenta) ni sigue
+  enlaces simbólicos (los homes de orígenes locales son enlaces);
+- corre sólo en el worker de transferencias (GestorFTP.iniciar_tareas_fondo,
+  desde transfer_worker.py), no en cada worker de uvicorn; la API sólo lee
+  la foto. Un flock sobre /data/.uso.lock evita además que dos procesos
+  escaneen a la vez (p. ej. el worker saliente y el nuevo en un reinicio).
+  La caché de directorios es del proceso: el que tome el relevo empieza con
+  una pasada completa.
+
+Los bytes son aparentes (st_size, como `du -b`) y un árbol armado con
+enlaces duros (reuso de contenido) cuenta completo en cada home que lo ve.
+"""
+import asyncio
+import fcntl
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from papelera import _bajar_prioridad_io
+
+logger = logging.getLogger(__name__)
+
+# Prefijo de los homes FTP (ver GestorFTPBase.generate_username).
+_PREFIJO_HOME = "ftp_"
+
+
+class _Directorio:
+    """Lo que se sabe de un directorio en la última pasada."""
+    __slots__ = ("mtime_ns", "bytes", "archivos", "subdirs")
+
+    def __init__(self, mtime_ns: int, bytes_: int, archivos: int, subdirs: List[str]) -> None:
+        self.mtime_ns, self.bytes, self.archivos, self.subdirs = mtime_ns, bytes_, archivos, subdirs
+
+
+def _hilo_baja_prioridad() -> None:
+    """Inicializador del hilo del escáner: E/S idle y nice 19, sólo para él."""
+    _bajar_prioridad_io()
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+class EscanerUso:
+    """Recorre los homes de `raiz` y guarda el uso de cada uno con `guardar`
+    (corrutina que recibe filas, duración y estadísticas de la pasada; p. ej.
+    AsyncTMPFTPdb.guardar_escaneo_uso)."""
+
+    def __init__(self, raiz: str = "/data", guardar=None, intervalo_s: Optional[float] = None,
+                 pasada_completa: Optional[int] = None) -> None:
+        self.raiz = os.path.abspath(raiz)
+        self.papelera = os.path.join(self.raiz, ".trash")
+        self.guardar = guardar
+        self.intervalo_s = intervalo_s if intervalo_s is not None else float(
+            os.getenv("TEMPOFTP_USO_INTERVALO_S", "900"))
+        self.pasada_completa = pasada_completa if pasada_completa is not None else int(
+            os.getenv("TEMPOFTP_USO_PASADA_COMPLETA", "24"))
+        self._cache: Dict[str, _Directorio] = {}
+        self._pasadas = 0
+        # Duración y estadísticas ({leidos, reusados}) de la última pasada.
+        self.duracion_s = 0.0
+        self.stats: Dict[str, int] = {"leidos": 0, "reusados": 0}
+        self._parar = threading.Event()
+        self._hilo: Optional[ThreadPoolExecutor] = None
+        self._tarea: Optional[asyncio.Task] = None
+
+    # --- Recorrido -------------------------------------------------------------
+
+    def _homes(self) -> List[str]:
+        try:
+            with os.scandir(self.raiz) as it:
+                return sorted(e.path for e in it
+                              if e.name.startswith(_PREFIJO_HOME) and e.is_dir(follow_symlinks=False))
+        except FileNotFoundError:
+            return []
+
+    def _directorio(self, ruta: str, completa: bool, stats: Dict[str, int]) -> Optional[_Directorio]:
+        """Lo propio de `ruta` (sin bajar): de la caché si su mtime no cambió."""
+        try:
+            mtime_ns = os.lstat(ruta).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        previo = self._cache.get(ruta)
+        if previo is not None and previo.mtime_ns == mtime_ns and not completa:
+            stats["reusados"] += 1
+            return previo
+        bytes_ = archivos = 0
+        subdirs = []
+        try:
+            with os.scandir(ruta) as it:
+                for entrada in it:
+                    try:
+                        if entrada.is_dir(follow_symlinks=False):
+                            if entrada.path != self.papelera:
+                                subdirs.append(entrada.path)
+                        else:
+                            bytes_ += entrada.stat(follow_symlinks=False).st_size
+                            archivos += 1
+                    except FileNotFoundError:
+                        continue
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        stats["leidos"] += 1
+        directorio = _Directorio(mtime_ns, bytes_, archivos, subdirs)
+        self._cache[ruta] = directorio
+        return directorio
+
+    def _home(self, home: str, completa: bool, vistos: set, stats: Dict[str, int]) -> Dict[str, Any]:
+        total = {"bytes": 0, "archivos": 0, "directorios": 0}
+        pendientes = [home]
+        while pendientes and not self._parar.is_set():
+            ruta = pendientes.pop()
+            directorio = self._directorio(ruta, completa, stats)
+            if directorio is None:
+                continue
+            vistos.add(ruta)
+            total["bytes"] += directorio.bytes
+            total["archivos"] += directorio.archivos
+            total["directorios"] += 1
+            pendientes.extend(directorio.subdirs)
+        return total
+
+    def escanear(self) -> Optional[List[Dict[str, Any]]]:
+        """Una pasada sobre todos los homes, salvo que otro proceso ya esté
+        escaneando (None). Devuelve [{usuario, bytes, archivos, directorios}]
+        y deja la duración y las estadísticas en duracion_s y stats. No
+        guarda nada: eso lo hace el bucle en segundo plano."""
+        try:
+            fd = os.open(os.path.join(self.raiz, ".uso.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+        except OSError as e:
+            logger.warning("No se pudo abrir el lock del escáner de uso en %s: %s", self.raiz, e)
+            return None
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            t0 = time.perf_counter()
+            completa = not self._cache or (self.pasada_completa > 0 and self._pasadas % self.pasada_completa == 0)
+            stats = {"leidos": 0, "reusados": 0}
+            vistos: set = set()
+            filas = []
+            for home in self._homes():
+                if self._parar.is_set():
+                    return None
+                filas.append({"usuario": os.path.basename(home), **self._home(home, completa, vistos, stats)})
+            # Directorios que ya no existen (solicitudes borradas, homes eliminados).
+            for ruta in set(self._cache) - vistos:
+                del self._cache[ruta]
+            self._pasadas += 1
+            self.duracion_s, self.stats = time.perf_counter() - t0, stats
+            logger.info("Escaneo de uso de %s: %d homes, %d directorios leídos, %d sin cambios, %.2fs%s",
+                        self.raiz, len(filas), stats["leidos"], stats["reusados"], self.duracion_s,
+                        " (pasada completa)" if completa else "")
+            return filas
+        finally:
+            os.close(fd)
+
+    # --- Escáner en segundo plano ----------------------------------------------
+
+    async def iniciar(self) -> None:
+        if self._tarea is not None or self.intervalo_s <= 0:
+            return
+        self._parar.clear()
+        # Un solo hilo para todas las pasadas: la prioridad baja no contagia
+        # al executor por defecto, que usan los borrados y las consultas.
+        self._hilo = ThreadPoolExecutor(max_workers=1, initializer=_hilo_baja_prioridad,
+                                        thread_name_prefix="uso-disco")
+        self._tarea = asyncio.create_task(self._bucle())
+
+    async def _bucle(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                filas = await loop.run_in_executor(self._hilo, self.escanear)
+                if filas is not None and self.guardar is not None:
+                    await self.guardar(filas, self.duracion_s, dict(self.stats))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error escaneando el uso de %s", self.raiz)
+            await asyncio.sleep(self.intervalo_s)
+
+    async def cerrar(self) -> None:
+        self._parar.set()
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+        if self._hilo is not None:
+            # _parar corta la pasada en curso en el próximo directorio.
+            await asyncio.to_thread(self._hilo.shutdown, wait=True)
+            self._hilo = None